@@ -0,0 +1,98 @@
+# alert_fields.py
+#
+# Extractor de campos del cuerpo de una alarma en UNA pasada:
+#   Planta / Sede, Área / Zona / Ubicación / Lugar, Operador, ID Operador / DNI.
+# Mismas reglas que parse_plant / parse_area / parse_operator: cada campo sale de la
+# PRIMERA línea donde matchea su patrón; planta / área, si no, del texto completo.
+#
+# Lo usan gmail_alert_listener.py y gmail_alert_month_backfill.py (build_alert_payload).
+# Benchmark contra las funciones anteriores en bench_parsing.py. Solo stdlib.
+
+import re
+
+PLANT_RE = re.compile(r"(Planta|Sede)\s*:\s*(.+)", re.IGNORECASE)
+PLANT_FALLBACK_RE = re.compile(r"(Planta|Sede)\s*:\s*([^\n\r]+)", re.IGNORECASE)
+
+AREA_LABELS = r"(?:\bÁrea\b|\bArea\b|\bZona\b|\bUbicación\b|\bUbicacion\b|\bLugar\b)"
+AREA_RE = re.compile(AREA_LABELS + r"\s*:\s*(.+)", re.IGNORECASE)
+AREA_FALLBACK_RE = re.compile(AREA_LABELS + r"\s*:\s*([^\n\r]+)", re.IGNORECASE)
+
+OPERATOR_NAME_RE = re.compile(r"Operador\s*:\s*(.+)", re.IGNORECASE)
+OPERATOR_ID_RE = re.compile(r"(ID\s*Operador|DNI)\s*:\s*(.+)", re.IGNORECASE)
+
+VALUE_CUT_RE = re.compile(r"\s{2,}|\t|\|")
+
+# Fecha / Hora del evento (parse_event_time_from_body en los scripts, alert_templates.py)
+EVENT_TIME_RE = re.compile(
+    r"(?:Alarma\s+Fecha|Fecha)\s*:\s*([0-9]{2}-[A-Za-z]{3}-[0-9]{4}).*?Hora\s*:\s*([0-9]{2}:[0-9]{2})",
+    re.IGNORECASE | re.DOTALL,
+)
+
+# prefiltro en minúsculas; IGNORECASE además iguala ı/İ con i y ſ con s
+PLANT_WORDS = ("planta", "sede")
+AREA_WORDS = ("area", "área", "zona", "ubicacion", "ubicación", "lugar")
+OPERATOR_WORD = "operador"
+OPERATOR_ID_WORDS = ("operador", "dni")
+
+
+def lower_for_prefilter(text: str) -> str:
+    return text.lower().replace("\u0307", "").replace("ı", "i").replace("ſ", "s")
+
+_UNSET = object()
+
+
+def cut_value(val: str):
+    val = VALUE_CUT_RE.split(val.strip())[0].strip()
+    return val or None
+
+
+def extract_fields(text: str):
+    """
+    (planta, área, nombre_operador, id_operador); None donde no haya dato.
+    """
+    if not text:
+        return None, None, None, None
+
+    plant = area = _UNSET
+    operator_name = operator_id = None
+
+    low_text = lower_for_prefilter(text)
+    lines = text.splitlines()
+    low_lines = low_text.splitlines()  # mismas líneas (lower() no toca los saltos)
+
+    for line, low in zip(lines, low_lines):
+        if ":" not in low:
+            continue
+        line = line.strip()
+
+        if plant is _UNSET and any(w in low for w in PLANT_WORDS):
+            m = PLANT_RE.search(line)
+            if m:
+                plant = cut_value(m.group(2))
+
+        if area is _UNSET and any(w in low for w in AREA_WORDS):
+            m = AREA_RE.search(line)
+            if m:
+                area = cut_value(m.group(1))
+
+        if operator_name is None and OPERATOR_WORD in low:
+            m = OPERATOR_NAME_RE.search(line)
+            if m:
+                operator_name = m.group(1).strip() or None
+
+        if operator_id is None and any(w in low for w in OPERATOR_ID_WORDS):
+            m = OPERATOR_ID_RE.search(line)
+            if m:
+                operator_id = m.group(2).strip() or None
+
+        if plant is not _UNSET and area is not _UNSET and operator_name is not None and operator_id is not None:
+            break
+
+    if plant is _UNSET:
+        m = PLANT_FALLBACK_RE.search(text) if any(w in low_text for w in PLANT_WORDS) else None
+        plant = cut_value(m.group(2)) if m else None
+    if area is _UNSET:
+        m = AREA_FALLBACK_RE.search(text) if any(w in low_text for w in AREA_WORDS) else None
+        area = cut_value(m.group(1)) if m else None
+
+    return plant, area, operator_name, operator_id
@@ -0,0 +1,103 @@
+# alert_keywords.py
+#
+# Palabras clave de una alarma (alarma, checklist, impacto, fren, aceler,
+# sin condiciones, bloquea) y las decisiones que dependen de ellas, juntas en un módulo:
+#   - filtro de relevancia y checklist (process_message / evaluate_message)
+#   - tipo permitido (canonical_alert_type / guess_allowed_type)
+#   - severidad (guess_severity)
+#
+# Es una reorganización, no un buscador de una pasada: cada texto se pasa a minúsculas una
+# vez y cada decisión hace sus propios "in" sobre ese texto. Una alternación compilada con un
+# solo findall da el mismo resultado pero mide ~0.4x: re no tiene prefiltro de varios
+# literales y siete "in" (búsqueda en C) recorren el texto más rápido. En bench_parsing.py el
+# resultado queda a la par de las funciones anteriores (~0.8-0.9x), no más rápido.
+#
+# Benchmark contra las funciones anteriores en bench_parsing.py. Solo stdlib.
+
+# raíces del filtro de relevancia (substring sobre el texto en minúsculas); el filtro de
+# servidor opcional (ALERT_SERVER_QUERY=imap) busca las mismas con SEARCH TEXT
+RELEVANT_STEMS = ("alarma", "checklist", "impacto", "fren", "aceler")
+
+# tipo canónico (sobre el texto en mayúsculas y sin tildes), en orden de prioridad
+TYPE_MARKERS = (("IMPACTO", "IMPACTO"), ("FREN", "FRENADA"), ("ACELER", "ACELERACION"))
+
+
+def normalize_alert_text(s: str) -> str:
+    if not s:
+        return ""
+    x = s.strip().upper()
+    x = (x.replace("Ó", "O")
+           .replace("Á", "A")
+           .replace("É", "E")
+           .replace("Í", "I")
+           .replace("Ú", "U"))
+    return x
+
+
+def canonical_alert_type(s: str) -> str:
+    """
+    Mapea variaciones a los 3 tipos permitidos:
+      - contiene IMPACTO => IMPACTO
+      - contiene FREN => FRENADA
+      - contiene ACELER => ACELERACION
+    """
+    x = normalize_alert_text(s)
+    for marker, alert_type in TYPE_MARKERS:
+        if marker in x:
+            return alert_type
+    return ""
+
+
+class KeywordScan:
+    """
+    Palabras clave de UN texto (asunto o cuerpo): minúsculas una vez, tipo canónico a pedido.
+    """
+    __slots__ = ("text", "low", "_alert_type")
+
+    def __init__(self, text: str):
+        self.text = text or ""
+        self.low = self.text.lower()
+        self._alert_type = None
+
+    def relevant(self) -> bool:
+        # filtro rápido: si no aparece ninguna, el correo ni se cachea
+        low = self.low
+        return any(stem in low for stem in RELEVANT_STEMS)
+
+    def checklist(self) -> bool:
+        return "checklist" in self.low
+
+    def blocking(self) -> bool:
+        return "sin condiciones" in self.low or "bloquea" in self.low
+
+    def alert_type(self) -> str:
+        if self._alert_type is None:
+            self._alert_type = canonical_alert_type(self.text)
+        return self._alert_type
+
+
+def is_relevant(subject_kw: KeywordScan, body_kw: KeywordScan) -> bool:
+    return subject_kw.relevant() or body_kw.relevant()
+
+
+def is_checklist(subject_kw: KeywordScan, body_kw: KeywordScan) -> bool:
+    return subject_kw.checklist() or body_kw.checklist()
+
+
+def guess_allowed_type(subject_kw: KeywordScan, parse_kw: KeywordScan) -> str:
+    """
+    Tipo del asunto; si no trae, el del texto del cuerpo; o "".
+    """
+    return subject_kw.alert_type() or parse_kw.alert_type()
+
+
+def guess_severity(alert_type: str, scan: KeywordScan) -> str:
+    t = normalize_alert_text(alert_type or "")
+
+    if scan.blocking():
+        return "BLOQUEA_OPERACION"
+    if "IMPACTO" in t:
+        return "CRITICAL"
+    if "FREN" in t or "ACELER" in t:
+        return "WARNING"
+    return "INFO"
@@ -0,0 +1,305 @@
+# alert_templates.py
+#
+# Registro de plantillas: casi todo el correo de alarmas sale de la misma plantilla,
+# así que en vez de correr el parser genérico (alert_fields.extract_fields + Fecha/Hora)
+# en cada correo se aprende UNA vez en qué línea está cada dato.
+#   huella = (remitente, dominio del Message-ID, etiquetas de las líneas que pueden traer
+#             un campo o la Fecha)
+# Las demás líneas (texto libre como 'a las 10:45', líneas en blanco o de más) no entran en
+# la huella: el plan apunta a la n-ésima línea con etiqueta, no a un número de línea.
+# El plan solo se guarda si reproduce exactamente el resultado del parser genérico, y
+# se aplica solo si sigue valiendo para ese correo (ver apply_plan); si no, genérico.
+#
+# Los planes aprendidos se guardan en cache/alert_templates.json (TemplateRegistry.load /
+# save) para no volver a aprenderlos en cada arranque.
+#
+# Lo usan gmail_alert_listener.py y gmail_alert_month_backfill.py (build_alert_payload).
+# Benchmark contra el parser genérico en bench_parsing.py. Solo stdlib.
+
+import functools
+import json
+import os
+import re
+import threading
+
+from alert_fields import (
+    AREA_RE, AREA_WORDS, EVENT_TIME_RE, OPERATOR_ID_RE, OPERATOR_ID_WORDS, OPERATOR_NAME_RE, OPERATOR_WORD,
+    PLANT_RE, PLANT_WORDS, cut_value, extract_fields, lower_for_prefilter,
+)
+
+
+def strip_value(value: str):
+    return value or None
+
+
+# (patrón por línea, palabras del prefiltro, valor a partir del texto tras la etiqueta)
+FIELDS = (
+    (PLANT_RE, PLANT_WORDS, cut_value),
+    (AREA_RE, AREA_WORDS, cut_value),
+    (OPERATOR_NAME_RE, (OPERATOR_WORD,), strip_value),
+    (OPERATOR_ID_RE, OPERATOR_ID_WORDS, strip_value),
+)
+ABSENT = -1  # el campo no aparece en el cuerpo
+# cualquier palabra de cualquier campo (sobre texto ya pasado por lower_for_prefilter)
+ANY_FIELD_WORD_RE = re.compile("|".join(sorted({w for _, words, _ in FIELDS for w in words}, key=len, reverse=True)))
+EVENT_WORD = "fecha"
+
+# formato de cache/alert_templates.json: subirlo si cambian las reglas de alert_fields
+# (los planes guardados dejan de valer y se descartan al cargar)
+TEMPLATES_FORMAT = 1
+
+_UNKNOWN = object()
+
+
+def message_origin(from_: str, message_id: str) -> tuple:
+    """
+    (remitente, dominio del Message-ID) en minúsculas: parte de la huella.
+    """
+    sender = (from_ or "").rpartition("<")[2].rstrip(">").strip().lower()
+    message_id = (message_id or "").strip().rstrip(">")
+    domain = message_id.rpartition("@")[2].lower() if "@" in message_id else ""
+    return sender, domain
+
+
+@functools.lru_cache(maxsize=4096)
+def is_key_label(label: str) -> bool:
+    """
+    True si la etiqueta puede ser la de un campo o la de Fecha: entra en la huella.
+    Con cache: las etiquetas de una plantilla se repiten en cada correo.
+    """
+    low = lower_for_prefilter(label)
+    return EVENT_WORD in low or ANY_FIELD_WORD_RE.search(low) is not None
+
+
+def split_labels(lines):
+    """
+    (esqueleto, restos, posiciones):
+      esqueleto  = etiquetas (lo anterior al primer ':') de las líneas que pueden traer un
+                   campo o la Fecha, en orden
+      restos     = lo que sigue al primer ':', para CADA línea
+      posiciones = número de línea de cada etiqueta del esqueleto
+    Un campo solo matchea en una línea cuya etiqueta tiene la palabra del campo, o con otro
+    ':' en el resto (eso lo revisa apply_plan): las demás líneas no cambian la huella.
+    """
+    labels = []
+    rests = []
+    positions = []
+    for j, line in enumerate(lines):
+        label, colon, rest = line.partition(":")
+        rests.append(rest)
+        if colon and is_key_label(label):
+            labels.append(label)
+            positions.append(j)
+    return tuple(labels), rests, positions
+
+
+def apply_plan(plan, text: str, lines, rests, positions):
+    """
+    ((planta, área, nombre_operador, id_operador), texto para Fecha/Hora) o None si el
+    plan no vale para este cuerpo.
+    """
+    field_keys, event_key = plan
+    field_lines = [ABSENT if k == ABSENT else positions[k] for k in field_keys]
+    event_line = None if event_key is None else positions[event_key]
+    values = []
+    low_text = None
+
+    # líneas con otro ':' después de la etiqueta y alguna palabra de campo: ahí podría
+    # matchear un campo antes que en la línea del plan (casi nunca pasa)
+    last = max(field_lines)
+    risky = {}
+    for j in range(last):
+        if ":" in rests[j]:
+            low = lower_for_prefilter(rests[j])
+            if ANY_FIELD_WORD_RE.search(low):
+                risky[j] = low
+
+    for (_, words, value_of), idx in zip(FIELDS, field_lines):
+        if idx == ABSENT:
+            if low_text is None:
+                low_text = lower_for_prefilter(text)
+            if any(w in low_text for w in words):
+                return None
+            values.append(None)
+            continue
+        if risky and any(j < idx and any(w in low for w in words) for j, low in risky.items()):
+            return None
+        value = rests[idx].strip()
+        if not value:
+            return None  # 'Planta:' sin valor: el genérico sigue buscando en las líneas de abajo
+        values.append(value_of(value))
+
+    event_text = text
+    if event_line is not None and not any(EVENT_WORD in lower_for_prefilter(lines[j]) for j in range(event_line)):
+        if EVENT_TIME_RE.search(lines[event_line]):
+            event_text = lines[event_line]
+
+    return tuple(values), event_text
+
+
+def learn_plan(text: str, lines, labels, rests, positions):
+    """
+    Plan para esta plantilla, o None si el parser genérico no se puede reproducir
+    con uno (valor en la línea siguiente, etiqueta después de otro ':', etc).
+    El plan guarda posiciones en el esqueleto (ver split_labels), no números de línea.
+    """
+    low_text = lower_for_prefilter(text)
+    key_of_line = {j: k for k, j in enumerate(positions)}
+    field_keys = []
+    for regex, words, _ in FIELDS:
+        idx = next((j for j, line in enumerate(lines) if regex.search(line.strip())), None)
+        if idx is None:
+            if any(w in low_text for w in words):
+                return None  # búsqueda sobre el texto completo: queda para el genérico
+            field_keys.append(ABSENT)
+            continue
+        k = key_of_line.get(idx)
+        if k is None or not regex.search(labels[k] + ":x"):
+            return None
+        if any(regex.search(label + ":x") for label in labels[:k]):
+            # la misma etiqueta más arriba, vacía en este correo: en otro con la misma
+            # huella puede traer valor y el genérico se quedaría con esa
+            return None
+        field_keys.append(k)
+
+    event_key = None
+    m_text = EVENT_TIME_RE.search(text)
+    if m_text:
+        for j, line in enumerate(lines):
+            if EVENT_WORD in lower_for_prefilter(line):
+                m = EVENT_TIME_RE.search(line)
+                if m and m.groups() == m_text.groups():
+                    event_key = key_of_line.get(j)
+                break
+
+    plan = (tuple(field_keys), event_key)
+    result = apply_plan(plan, text, lines, rests, positions)
+    if result is None or result[0] != extract_fields(text):
+        return None
+    return plan
+
+
+def valid_plan(plan, labels) -> bool:
+    """
+    Plan leído del archivo: forma esperada y posiciones dentro del esqueleto.
+    """
+    field_keys, event_key = plan
+    n = len(labels)
+    if len(field_keys) != len(FIELDS) or not all(isinstance(k, int) and ABSENT <= k < n for k in field_keys):
+        return False
+    return event_key is None or (isinstance(event_key, int) and 0 <= event_key < n)
+
+
+class TemplateRegistry:
+    """
+    Huella -> plan de extracción (None = plantilla conocida sin plan: parser genérico).
+    Seguro entre hilos. Como mucho 'max_templates' huellas: lleno el registro, las huellas
+    nuevas van directo al parser genérico (sin intentar aprender en cada correo).
+    """
+
+    def __init__(self, max_templates: int = 256):
+        self.max_templates = max_templates
+        self.lock = threading.Lock()
+        self.plans = {}
+        self.saved = 0  # huellas ya en el archivo (ver save)
+        self.applied = 0
+        self.generic = 0
+
+    def extract(self, origin: tuple, text: str):
+        """
+        ((planta, área, nombre_operador, id_operador), texto para Fecha/Hora).
+        'origin' = message_origin(From, Message-ID). Mismo resultado que extract_fields(text)
+        y la búsqueda de Fecha/Hora sobre 'text'.
+        """
+        if text:
+            lines = text.splitlines()
+            labels, rests, positions = split_labels(lines)
+            key = (origin, labels)
+            plan = self.plans.get(key, _UNKNOWN)
+            if plan is _UNKNOWN:
+                if len(self.plans) >= self.max_templates:
+                    plan = None
+                else:
+                    plan = learn_plan(text, lines, labels, rests, positions)
+                    with self.lock:
+                        if key not in self.plans and len(self.plans) < self.max_templates:
+                            self.plans[key] = plan
+            if plan is not None:
+                result = apply_plan(plan, text, lines, rests, positions)
+                if result is not None:
+                    with self.lock:
+                        self.applied += 1
+                    return result
+        with self.lock:
+            self.generic += 1
+        return extract_fields(text), text
+
+    def load(self, path: str) -> int:
+        """
+        Planes guardados por una corrida anterior. Archivo ausente, roto o de otro
+        TEMPLATES_FORMAT => se empieza vacío. Devuelve cuántas huellas se cargaron.
+        """
+        if not os.path.exists(path):
+            return 0
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("format") != TEMPLATES_FORMAT:
+                return 0
+            loaded = {}
+            for (sender, domain), labels, plan in data["templates"]:
+                labels = tuple(labels)
+                if plan is not None:
+                    plan = (tuple(plan[0]), plan[1])
+                    if not valid_plan(plan, labels):
+                        continue
+                loaded[((sender, domain), labels)] = plan
+        except Exception:
+            return 0
+        with self.lock:
+            for key, plan in loaded.items():
+                if len(self.plans) >= self.max_templates:
+                    break
+                self.plans.setdefault(key, plan)
+            self.saved = len(self.plans)
+            return self.saved
+
+    def save(self, path: str) -> bool:
+        """
+        Guarda los planes si hay huellas nuevas desde el último load / save. Escritura
+        atómica (tmp + rename): el listener y el backfill comparten el archivo.
+        """
+        with self.lock:
+            if len(self.plans) == self.saved:
+                return False
+            entries = [
+                [list(origin), list(labels), None if plan is None else [list(plan[0]), plan[1]]]
+                for (origin, labels), plan in self.plans.items()
+            ]
+            tmp = path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"format": TEMPLATES_FORMAT, "templates": entries}, f, ensure_ascii=False, indent=2)
+            os.replace(tmp, path)
+            self.saved = len(self.plans)
+            return True
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.applied + self.generic
+            return {
+                "templates": len(self.plans),
+                "withPlan": sum(1 for p in self.plans.values() if p is not None),
+                "applied": self.applied,
+                "generic": self.generic,
+                "hitRate": self.applied / total if total else 0.0,
+            }
+
+
+def format_template_stats(registry: TemplateRegistry) -> str:
+    if registry is None:
+        return "Plantillas: no activo (ALERT_TEMPLATES=1 para aprender planes de extracción)"
+    s = registry.stats()
+    return (
+        f"Plantillas: {s['templates']} conocidas ({s['withPlan']} con plan) | "
+        f"plan aplicado={s['applied']} ({s['hitRate'] * 100:.1f}%) | parser genérico={s['generic']}"
+    )
@@ -0,0 +1,487 @@
+# bench_imap_standin.py
+#
+# Benchmark de punta a punta contra imap_standin.py (nada sale a Gmail ni a la API real):
+#   1) backfill del mes (gmail_alert_month_backfill.main) sobre el buzón sintético -> correos/s
+#   2) listener: N polls con check_mail_once, agregando K alarmas nuevas antes de cada uno
+#      -> latencia por poll (p50 / p95 / máx) y correos/s
+#
+# La API se reemplaza por un HTTP local que responde 201 y cuenta los POST.
+# Cada fase corre en un directorio temporal (cache/ limpio).
+#
+#   python3 bench_imap_standin.py --messages 2000 --latency 0.02
+#   python3 bench_imap_standin.py --backfill-mode shards --latency-fetch 0.05
+#   python3 bench_imap_standin.py --skip-backfill --polls 50 --per-poll 3
+#
+# Verificaciones (sin medir, código 1 si fallan):
+#   python3 bench_imap_standin.py --check query       (filtro de servidor vs filtro del cliente)
+#   python3 bench_imap_standin.py --check mailboxes   (dos buzones / empresas sobre la misma cuenta)
+#   python3 bench_imap_standin.py --check async       (--async manda las mismas alertas que el modo normal)
+#   python3 bench_imap_standin.py --check idle        (IDLE del listener: timeout, EXISTS y CONDSTORE)
+#   python3 bench_imap_standin.py --check condstore   (CONDSTORE con y sin ENABLE anunciado)
+#
+# Solo stdlib (más las dependencias de los propios scripts).
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import imap_standin
+
+
+# ---------- API FALSA ----------
+
+class ApiStubHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        with self.server.lock:
+            self.server.posted += 1
+            self.server.last_payload = body
+            self.server.arrivals.append((time.perf_counter(), body))
+        out = json.dumps({"ok": True}).encode()
+        self.send_response(201)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+def start_api_stub(delay: float = 0.0) -> ThreadingHTTPServer:
+    """
+    'delay' = segundos que tarda la API falsa en responder cada POST.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ApiStubHandler)
+    server.daemon_threads = True
+    server.delay = delay
+    server.lock = threading.Lock()
+    server.posted = 0
+    server.last_payload = None
+    server.arrivals = []  # (perf_counter, body) de cada POST
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# ---------- UTILIDADES ----------
+
+@contextlib.contextmanager
+def phase_dir(verbose: bool):
+    """
+    cwd temporal (cache/ propio) + stdout silenciado salvo --verbose.
+    """
+    prev = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="bench_imap_") as tmp:
+        os.chdir(tmp)
+        try:
+            if verbose:
+                yield
+            else:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    yield
+        finally:
+            os.chdir(prev)
+
+
+def percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = min(len(ordered) - 1, max(0, int(round(p / 100.0 * (len(ordered) - 1)))))
+    return ordered[k]
+
+
+def reset_counts(imap_server, api):
+    with imap_server.stats_lock:
+        imap_server.command_counts.clear()
+    with api.lock:
+        api.posted = 0
+        api.arrivals.clear()
+
+
+def format_counts(counts: dict) -> str:
+    return ", ".join(f"{k}={v}" for k, v in sorted(counts.items()))
+
+
+# ---------- FASES ----------
+
+def bench_backfill(imap_server, api, mode: str, verbose: bool):
+    import gmail_alert_month_backfill as backfill
+
+    total = len(imap_server.mailbox.msgs)
+    reset_counts(imap_server, api)
+    argv = sys.argv
+    sys.argv = [backfill.__file__] + ([f"--{mode}"] if mode != "sync" else [])
+    try:
+        with phase_dir(verbose):
+            t0 = time.perf_counter()
+            backfill.main()
+            elapsed = time.perf_counter() - t0
+    finally:
+        sys.argv = argv
+
+    print(f"[backfill {mode}] {total} correos en {elapsed:.2f}s -> {total / elapsed:.1f} correos/s | "
+          f"alertas enviadas: {api.posted} ({api.posted / elapsed:.1f}/s)")
+    print(f"  comandos IMAP: {format_counts(imap_server.command_counts)}")
+
+
+def bench_listener(imap_server, api, polls: int, per_poll: int, verbose: bool, seed: int):
+    import gmail_alert_listener as listener
+
+    mailbox = imap_server.mailbox
+    rnd = random.Random(seed + 2)
+    kinds = [k for k, _ in imap_standin.ALARM_KINDS]
+    weights = [w for _, w in imap_standin.ALARM_KINDS]
+    next_id = 10 ** 6
+
+    latencies = []
+    with phase_dir(verbose):
+        # primer poll: arranque (conexión + lo que haya en la ventana DAYS_BACK), se reporta aparte
+        t0 = time.perf_counter()
+        listener.check_mail_once()
+        warmup = time.perf_counter() - t0
+
+        reset_counts(imap_server, api)
+        for _ in range(polls):
+            for _ in range(per_poll):
+                mailbox.add(imap_standin.make_geomov_message(
+                    next_id, rnd.choices(kinds, weights)[0], datetime.now(timezone.utc), rnd=rnd,
+                ))
+                next_id += 1
+            t0 = time.perf_counter()
+            listener.check_mail_once()
+            latencies.append(time.perf_counter() - t0)
+        listener.IMAP_SESSION.close()
+
+    new_msgs = polls * per_poll
+    busy = sum(latencies)
+    print(f"[listener] arranque (primer poll): {warmup:.2f}s")
+    print(f"[listener] {polls} polls x {per_poll} nuevas | latencia por poll: "
+          f"p50 {statistics.median(latencies) * 1000:.0f} ms, p95 {percentile(latencies, 95) * 1000:.0f} ms, "
+          f"máx {max(latencies) * 1000:.0f} ms | {new_msgs / busy if busy else 0:.1f} correos/s | "
+          f"alertas enviadas: {api.posted}")
+    print(f"  comandos IMAP: {format_counts(imap_server.command_counts)}")
+
+
+# ---------- VERIFICACIONES (--check, salen con código 1 si fallan) ----------
+
+def check_query(args) -> bool:
+    """
+    El filtro de servidor en modo imap (SEARCH OR TEXT con RELEVANT_STEMS) debe devolver todo
+    correo que el filtro anterior del cliente aceptaba (asunto + cuerpo en minúsculas):
+    alarmas GEOMOV, los casos borde / fuzz de bench_parsing y variantes como FRENO o frenazo.
+    """
+    import imaplib
+    from email.header import Header
+    from email.mime.text import MIMEText
+
+    import bench_parsing
+    from alert_keywords import RELEVANT_STEMS
+    from imap_fetch import ServerQuery
+
+    cases = [(subject, body) for subject, body, _, _ in bench_parsing.keyword_corpus(100, args.seed)]
+    cases += [
+        ("Alarma - ACELERACIÓN BRUSCA - MG010", "x"), ("Aviso - FRENO - MG011", ""), ("Aviso", "frenazo en rampa"),
+        ("Re: aviso", "Se detectó una ACELERACIÓN"), ("Reporte", "<p>IMPACTO</p>"), ("Aviso", "sin novedad"),
+    ]
+
+    mailbox = imap_standin.Mailbox()
+    accepted = []
+    for i, (subject, body) in enumerate(cases):
+        subject = subject.encode("utf-8", "replace").decode("utf-8")
+        body = body.encode("utf-8", "replace").decode("utf-8")
+        low = (subject + "\n" + body).lower()
+        accepted.append(any(stem in low for stem in RELEVANT_STEMS))
+        msg = MIMEText(body, "plain", "utf-8")
+        msg["Subject"] = Header(subject, "utf-8")
+        msg["From"] = "Alertas GEOMOV <alertas@geomov.com>"
+        msg["Message-ID"] = f"<{i}.check@bench>"
+        mailbox.add(msg.as_bytes())
+
+    imap_server = imap_standin.start_server(mailbox)
+    try:
+        mail = imaplib.IMAP4("127.0.0.1", imap_server.server_address[1])
+        mail.login("check", "check")
+        mail.select("INBOX")
+        status, data = mail.search(None, *ServerQuery("imap", RELEVANT_STEMS).criteria(mail))
+        mail.logout()
+    finally:
+        imap_server.shutdown()
+    found = {int(x) for x in data[0].split()} if status == "OK" else set()
+
+    missed = [cases[i] for i, ok in enumerate(accepted) if ok and i + 1 not in found]
+    print(f"[check query] {len(cases)} correos | aceptados por el cliente: {sum(accepted)} | "
+          f"devueltos por SEARCH: {len(found)} | perdidos: {len(missed)}")
+    for subject, body in missed[:10]:
+        print(f"  perdido: {subject!r} / {body[:60]!r}")
+    return status == "OK" and not missed
+
+
+def check_mailboxes(args) -> bool:
+    """
+    Dos buzones del listener sobre la misma cuenta Gmail (X-GM-EXT-1) que solo difieren en
+    companyId: cada empresa tiene que recibir todas sus alarmas (el dedupe por X-GM-MSGID
+    es por empresa, como la clave de cache). Una segunda pasada sin checkpoint no reenvía nada.
+    """
+    import glob
+    import gmail_alert_listener as listener
+
+    start, end = imap_standin.mailbox_range(1)
+    mailbox = imap_standin.build_synthetic_mailbox(60, start, end, seed=args.seed)
+    imap_server = imap_standin.start_server(mailbox, caps=imap_standin.DEFAULT_CAPS + " X-GM-EXT-1")
+    api = start_api_stub()
+
+    def posted_by_company() -> dict:
+        counts = {}
+        with api.lock:
+            for _, body in api.arrivals:
+                company = json.loads(body)["companyId"]
+                counts[company] = counts.get(company, 0) + 1
+            api.arrivals.clear()
+        return counts
+
+    base = {"user": "alertas@gmail.com", "password": "x", "host": "127.0.0.1",
+            "port": imap_server.server_address[1], "ssl": False,
+            "apiBase": f"http://127.0.0.1:{api.server_address[1]}"}
+    try:
+        with phase_dir(args.verbose):
+            with open("mailboxes.json", "w", encoding="utf-8") as f:
+                json.dump([{**base, "name": "empresa1", "companyId": 1},
+                           {**base, "name": "empresa2", "companyId": 2}], f)
+            mailboxes = listener.load_mailboxes_config("mailboxes.json")
+            for mbox in mailboxes:
+                listener.check_mailbox(mbox)
+            first = posted_by_company()
+
+            # sin checkpoint UID: todo vuelve a ser candidato y lo tiene que frenar el dedupe
+            for fp in glob.glob(os.path.join(listener.CACHE_DIR, "listener_uid_state*.json")):
+                os.remove(fp)
+            for mbox in mailboxes:
+                mbox.session.close()
+                listener.check_mailbox(mbox)
+            second = posted_by_company()
+            gmid_maps = glob.glob(os.path.join(listener.CACHE_DIR, "alerts_gmid_*.json"))
+            for mbox in mailboxes:
+                mbox.session.close()
+    finally:
+        imap_server.shutdown()
+        api.shutdown()
+
+    ok = first.get(1, 0) > 0 and first.get(1) == first.get(2) and not second and bool(gmid_maps)
+    print(f"[check mailboxes] {len(mailbox.msgs)} correos | 1ra pasada por companyId: {first} | "
+          f"2da pasada (sin checkpoint): {second or 'nada'} | mapa X-GM-MSGID: {'sí' if gmid_maps else 'no'}")
+    return ok
+
+
+def check_async(args) -> bool:
+    """
+    El backfill con --async tiene que mandar exactamente las mismas alertas que el modo normal
+    (sin y con X-GM-EXT-1), y re-ejecutado sobre su propio cache no reenvía nada.
+    FETCH_MODE / spool se toman del entorno (ALERT_FETCH_MODE=full, ALERT_SPOOL=1).
+    """
+    start, end = imap_standin.mailbox_range(args.days)
+    mailbox = imap_standin.build_synthetic_mailbox(min(args.messages, 300), start, end, args.html_ratio,
+                                                   args.attach_ratio, args.attach_bytes, args.seed)
+    imap_server = imap_standin.start_server(mailbox)
+    api = start_api_stub()
+    os.environ.update({
+        "ALERT_IMAP_HOST": "127.0.0.1",
+        "ALERT_IMAP_PORT": str(imap_server.server_address[1]),
+        "ALERT_IMAP_SSL": "0",
+        "ALERT_API_BASE": f"http://127.0.0.1:{api.server_address[1]}",
+        "ALERT_YEAR": str(end.year),
+        "ALERT_MONTH": str(end.month),
+        "GMAIL_USER": "check@example.com",
+        "GMAIL_PASS": "check",
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import gmail_alert_month_backfill as backfill
+
+    def run(modes) -> list:
+        # cada corrida con su cache/ limpio; devuelve los payloads de cada pasada
+        posted = []
+        argv = sys.argv
+        try:
+            with phase_dir(args.verbose):
+                for mode in modes:
+                    reset_counts(imap_server, api)
+                    sys.argv = [backfill.__file__] + ([f"--{mode}"] if mode != "sync" else [])
+                    backfill.main()
+                    with api.lock:
+                        posted.append(sorted(body for _, body in api.arrivals))
+        finally:
+            sys.argv = argv
+        return posted
+
+    ok = True
+    try:
+        for caps in (imap_standin.DEFAULT_CAPS, imap_standin.DEFAULT_CAPS + " X-GM-EXT-1"):
+            imap_server.caps = caps
+            sync_posted, = run(["sync"])
+            async_posted, again = run(["async", "async"])
+            same = bool(sync_posted) and sync_posted == async_posted and not again
+            ok = ok and same
+            print(f"[check async] caps: {caps} | alertas sync={len(sync_posted)} async={len(async_posted)} | "
+                  f"iguales: {'sí' if sync_posted == async_posted else 'NO'} | 2da pasada async: {len(again)}")
+    finally:
+        imap_server.shutdown()
+        api.shutdown()
+    return ok
+
+
+def check_idle(args) -> bool:
+    """
+    idle_wait del listener (con COMPRESS): el timeout devuelve False y la sesión sigue usable,
+    un EXISTS despierta enseguida y, sin cambios, el ciclo siguiente lo salta CONDSTORE.
+    """
+    import imaplib
+    import gmail_alert_listener as listener
+
+    start, end = imap_standin.mailbox_range(1)
+    mailbox = imap_standin.build_synthetic_mailbox(5, start, end, seed=args.seed)
+    imap_server = imap_standin.start_server(mailbox)
+    api = start_api_stub()
+    mbox = listener.Mailbox(host="127.0.0.1", port=imap_server.server_address[1], ssl=False,
+                            api_base=f"http://127.0.0.1:{api.server_address[1]}")
+    out = io.StringIO()
+    try:
+        with phase_dir(args.verbose), contextlib.redirect_stdout(out):
+            mail = mbox.session.get()
+            listener.sync_session(mbox.session, mail, mbox)
+            idle_timeout = listener.idle_wait(mail, 1)
+            usable = mail.noop()[0] == "OK"
+            threading.Timer(0.3, lambda: mailbox.add(imap_standin.make_geomov_message(
+                10 ** 6, "CHECKLIST", datetime.now(timezone.utc)))).start()
+            t0 = time.perf_counter()
+            woke = listener.idle_wait(mail, 30)
+            wake_seconds = time.perf_counter() - t0
+            listener.sync_session(mbox.session, mail, mbox)
+            listener.sync_session(mbox.session, mail, mbox)
+            mbox.session.close()
+    except imaplib.IMAP4.error as e:
+        print(f"[check idle] error IMAP: {e}")
+        return False
+    finally:
+        imap_server.shutdown()
+        api.shutdown()
+
+    skipped = "CONDSTORE: sin correo nuevo" in out.getvalue()
+    ok = idle_timeout is False and usable and woke and wake_seconds < 5 and skipped
+    print(f"[check idle] timeout -> {idle_timeout} (sesión usable: {'sí' if usable else 'NO'}) | "
+          f"EXISTS -> {woke} en {wake_seconds:.1f}s | ciclo sin cambios saltado por CONDSTORE: {'sí' if skipped else 'NO'}")
+    return ok
+
+
+def check_condstore(args) -> bool:
+    """
+    CONDSTORE del listener con y sin ENABLE anunciado (RFC 7162: SELECT ... (CONDSTORE)):
+    el SELECT trae HIGHESTMODSEQ y un ciclo sin cambios lo salta CONDSTORE.
+    """
+    import gmail_alert_listener as listener
+
+    start, end = imap_standin.mailbox_range(1)
+    mailbox = imap_standin.build_synthetic_mailbox(5, start, end, seed=args.seed)
+    api = start_api_stub()
+    ok = True
+    for caps in (imap_standin.DEFAULT_CAPS, imap_standin.DEFAULT_CAPS.replace(" ENABLE", "")):
+        imap_server = imap_standin.start_server(mailbox, caps=caps)
+        mbox = listener.Mailbox(host="127.0.0.1", port=imap_server.server_address[1], ssl=False,
+                                api_base=f"http://127.0.0.1:{api.server_address[1]}")
+        out = io.StringIO()
+        try:
+            with phase_dir(args.verbose), contextlib.redirect_stdout(out):
+                mail = mbox.session.get()
+                for _ in range(2):
+                    listener.sync_session(mbox.session, mail, mbox)
+                modseq = mbox.session.highest_modseq
+                mbox.session.close()
+        finally:
+            imap_server.shutdown()
+        skipped = "CONDSTORE: sin correo nuevo" in out.getvalue()
+        ok = ok and modseq is not None and skipped
+        print(f"[check condstore] caps: {caps} | HIGHESTMODSEQ del SELECT: {modseq} | "
+              f"ciclo sin cambios saltado: {'sí' if skipped else 'NO'}")
+    api.shutdown()
+    return ok
+
+
+CHECKS = {
+    "query": check_query,
+    "mailboxes": check_mailboxes,
+    "async": check_async,
+    "idle": check_idle,
+    "condstore": check_condstore,
+}
+
+
+# ---------- MAIN ----------
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de backfill / listener contra imap_standin")
+    imap_standin.add_server_args(parser)
+    parser.add_argument("--backfill-mode", choices=("sync", "async", "shards"), default="sync")
+    parser.add_argument("--polls", type=int, default=20, help="polls del listener a medir")
+    parser.add_argument("--per-poll", type=int, default=2, help="alarmas nuevas antes de cada poll")
+    parser.add_argument("--skip-backfill", action="store_true")
+    parser.add_argument("--skip-listener", action="store_true")
+    parser.add_argument("--verbose", action="store_true", help="mostrar la salida de los scripts")
+    parser.add_argument("--check", choices=sorted(CHECKS), action="append",
+                        help="solo verificar (sin medir); sale con código 1 si falla")
+    args = parser.parse_args()
+
+    if args.check:
+        failed = [name for name in args.check if not CHECKS[name](args)]
+        if failed:
+            print(f"FALLA: {', '.join(failed)}")
+            sys.exit(1)
+        return
+
+    start, end = imap_standin.mailbox_range(args.days)
+    t0 = time.perf_counter()
+    mailbox = imap_standin.build_synthetic_mailbox(args.messages, start, end, args.html_ratio,
+                                                   args.attach_ratio, args.attach_bytes, args.seed)
+    print(f"Buzón sintético: {args.messages} correos ({start:%Y-%m-%d} -> {end:%Y-%m-%d %H:%M} Lima) "
+          f"generado en {time.perf_counter() - t0:.1f}s")
+
+    imap_server = imap_standin.start_server(mailbox, caps=args.caps, latency=imap_standin.latency_from_args(args))
+    api = start_api_stub()
+    print(f"Latencia inyectada: {imap_server.latency} | caps: {args.caps}")
+
+    # los scripts leen la configuración al importarse
+    os.environ.update({
+        "ALERT_IMAP_HOST": "127.0.0.1",
+        "ALERT_IMAP_PORT": str(imap_server.server_address[1]),
+        "ALERT_IMAP_SSL": "0",
+        "ALERT_API_BASE": f"http://127.0.0.1:{api.server_address[1]}",
+        "ALERT_YEAR": str(end.year),
+        "ALERT_MONTH": str(end.month),
+        "GMAIL_USER": "bench@example.com",
+        "GMAIL_PASS": "bench",
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    if not args.skip_backfill:
+        bench_backfill(imap_server, api, args.backfill_mode, args.verbose)
+    if not args.skip_listener:
+        bench_listener(imap_server, api, args.polls, args.per_poll, args.verbose, args.seed)
+
+    imap_server.shutdown()
+    api.shutdown()
+
+
+if __name__ == "__main__":
+    main()
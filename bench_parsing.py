@@ -0,0 +1,783 @@
+# bench_parsing.py
+#
+# Benchmark del parseo de correos (CPU pura, sin IMAP ni API):
+# compara las implementaciones actuales con las anteriores (copiadas abajo tal cual,
+# sección REFERENCIA) sobre un corpus sintético con forma de alarmas GEOMOV reales,
+# y verifica que den EXACTAMENTE el mismo resultado antes de medir.
+#
+#   python3 bench_parsing.py                          (todas las fases)
+#   python3 bench_parsing.py --only mime --messages 300 --attach-kb 512
+#
+# Fases:
+#   mime   -> parse + extract_body_text (mime_body.py) vs message_from_bytes + dos walk()
+#   fields -> extract_fields (alert_fields.py) vs parse_plant + parse_area + parse_operator
+#   html   -> body_to_text (html_text.py) vs looks_like_html + html_to_text de siete pasadas
+#   keywords -> KeywordScan (alert_keywords.py) vs filtro + canonical_alert_type + guess_severity
+#   templates -> TemplateRegistry (alert_templates.py) vs extract_fields + Fecha/Hora sobre todo el cuerpo
+#
+# Sale con código 1 si alguna implementación nueva difiere de la anterior.
+# Solo stdlib.
+
+import argparse
+import email
+import html as html_lib
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from email.mime.application import MIMEApplication
+from email.mime.image import MIMEImage
+from email.mime.message import MIMEMessage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import alert_fields
+import alert_keywords
+import alert_templates
+import html_text
+import imap_standin
+import mime_body
+
+
+# ---------- REFERENCIA (implementación anterior) ----------
+
+def legacy_extract_body_text(msg):
+    if msg.is_multipart():
+        for part in msg.walk():
+            content_type = part.get_content_type()
+            content_disp = str(part.get("Content-Disposition", ""))
+            if content_type == "text/plain" and "attachment" not in content_disp:
+                try:
+                    return part.get_payload(decode=True).decode(
+                        part.get_content_charset() or "utf-8",
+                        errors="ignore",
+                    )
+                except Exception:
+                    pass
+
+        for part in msg.walk():
+            content_type = part.get_content_type()
+            content_disp = str(part.get("Content-Disposition", ""))
+            if content_type == "text/html" and "attachment" not in content_disp:
+                try:
+                    return part.get_payload(decode=True).decode(
+                        part.get_content_charset() or "utf-8",
+                        errors="ignore",
+                    )
+                except Exception:
+                    pass
+        return ""
+    else:
+        try:
+            return msg.get_payload(decode=True).decode(
+                msg.get_content_charset() or "utf-8",
+                errors="ignore",
+            )
+        except Exception:
+            return ""
+
+
+def legacy_looks_like_html(s: str) -> bool:
+    if not s:
+        return False
+    low = s.lower()
+    return "<html" in low or "<body" in low or "<br" in low or "</div" in low or "<p" in low
+
+
+def legacy_html_to_text(s: str) -> str:
+    if not s:
+        return ""
+
+    s = re.sub(r"(?i)<br\s*/?>", "\n", s)
+    s = re.sub(r"(?i)</p\s*>", "\n", s)
+    s = re.sub(r"(?i)</div\s*>", "\n", s)
+
+    s = re.sub(r"<[^>]+>", " ", s)
+    s = html_lib.unescape(s)
+
+    s = s.replace("\xa0", " ")
+    s = re.sub(r"[ \t]+", " ", s)
+    s = re.sub(r"\n\s*\n+", "\n", s)
+
+    return s.strip()
+
+
+def legacy_parse_plant(body_text: str):
+    if not body_text:
+        return None
+
+    for line in body_text.splitlines():
+        line_clean = line.strip()
+        m = re.search(r"(Planta|Sede)\s*:\s*(.+)", line_clean, re.IGNORECASE)
+        if m:
+            val = m.group(2).strip()
+            val = re.split(r"\s{2,}|\t|\|", val)[0].strip()
+            return val or None
+
+    m2 = re.search(r"(Planta|Sede)\s*:\s*([^\n\r]+)", body_text, re.IGNORECASE)
+    if m2:
+        val = m2.group(2).strip()
+        val = re.split(r"\s{2,}|\t|\|", val)[0].strip()
+        return val or None
+
+    return None
+
+
+def legacy_parse_area(body_text: str):
+    if not body_text:
+        return None
+
+    for line in body_text.splitlines():
+        line_clean = line.strip()
+        if not line_clean:
+            continue
+
+        m = re.search(
+            r"(?:\bÁrea\b|\bArea\b|\bZona\b|\bUbicación\b|\bUbicacion\b|\bLugar\b)\s*:\s*(.+)",
+            line_clean,
+            re.IGNORECASE,
+        )
+        if m:
+            val = m.group(1).strip()
+            val = re.split(r"\s{2,}|\t|\|", val)[0].strip()
+            return val or None
+
+    m2 = re.search(
+        r"(?:\bÁrea\b|\bArea\b|\bZona\b|\bUbicación\b|\bUbicacion\b|\bLugar\b)\s*:\s*([^\n\r]+)",
+        body_text,
+        re.IGNORECASE,
+    )
+    if m2:
+        val = m2.group(1).strip()
+        val = re.split(r"\s{2,}|\t|\|", val)[0].strip()
+        return val or None
+
+    return None
+
+
+def legacy_parse_operator(body_text: str):
+    operator_name = None
+    operator_id = None
+
+    for line in body_text.splitlines():
+        line_clean = line.strip()
+
+        m_name = re.search(r"Operador\s*:\s*(.+)", line_clean, re.IGNORECASE)
+        if m_name and not operator_name:
+            operator_name = m_name.group(1).strip()
+
+        m_id = re.search(r"(ID\s*Operador|DNI)\s*:\s*(.+)", line_clean, re.IGNORECASE)
+        if m_id and not operator_id:
+            operator_id = m_id.group(2).strip()
+
+    return operator_name, operator_id
+
+
+def legacy_parse_text(body_text: str) -> str:
+    return legacy_html_to_text(body_text) if legacy_looks_like_html(body_text) else (body_text or "")
+
+
+def legacy_normalize_alert_text(s: str) -> str:
+    if not s:
+        return ""
+    x = s.strip().upper()
+    x = (x.replace("Ó", "O")
+           .replace("Á", "A")
+           .replace("É", "E")
+           .replace("Í", "I")
+           .replace("Ú", "U"))
+    return x
+
+
+def legacy_canonical_alert_type(s: str) -> str:
+    x = legacy_normalize_alert_text(s)
+    if "IMPACTO" in x:
+        return "IMPACTO"
+    if "FREN" in x:
+        return "FRENADA"
+    if "ACELER" in x:
+        return "ACELERACION"
+    return ""
+
+
+def legacy_guess_allowed_type(subject: str, body_text: str) -> str:
+    t = legacy_canonical_alert_type(subject or "")
+    if t:
+        return t
+    return legacy_canonical_alert_type(body_text or "")
+
+
+def legacy_guess_severity(alert_type: str, body_text: str) -> str:
+    t = legacy_normalize_alert_text(alert_type or "")
+    text = (body_text or "").lower()
+
+    if "sin condiciones" in text or "bloquea" in text:
+        return "BLOQUEA_OPERACION"
+    if "IMPACTO" in t:
+        return "CRITICAL"
+    if "FREN" in t or "ACELER" in t:
+        return "WARNING"
+    return "INFO"
+
+
+def legacy_classify(item):
+    """
+    Decisiones de process_message + build_alert_payload: (relevante, checklist, tipo, severidad).
+    """
+    subject, body_text, parse_text, alert_type_raw = item
+    text_to_search = (subject or "") + "\n" + (body_text or "")
+    low = text_to_search.lower()
+    if ("alarma" not in low) and ("checklist" not in low) and ("impacto" not in low) and ("fren" not in low) and ("aceler" not in low):
+        return False, None, None, None
+    if "checklist" in low:
+        return True, True, None, None
+    alert_type = legacy_canonical_alert_type(alert_type_raw or "")
+    if not alert_type:
+        alert_type = legacy_guess_allowed_type(subject, parse_text) or "DESCONOCIDO"
+    return True, False, alert_type, legacy_guess_severity(alert_type, parse_text)
+
+
+# ---------- CORPUS ----------
+
+def finish(part, subject: str, i: int) -> bytes:
+    part["Subject"] = subject
+    part["From"] = "Alertas GEOMOV <alertas@geomov.com>"
+    part["Date"] = "Mon, 06 Oct 2025 10:15:00 -0500"
+    part["Message-ID"] = f"<{i}.bench.JavaMail.geomov@dbserver02>"
+    return part.as_bytes()
+
+
+def geomov_text(rnd: random.Random, html: bool = False) -> str:
+    lines = [
+        f"Alarma Fecha: {rnd.randint(1, 28):02d}-Oct-2025 Hora: {rnd.randint(0, 23):02d}:{rnd.randint(0, 59):02d}",
+        f"Planta: {rnd.choice(imap_standin.PLANTS)}",
+        f"Área: {rnd.choice(imap_standin.AREAS)}",
+        f"Operador: {rnd.choice(imap_standin.OPERATORS)}",
+        f"DNI: {rnd.randint(40000000, 79999999)}",
+    ]
+    if html:
+        rows = "".join(f"<tr><td>{line}</td></tr>" for line in lines)
+        return f"<html><body><div><p><b>Reporte de alarma</b></p><table>{rows}</table></div></body></html>"
+    return "\n".join(lines)
+
+
+def edge_case_messages(rnd: random.Random):
+    """
+    Estructuras raras que la versión anterior resuelve de una forma concreta;
+    la nueva tiene que elegir la misma parte.
+    """
+    out = []
+
+    # alternative con text/plain latin-1 en quoted-printable + html
+    alt = MIMEMultipart("alternative")
+    alt.attach(MIMEText(geomov_text(rnd), "plain", "iso-8859-1"))
+    alt.attach(MIMEText(geomov_text(rnd, html=True), "html", "utf-8"))
+    out.append(alt)
+
+    # html en el cuerpo + text/plain adjunto (debe ganar el html)
+    mixed = MIMEMultipart("mixed")
+    mixed.attach(MIMEText(geomov_text(rnd, html=True), "html", "utf-8"))
+    att = MIMEText("log adjunto\n", "plain", "utf-8")
+    att["Content-Disposition"] = 'attachment; filename="log.txt"'
+    mixed.attach(att)
+    out.append(mixed)
+
+    # reenvío: html afuera, message/rfc822 con text/plain adentro (gana el plain interno)
+    fwd = MIMEMultipart("mixed")
+    fwd.attach(MIMEText("<p>Reenvío</p>", "html", "utf-8"))
+    inner = MIMEMultipart("alternative")
+    inner.attach(MIMEText(geomov_text(rnd), "plain", "utf-8"))
+    inner.attach(MIMEText(geomov_text(rnd, html=True), "html", "utf-8"))
+    inner["Subject"] = "Alarma - IMPACTO - MG001 (111FG11-1)"
+    fwd.attach(MIMEMessage(inner))
+    out.append(fwd)
+
+    # reenvío como cuerpo entero: message/rfc822 en el nivel superior (se busca adentro)
+    top = MIMEMultipart("alternative")
+    top.attach(MIMEText(geomov_text(rnd), "plain", "utf-8"))
+    top.attach(MIMEText(geomov_text(rnd, html=True), "html", "utf-8"))
+    top["Subject"] = "Alarma - FRENADO BRUSCO - MG002 (222FG22-2)"
+    out.append(MIMEMessage(top))
+    out.append(MIMEMessage(MIMEText(geomov_text(rnd), "plain", "iso-8859-1")))
+
+    # charset desconocido en el plain -> la anterior cae al html
+    bad = MIMEMultipart("alternative")
+    plain = MIMEText(geomov_text(rnd), "plain", "utf-8")
+    plain.set_param("charset", "x-desconocido")
+    bad.attach(plain)
+    bad.attach(MIMEText(geomov_text(rnd, html=True), "html", "utf-8"))
+    out.append(bad)
+
+    # multipart sin boundary (roto) y multipart vacío
+    broken = email.message_from_string("Content-Type: multipart/mixed\n\nsin partes\n")
+    out.append(broken)
+    out.append(MIMEMultipart("mixed"))
+
+    # solo adjuntos
+    only_att = MIMEMultipart("mixed")
+    only_att.attach(MIMEApplication(rnd.randbytes(2048), Name="a.pdf"))
+    out.append(only_att)
+
+    # text/plain en base64, sin charset
+    b64 = MIMEText(geomov_text(rnd), "plain", "utf-8")
+    del b64["Content-Type"]
+    b64["Content-Type"] = "text/plain"
+    out.append(b64)
+
+    raws = [finish(m, "Alarma - IMPACTO - MG069 (308FG25-3)", 900000 + n) for n, m in enumerate(out)]
+    # los servidores IMAP entregan CRLF; los exports mbox suelen venir con LF
+    raws += [r.replace(b"\n", b"\r\n") for r in raws]
+    # cierre de boundary ausente
+    raws.append(raws[0].rsplit(b"--", 2)[0])
+    return raws
+
+
+def large_alarm_message(i: int, rnd: random.Random, attach_kb: int) -> bytes:
+    """
+    Alarma 'pesada': mixed[ alternative[plain, html], logo inline, PDF del reporte, foto ].
+    """
+    html_first = rnd.random() < 0.3
+    outer = MIMEMultipart("mixed")
+    alt = MIMEMultipart("alternative")
+    if not html_first:
+        alt.attach(MIMEText(geomov_text(rnd), "plain", "utf-8"))
+    alt.attach(MIMEText(geomov_text(rnd, html=True), "html", "utf-8"))
+    outer.attach(alt)
+    logo = MIMEImage(b"\x89PNG\r\n\x1a\n" + rnd.randbytes(8 * 1024), "png")
+    logo["Content-Disposition"] = "inline"
+    outer.attach(logo)
+    pdf = MIMEApplication(b"%PDF-1.4\n" + rnd.randbytes(attach_kb * 1024), Name="reporte.pdf")
+    pdf["Content-Disposition"] = 'attachment; filename="reporte.pdf"'
+    outer.attach(pdf)
+    photo = MIMEImage(b"\xff\xd8\xff" + rnd.randbytes(attach_kb * 512), "jpeg")
+    photo["Content-Disposition"] = 'attachment; filename="camara.jpg"'
+    outer.attach(photo)
+    raw = finish(outer, f"Alarma - IMPACTO - MG{i % 150:03d} (308FG25-3)", i)
+    return raw.replace(b"\n", b"\r\n")
+
+
+def build_corpus(messages: int, attach_kb: int, seed: int):
+    rnd = random.Random(seed)
+    start = datetime(2025, 10, 1, tzinfo=timezone.utc)
+    corpus = []
+    for i in range(messages):
+        kind = rnd.random()
+        if kind < 0.5:
+            corpus.append(large_alarm_message(i, rnd, attach_kb))
+        else:
+            corpus.append(imap_standin.make_geomov_message(
+                i, "IMPACTO", start + timedelta(minutes=i), html=kind < 0.7,
+                attach_bytes=rnd.choice((0, 4096)), rnd=rnd,
+            ))
+    return corpus, edge_case_messages(rnd)
+
+
+FIELD_VARIANTS = [
+    # (plantilla de línea de planta, de área, de operador, de id)
+    ("Planta: {plant}", "Área: {area}", "Operador: {op}", "DNI: {dni}"),
+    ("Sede: {plant}  Turno: B", "Zona: {area} | Sector 4", "Operador : {op}", "ID Operador: {dni}"),
+    ("PLANTA:\t{plant}", "UBICACIÓN: {area}", "Nombre Operador: {op}", "Dni:{dni}"),
+    ("Planta:", "Lugar:", "", ""),
+    ("Subplanta: {plant}", "Areas: {area}", "ID Operador: {dni}", "Operador: {op}"),
+    ("", "", "", ""),
+]
+
+
+FIELD_EDGE_CASES = [
+    "Planta\n: Norte\nZona\n:\nRampa 3",
+    "Planta:\x0bNorte\x0cÁrea:\x1cPatio",
+    "ſede: Callao\nUBİCACIÓN: Muelle\nDNı: 123\nOPERADOR: ANA",
+    "Planta: | Sur\nPlanta: Norte\nÁrea:   \t x",
+    "ID Operador: 5\nOperador: Luis\nDNI: 7",
+    "Sede: A  Planta: B\nLugar: Patio | Zona: Rampa",
+    "Subarea: x\nÁreas: y\nel área: z",
+    "sin etiquetas", "", ":\n:\n",
+]
+
+
+def body_corpus(messages: int, seed: int):
+    """
+    Cuerpos con forma real (texto plano, HTML de tabla, variantes de etiquetas, pie largo),
+    ya convertidos a texto como en build_alert_payload.
+    """
+    rnd = random.Random(seed)
+    start = datetime(2025, 10, 1, tzinfo=timezone.utc)
+    bodies = []
+    for i in range(messages):
+        if rnd.random() < 0.6:
+            raw = imap_standin.make_geomov_message(i, rnd.choice(("IMPACTO", "SIN CONDICIONES", "FRENADA BRUSCA")),
+                                                   start + timedelta(minutes=i), html=rnd.random() < 0.5, rnd=rnd)
+            body = mime_body.extract_body_text(mime_body.parse_message_lazy(raw))
+        else:
+            plant_t, area_t, op_t, id_t = rnd.choice(FIELD_VARIANTS)
+            values = {
+                "plant": rnd.choice(imap_standin.PLANTS), "area": rnd.choice(imap_standin.AREAS),
+                "op": rnd.choice(imap_standin.OPERATORS), "dni": rnd.randint(40000000, 79999999),
+            }
+            lines = [f"Alarma Fecha: {rnd.randint(1, 28):02d}-Oct-2025 Hora: 10:{rnd.randint(0, 59):02d}",
+                     "Vehículo: MG069  Placa: 308FG25-3"]
+            lines += [t.format(**values) for t in (plant_t, area_t, op_t, id_t)]
+            if plant_t == "Planta:":
+                lines.append(values["plant"])  # valor en la línea siguiente
+            lines += ["Este es un mensaje automático del sistema de monitoreo. No responder."] * rnd.randint(1, 30)
+            body = "\r\n".join(lines) if rnd.random() < 0.5 else "\n".join(lines)
+            if rnd.random() < 0.3:
+                body = "<html><body>" + "".join(f"<p>{html_lib.escape(x)}</p>" for x in lines) + "</body></html>"
+        bodies.append(legacy_parse_text(body))
+    return bodies
+
+
+KEYWORD_EDGE_CASES = [
+    # (asunto, cuerpo): mayúsculas raras, tildes, ligaduras, palabras solo en el cuerpo
+    ("Alarma - ÍMPACTO - MG001 (1)", "x"), ("Alarma - ımpacto - MG002", ""), ("Alarma - ﬀRENADA", "Fren"),
+    ("Aviso - MG003", "ACELERACIÓN brusca"), ("Aviso", "İMPACTO"), ("", "SIN CONDICIONES"),
+    ("Alarma - EXCESO VELOCIDAD - MG004", "bloquea la operación"), ("CheckList semanal", "impacto"),
+    ("Reporte", "fren\naceler"), ("Reporte", "sin\ncondiciones"), ("Re: Alarma - IMPACTO", "<p>Bloquea</p>"),
+    ("Alarma - - MG005", "Acelerómetro: ok"), ("Aviso - - -", "alarma"), ("ALARMA", "ſin condiciones"),
+    ("Aviso", "CHEC\u212aLIST diario"), ("Aviso", "checkl\u0130st"), ("Aviso", "İmpacto"), ("Aviso", "x\ud800 fren"),
+    # palabras pegadas que comparten letra (findall no solapa coincidencias)
+    ("Aviso", "alarmaceler"), ("Aviso", "bloqueaceler"), ("Aviso", "bloquealarma"), ("Reporte", "frenimpacto"),
+]
+
+KEYWORD_FUZZ_TOKENS = [
+    "alarma", "ALARMA", "check", "lista", "CHEC\u212aLIST", "list", "impacto", "ÍMPACTO", "İ", "ı", "ſ", "ﬀ",
+    "fren", "FRENADA", "aceler", "ACELERACIÓN", "sin", "SIN", "condiciones", "bloquea", "BLOQUEA", " ", "\n",
+    "-", "Ó", "x", "\ud800", "a", "ALARM", "bloque",
+]
+
+
+def keyword_fuzz_cases(rnd: random.Random, count: int):
+    def text():
+        return "".join(rnd.choice(KEYWORD_FUZZ_TOKENS) for _ in range(rnd.randint(0, 8)))
+    return [(text(), text()) for _ in range(count)]
+
+
+def keyword_corpus(messages: int, seed: int):
+    """
+    (asunto, cuerpo, texto a parsear, tipo del asunto) como llegan a process_message:
+    asuntos GEOMOV, asuntos sin tipo (el tipo sale del cuerpo), avisos irrelevantes.
+    """
+    rnd = random.Random(seed)
+    start = datetime(2025, 10, 1, tzinfo=timezone.utc)
+    kinds = [k for k, _ in imap_standin.ALARM_KINDS]
+    weights = [w for _, w in imap_standin.ALARM_KINDS]
+    items = []
+    for i in range(messages):
+        kind = rnd.choices(kinds, weights)[0]
+        msg = mime_body.parse_message_lazy(
+            imap_standin.make_geomov_message(i, kind, start + timedelta(minutes=i), html=rnd.random() < 0.3, rnd=rnd))
+        subject = str(msg.get("Subject"))
+        body = mime_body.extract_body_text(msg)
+        roll = rnd.random()
+        if roll < 0.15:
+            subject = subject.replace(f" {kind} -", " Evento -")
+        elif roll < 0.25:
+            subject, body = f"Boletín {i}", body.replace("Alarma", "Aviso")
+        items.append((subject, body))
+    out = []
+    for subject, body in items + KEYWORD_EDGE_CASES + keyword_fuzz_cases(rnd, messages * 50):
+        parts = subject.split("-")
+        out.append((subject, body, legacy_parse_text(body), parts[1].strip() if len(parts) >= 3 else ""))
+    return out
+
+
+# mutaciones que rompen (o casi) el plan aprendido de la plantilla GEOMOV
+TEMPLATE_MUTATIONS = [
+    lambda b: b.replace("Placa:", "Planta: Oeste  Placa:"),
+    lambda b: b.replace("Placa:", "Zona:"),
+    lambda b: b.replace("Placa:", "ID Operador:"),
+    lambda b: b.replace("Hora:", "Sede: x Hora:"),
+    lambda b: b.replace("Planta: ", "Planta:", 1).replace("Planta:Planta", "Planta:"),
+    lambda b: b.replace("Área: ", "Área:   \t"),
+    lambda b: b.replace("Operador: ", "Operador: DNI: "),
+    lambda b: b.replace("Vehículo:", "Fecha: 01-Ene-2020 Hora: 00:00 Vehículo:"),
+    lambda b: b.replace("Alarma Fecha:", "Fecha anterior\nAlarma Fecha:"),
+    lambda b: b.replace("Hora: ", "Hora:\n"),
+    lambda b: b.replace("Hora: ", "Hora: x "),
+    lambda b: b.replace("DNI: ", "DNI: | "),
+    lambda b: b.replace("MG", "Lugar: MG"),
+    lambda b: b + "\nPlanta: otra",
+    lambda b: b.replace("Vehículo: ", "Vehículo: ubicación:"),
+    # texto libre con horas, líneas en blanco o de más: fuera de la huella, mismo plan
+    lambda b: b.replace("Vehículo:", "Reportado a las 10:45\n\nVehículo:", 1),
+    lambda b: "\n" + b + "\nNota: revisar a las 08:30\n\n",
+    lambda b: b.replace("\n", "\n\n", 2),
+]
+
+
+def template_corpus(messages: int, seed: int):
+    """
+    (origen, texto a parsear): alarmas GEOMOV (texto y HTML), variantes de etiquetas y
+    mutaciones de la plantilla con la misma huella (valores que imitan etiquetas, etc).
+    """
+    rnd = random.Random(seed)
+    start = datetime(2025, 10, 1, tzinfo=timezone.utc)
+    kinds = [k for k, _ in imap_standin.ALARM_KINDS]
+    weights = [w for _, w in imap_standin.ALARM_KINDS]
+    items = []
+    for i in range(messages):
+        msg = mime_body.parse_message_lazy(imap_standin.make_geomov_message(
+            i, rnd.choices(kinds, weights)[0], start + timedelta(minutes=i), html=rnd.random() < 0.2, rnd=rnd))
+        origin = alert_templates.message_origin(str(msg.get("From")), str(msg.get("Message-ID")))
+        items.append((origin, legacy_parse_text(mime_body.extract_body_text(msg))))
+    origin = items[0][0]
+    plain = next(text for _, text in items if "\nPlanta:" in text)
+    # 'Planta:' vacía más arriba en el correo que se aprende; con valor en el siguiente
+    # (misma huella) el genérico se queda con esa: el plan no se puede guardar
+    checks = [(origin, plain.replace("\nPlanta:", "\nPlanta:\nPlanta:", 1)),
+              (origin, plain.replace("\nPlanta:", "\nPlanta: Sur\nPlanta:", 1))]
+    checks += [(origin, body) for body in body_corpus(messages // 4, seed)]
+    checks += [(origin, text) for text in FIELD_EDGE_CASES]
+    for n in range(messages * 10):
+        body = items[n % messages][1]
+        for _ in range(rnd.randint(1, 3)):
+            body = rnd.choice(TEMPLATE_MUTATIONS)(body)
+        checks.append((origin, body))
+    return items, checks
+
+
+def heavy_html_body(rnd: random.Random, rows: int) -> str:
+    """
+    Reporte HTML 'pesado': CSS en línea, tablas anidadas, entidades, CRLF entre filas.
+    """
+    style = "".join(f"td.c{k}{{font-family:Arial;font-size:12px;color:#333}}\r\n" for k in range(40))
+    cells = []
+    for r in range(rows):
+        cells.append(
+            f'<tr><td class="lbl" style="padding:2px">Planta&nbsp;:</td>'
+            f'<td><span style="color:#c00">{html_lib.escape(rnd.choice(imap_standin.PLANTS))}</span></td></tr>\r\n'
+            f'<tr><td class="lbl">&Aacute;rea:</td><td>{html_lib.escape(rnd.choice(imap_standin.AREAS))}</td></tr>\r\n'
+            f'<tr><td>Operador:</td><td>{html_lib.escape(rnd.choice(imap_standin.OPERATORS))} &amp; turno {r}</td></tr>'
+        )
+    return (
+        f"<!DOCTYPE html><html><head><meta charset=\"utf-8\"><style>{style}</style></head><body>"
+        f"<div><p><b>Reporte de alarma</b><br/>Alarma Fecha: 06-Oct-2025 Hora: 10:15</p>"
+        f"<table cellpadding=\"0\">{''.join(cells)}</table></div><br>\r\n<p>Saludos,<br>Centro de control</p>"
+        f"</body></html>"
+    )
+
+
+HTML_FUZZ_TOKENS = [
+    "<br>", "<BR/>", "<br />", "</p>", "</P >", "</div>", "</dİv>", "</p", "</div", "<br", "<p>", "<div>",
+    "<td>", "</td>", "<", ">", "&nbsp;", "&amp;", "&amp;nbsp;", "&#10;", "&#9;", "&#32;", "&lt;br&gt;",
+    "&aacute", "&", "\n", "\r\n", "\t", " ", "  ", "\xa0", "\x0b", "\x1c", "a", "Planta:",
+]
+
+
+def html_fuzz_cases(rnd: random.Random, count: int):
+    return ["".join(rnd.choice(HTML_FUZZ_TOKENS) for _ in range(rnd.randint(0, 14))) for _ in range(count)]
+
+
+# ---------- MEDICIÓN ----------
+
+def time_per_message(fn, corpus, repeat: int):
+    """
+    Mejor de 'repeat' corridas: (segundos totales, lista de µs por correo).
+    """
+    best_total, best_each = None, None
+    for _ in range(repeat):
+        each = []
+        t_start = time.perf_counter()
+        for item in corpus:
+            t0 = time.perf_counter()
+            fn(item)
+            each.append((time.perf_counter() - t0) * 1e6)
+        total = time.perf_counter() - t_start
+        if best_total is None or total < best_total:
+            best_total, best_each = total, each
+    return best_total, best_each
+
+
+def report(name: str, old, new, count: int, extra: str = ""):
+    old_total, old_each = old
+    new_total, new_each = new
+    speedup = old_total / new_total if new_total else 0.0
+    print(f"[{name}] {count} correos{extra}")
+    print(f"  anterior: {old_total * 1000:8.1f} ms | por correo p50 {statistics.median(old_each):8.1f} µs, "
+          f"máx {max(old_each):9.1f} µs")
+    print(f"  nueva   : {new_total * 1000:8.1f} ms | por correo p50 {statistics.median(new_each):8.1f} µs, "
+          f"máx {max(new_each):9.1f} µs")
+    print(f"  -> {speedup:.1f}x")
+
+
+def compare(name: str, old_fn, new_fn, items) -> int:
+    """
+    Cuenta (e imprime las primeras) diferencias entre anterior y nueva.
+    """
+    diffs = 0
+    for n, item in enumerate(items):
+        a, b = old_fn(item), new_fn(item)
+        if a != b:
+            diffs += 1
+            if diffs <= 3:
+                print(f"  [{name}] DIFERENCIA en #{n}: {a!r:.120} != {b!r:.120}")
+    return diffs
+
+
+# ---------- FASES ----------
+
+def bench_mime(args) -> int:
+    corpus, edge = build_corpus(args.messages, args.attach_kb, args.seed)
+
+    def old(raw):
+        return legacy_extract_body_text(email.message_from_bytes(raw))
+
+    def new(raw):
+        return mime_body.extract_body_text(mime_body.parse_message_lazy(raw))
+
+    def new_full(raw):
+        # mensajes ya parseados completos (build_partial_message, etc.)
+        return mime_body.extract_body_text(email.message_from_bytes(raw))
+
+    diffs = compare("mime", old, new, corpus + edge) + compare("mime/full", old, new_full, corpus + edge)
+    size_mb = sum(len(r) for r in corpus) / 1048576
+    report("mime", time_per_message(old, corpus, args.repeat), time_per_message(new, corpus, args.repeat),
+           len(corpus), f" ({size_mb:.1f} MB, adjuntos ~{args.attach_kb} KB, {len(edge)} casos borde verificados)")
+    return diffs
+
+
+def bench_fields(args) -> int:
+    bodies = body_corpus(args.messages, args.seed)
+
+    def old(text):
+        return (legacy_parse_plant(text), legacy_parse_area(text)) + legacy_parse_operator(text)
+
+    new = alert_fields.extract_fields
+
+    diffs = compare("fields", old, new, bodies + FIELD_EDGE_CASES)
+    avg_lines = sum(len(b.splitlines()) for b in bodies) / max(1, len(bodies))
+    report("fields", time_per_message(old, bodies, args.repeat), time_per_message(new, bodies, args.repeat),
+           len(bodies), f" (cuerpos de ~{avg_lines:.0f} líneas, {len(FIELD_EDGE_CASES)} casos borde verificados)")
+    return diffs
+
+
+def bench_html(args) -> int:
+    rnd = random.Random(args.seed)
+    start = datetime(2025, 10, 1, tzinfo=timezone.utc)
+    bodies = []
+    for i in range(args.messages):
+        if i % 2:
+            bodies.append(heavy_html_body(rnd, rnd.randint(5, 80)))
+            continue
+        raw = imap_standin.make_geomov_message(i, "IMPACTO", start + timedelta(minutes=i), html=i % 4 == 0, rnd=rnd)
+        bodies.append(mime_body.extract_body_text(mime_body.parse_message_lazy(raw)))
+    fuzz = html_fuzz_cases(rnd, args.messages * 50)
+
+    diffs = compare("html", legacy_parse_text, html_text.body_to_text, bodies + fuzz)
+    diffs += compare("html/to_text", legacy_html_to_text, html_text.html_to_text, fuzz)
+    size_kb = sum(len(b) for b in bodies) / 1024
+    report("html", time_per_message(legacy_parse_text, bodies, args.repeat),
+           time_per_message(html_text.body_to_text, bodies, args.repeat), len(bodies),
+           f" ({size_kb:.0f} KB de cuerpos, mitad reportes HTML pesados; {len(fuzz)} casos fuzz verificados)")
+    return diffs
+
+
+def bench_keywords(args) -> int:
+    items = keyword_corpus(args.messages, args.seed)
+
+    def new(item):
+        subject, body_text, parse_text, alert_type_raw = item
+        subject_kw, body_kw = alert_keywords.KeywordScan(subject), alert_keywords.KeywordScan(body_text)
+        if not alert_keywords.is_relevant(subject_kw, body_kw):
+            return False, None, None, None
+        if alert_keywords.is_checklist(subject_kw, body_kw):
+            return True, True, None, None
+        parse_kw = body_kw if parse_text is body_kw.text else alert_keywords.KeywordScan(parse_text)
+        alert_type = alert_keywords.canonical_alert_type(alert_type_raw or "")
+        if not alert_type:
+            alert_type = alert_keywords.guess_allowed_type(subject_kw, parse_kw) or "DESCONOCIDO"
+        return True, False, alert_type, alert_keywords.guess_severity(alert_type, parse_kw)
+
+    diffs = compare("keywords", legacy_classify, new, items)
+    corpus = items[:args.messages]
+    report("keywords", time_per_message(legacy_classify, corpus, args.repeat),
+           time_per_message(new, corpus, args.repeat), len(corpus),
+           f" (filtro + checklist + tipo + severidad, {len(items) - len(corpus)} casos borde / fuzz verificados)")
+    return diffs
+
+
+def bench_templates(args) -> int:
+    items, checks = template_corpus(args.messages, args.seed)
+
+    def old(item):
+        text = item[1]
+        m = alert_fields.EVENT_TIME_RE.search(text)
+        return alert_fields.extract_fields(text), m.groups() if m else None
+
+    def make_new(max_templates: int = 256):
+        registry = alert_templates.TemplateRegistry(max_templates)
+
+        def new(item):
+            fields, event_text = registry.extract(item[0], item[1])
+            m = alert_fields.EVENT_TIME_RE.search(event_text)
+            return fields, m.groups() if m else None
+        return registry, new
+
+    diffs = compare("templates", old, make_new()[1], items + checks)
+    # registro lleno: las plantillas que no entraron van al genérico
+    diffs += compare("templates", old, make_new(1)[1], items + checks)
+    registry, new = make_new()
+    for item in items:
+        new(item)  # aprendizaje fuera de la medición
+
+    # texto libre con horas distintas y líneas en blanco en cada correo: ninguna huella nueva
+    known = registry.stats()["templates"]
+    rnd = random.Random(args.seed)
+    for origin, text in items:
+        new((origin, f"Reportado a las {rnd.randint(0, 23):02d}:{rnd.randint(0, 59):02d}\n\n{text}" + "\n" * rnd.randint(0, 3)))
+    if registry.stats()["templates"] != known:
+        print(f"  [templates] huellas nuevas por texto libre: {known} -> {registry.stats()['templates']}")
+        diffs += 1
+
+    # cache/alert_templates.json: los planes vuelven iguales tras guardar y cargar
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "alert_templates.json")
+        registry.save(path)
+        loaded, new_loaded = make_new()
+        if loaded.load(path) != known or loaded.plans != registry.plans:
+            print(f"  [templates] cache: {len(loaded.plans)} planes cargados de {len(registry.plans)}")
+            diffs += 1
+        diffs += compare("templates/cache", old, new_loaded, items + checks)
+
+    before = registry.stats()
+    timing_new = time_per_message(new, items, args.repeat)
+    s = registry.stats()
+    applied = s["applied"] - before["applied"]
+    report("templates", time_per_message(old, items, args.repeat), timing_new, len(items),
+           f" ({s['templates']} plantillas, plan aplicado en {applied * 100 / max(1, applied + s['generic'] - before['generic']):.0f}%; "
+           f"{len(checks)} casos borde / mutaciones verificados)")
+    return diffs
+
+
+PHASES = {
+    "mime": bench_mime,
+    "fields": bench_fields,
+    "html": bench_html,
+    "keywords": bench_keywords,
+    "templates": bench_templates,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del parseo de correos (anterior vs nueva)")
+    parser.add_argument("--only", choices=sorted(PHASES), action="append", help="fase(s) a correr")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--attach-kb", type=int, default=256, help="tamaño del PDF en las alarmas pesadas")
+    parser.add_argument("--repeat", type=int, default=3, help="corridas por implementación (se toma la mejor)")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    diffs = 0
+    for name in args.only or PHASES:
+        diffs += PHASES[name](args)
+    if diffs:
+        print(f"{diffs} diferencia(s) entre implementaciones")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+# bench_smtp_ingest.py
+#
+# Prueba / benchmark del receptor SMTP/LMTP del listener (smtp_ingest.py):
+# varios clientes smtplib mandan alarmas sintéticas (imap_standin.make_geomov_message)
+# en paralelo y se mide, por correo, el tiempo desde que el cliente empieza a
+# enviar hasta que el POST llega a la API (falsa, local).
+# También se mide cuánto tarda el 250 (cola en disco con fsync).
+#
+#   python3 bench_smtp_ingest.py --messages 200 --clients 4
+#   python3 bench_smtp_ingest.py --lmtp --api-latency 0.05 --workers 8
+#   python3 bench_smtp_ingest.py --messages 100 --clients 2 --rate 10   (sin ráfaga: latencia "real")
+#
+# Al final verifica los límites del receptor (línea demasiado larga, cola muerta).
+# Sale con código 1 si alguna alarma no llegó a la API o falla una verificación.
+# Solo stdlib (más las dependencias del listener).
+
+import argparse
+import json
+import os
+import random
+import re
+import smtplib
+import statistics
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+import imap_standin
+from bench_imap_standin import start_api_stub, phase_dir, percentile
+
+# solo tipos que el listener manda a la API (los demás se cachean y no llegan)
+SENT_KINDS = ["IMPACTO", "FRENADA BRUSCA", "ACELERACION BRUSCA"]
+
+
+def send_all(host: str, port: int, messages, clients: int, lmtp: bool, sent_at: dict, acks: list,
+             rate: float = 0.0):
+    """
+    Reparte 'messages' [(ref, raw)] entre 'clients' conexiones, cada una en su hilo.
+    rate > 0 => cada cliente manda a ese ritmo (correos/s) en vez de en ráfaga.
+    """
+    errors = []
+
+    def client(chunk):
+        try:
+            conn = smtplib.LMTP(host, port) if lmtp else smtplib.SMTP(host, port)
+            try:
+                for ref, raw in chunk:
+                    t0 = time.perf_counter()
+                    sent_at[ref] = t0
+                    conn.sendmail("alertas@geomov.com", ["monitoreo@example.com"], raw)
+                    acks.append(time.perf_counter() - t0)
+                    if rate > 0:
+                        time.sleep(max(0.0, 1.0 / rate - (time.perf_counter() - t0)))
+            finally:
+                conn.quit()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=client, args=(messages[i::clients],)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return errors
+
+
+def check_limits(verbose: bool) -> bool:
+    """
+    Límites del receptor (sin API): una línea sin fin más larga que max_line_bytes da 500
+    y la sesión sigue usable; un correo que siempre falla termina en <cola>/dead/.
+    """
+    import smtp_ingest
+
+    with phase_dir(verbose):
+        calls = []
+
+        def always_fails(raw, ref):
+            calls.append(ref)
+            return None
+
+        server = smtp_ingest.SmtpIngestServer(("127.0.0.1", 0), always_fails, "queue", workers=1,
+                                              retry_seconds=0.01, max_attempts=3, max_line_bytes=1000)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        host, port = server.server_address
+        conn = smtplib.SMTP(host, port)
+        try:
+            conn.sendmail("a@example.com", ["b@example.com"], b"Subject: x\r\n\r\n" + b"A" * 200000 + b"\r\n")
+            long_line = None
+        except smtplib.SMTPDataError as e:
+            long_line = e.smtp_code
+        conn.sendmail("a@example.com", ["b@example.com"], b"Subject: ok\r\n\r\nhola\r\n")
+        conn.quit()
+
+        deadline = time.perf_counter() + 10
+        while time.perf_counter() < deadline and not server.stats_snapshot()["dead"]:
+            time.sleep(0.01)
+        dead = os.listdir(os.path.join("queue", "dead")) if os.path.isdir(os.path.join("queue", "dead")) else []
+        pending = server.queue.pending()
+        server.shutdown()
+
+    ok = long_line == 500 and len(calls) == 3 and len(dead) == 1 and not pending
+    print(f"[límites] línea larga -> {long_line} | correo que siempre falla: {len(calls)} intento(s), "
+          f"dead/={len(dead)}, en cola={len(pending)}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latencia entrega SMTP/LMTP -> API del listener")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--clients", type=int, default=4, help="conexiones SMTP en paralelo")
+    parser.add_argument("--workers", type=int, default=4, help="workers del receptor (ALERT_SMTP_WORKERS)")
+    parser.add_argument("--lmtp", action="store_true", help="hablar LMTP (LHLO) en vez de SMTP")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="correos/s por cliente (0 = ráfaga); con ritmo bajo se ve la latencia sin cola")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="demora de la API falsa (s)")
+    parser.add_argument("--timeout", type=float, default=120.0, help="espera máxima a que todo llegue a la API")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--verbose", action="store_true", help="mostrar la salida del listener")
+    args = parser.parse_args()
+
+    api = start_api_stub(args.api_latency)
+    os.environ.update({
+        "ALERT_API_BASE": f"http://127.0.0.1:{api.server_address[1]}",
+        "ALERT_SMTP_WORKERS": str(args.workers),
+        "ALERT_SPOOL": "0",
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    rnd = random.Random(args.seed)
+    messages = []
+    for i in range(args.messages):
+        ref = f"smtp-{i:06d}"
+        raw = imap_standin.make_geomov_message(
+            10 ** 7 + i, rnd.choice(SENT_KINDS), datetime.now(timezone.utc),
+            html=rnd.random() < 0.3, rnd=random.Random(args.seed * 7919 + i), ref=ref,
+        )
+        messages.append((ref, raw))
+
+    sent_at = {}
+    acks = []
+    with phase_dir(args.verbose):
+        import gmail_alert_listener as listener
+
+        server = listener.start_smtp_server("127.0.0.1:0")
+        host, port = server.server_address
+        t0 = time.perf_counter()
+        errors = send_all(host, port, messages, args.clients, args.lmtp, sent_at, acks, args.rate)
+        t_sent = time.perf_counter() - t0
+
+        deadline = time.perf_counter() + args.timeout
+        while time.perf_counter() < deadline and api.posted < len(messages):
+            time.sleep(0.01)
+        t_total = time.perf_counter() - t0
+        server.shutdown()
+        stats = server.stats_snapshot()
+
+    latencies = []
+    for arrived, body in list(api.arrivals):
+        m = re.search(r"Ref: (smtp-\d+)", json.loads(body).get("rawPayload") or "")
+        if m and m.group(1) in sent_at:
+            latencies.append(arrived - sent_at[m.group(1)])
+
+    proto = "LMTP" if args.lmtp else "SMTP"
+    print(f"[{proto}] {len(messages)} correos, {args.clients} cliente(s), {args.workers} worker(s), "
+          f"API +{args.api_latency * 1000:.0f} ms")
+    if errors:
+        print(f"  errores de cliente: {errors[:3]}")
+    if acks:
+        print(f"  250 (encolado en disco): p50 {statistics.median(acks) * 1000:.1f} ms, "
+              f"p95 {percentile(acks, 95) * 1000:.1f} ms | envío completo en {t_sent:.2f}s")
+    if latencies:
+        print(f"  entrega -> API: p50 {statistics.median(latencies) * 1000:.1f} ms, "
+              f"p95 {percentile(latencies, 95) * 1000:.1f} ms, máx {max(latencies) * 1000:.1f} ms | "
+              f"{len(latencies) / t_total:.1f} alertas/s")
+    print(f"  llegaron a la API: {len(latencies)}/{len(messages)} | receptor: {stats}")
+
+    if not check_limits(args.verbose) or len(latencies) < len(messages) or errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
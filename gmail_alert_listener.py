@@ -5,19 +5,39 @@ from email.header import decode_header
 from email.utils import parsedate_to_datetime
 import time
 import os
+import sys
 from datetime import datetime, timedelta, timezone
 import re
 import json
-import html as html_lib
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import requests  # pip install requests
 
+from imap_compress import enable_compression, compression_stats  # COMPRESS=DEFLATE
+from raw_spool import RawSpool, format_spool_stats  # spool local de correos crudos
+from mail_replay import replay_options, iter_replay_messages, NdjsonSink, format_replay_stats  # --replay
+from mime_body import parse_message_lazy, extract_body_text  # cuerpo en una pasada, adjuntos sin decodificar
+from html_text import body_to_text  # HTML -> texto (mismo resultado que la copia anterior)
+from alert_fields import extract_fields, EVENT_TIME_RE  # planta / área / operador en una pasada
+from alert_keywords import (  # palabras clave: filtro, tipo y severidad en un módulo
+    RELEVANT_STEMS, KeywordScan, canonical_alert_type, guess_allowed_type, guess_severity, is_checklist, is_relevant,
+)
+from alert_templates import TemplateRegistry, message_origin, format_template_stats  # plantillas aprendidas
+from smtp_ingest import SmtpIngestServer, parse_listen  # --smtp (receptor SMTP/LMTP)
+from imap_fetch import (  # FETCH por lotes, pre-filtros de dedupe y filtro de SEARCH
+    ImapFetcher, ServerQuery, fetch_uid_of, flag_seen_batch, imap_quote, parse_fetch_response,
+)
+
 # =============== CONFIG ===============
 
 GMAIL_USER = os.environ.get("GMAIL_USER", "yap32k@gmail.com")  # (Reemplazar por la real)
 GMAIL_PASS = os.environ.get("GMAIL_PASS", "intn rkry alig xhtl")  # app password (NO hardcodear idealmente)
 
-IMAP_HOST = "imap.gmail.com"
+IMAP_HOST = os.environ.get("ALERT_IMAP_HOST", "imap.gmail.com")
+IMAP_PORT = int(os.environ.get("ALERT_IMAP_PORT", "993"))
+IMAP_SSL = os.environ.get("ALERT_IMAP_SSL", "1") == "1"  # 0 = IMAP plano (ej. imap_standin.py local)
 IMAP_FOLDER = "INBOX"
 
 API_BASE_URL = os.environ.get("ALERT_API_BASE", "https://samloto.com:4016")
@@ -30,9 +50,100 @@ WORK_WINDOW_SECONDS = int(os.environ.get("WORK_WINDOW_SECONDS", "60"))
 POLL_INTERVAL_SECONDS = int(os.environ.get("POLL_INTERVAL_SECONDS", "10"))        # chequea cada 10 s dentro de ese minuto
 SLEEP_BETWEEN_CYCLES_SECONDS = int(os.environ.get("SLEEP_BETWEEN_CYCLES_SECONDS", "120"))  # duerme 2 minutos
 
+# Planificador de polling: window (ventana/pausa fija) | adaptive (según la tasa de alarmas por hora del día)
+POLL_SCHEDULER = os.environ.get("ALERT_POLL_SCHEDULER", "window").strip().lower()
+POLL_MIN_SECONDS = int(os.environ.get("ALERT_POLL_MIN_SECONDS", "5"))      # piso del intervalo
+POLL_MAX_SECONDS = int(os.environ.get("ALERT_POLL_MAX_SECONDS", "180"))    # techo (backoff cuando no llega nada)
+ALARMS_PER_POLL = float(os.environ.get("ALERT_ALARMS_PER_POLL", "1"))     # alarmas esperadas por poll en la tasa actual
+ARRIVAL_EWMA_ALPHA = float(os.environ.get("ALERT_ARRIVAL_EWMA_ALPHA", "0.3"))  # peso de la última hora observada
+# Límites por empresa (opcional): "companyId=min:max,..."  ej: "2=30:600,3=5:60"
+POLL_BOUNDS = os.environ.get("ALERT_POLL_BOUNDS", "")
+
 # Rango de búsqueda (para agarrar correos del día / recientes)
 DAYS_BACK = int(os.environ.get("ALERT_DAYS_BACK", "1"))  # 1 = desde ayer (recomendado)
 
+# Modo de escucha: auto (IDLE si el servidor lo soporta, si no polling) | idle | poll
+LISTENER_MODE = os.environ.get("LISTENER_MODE", "auto").strip().lower()
+IDLE_TIMEOUT_SECONDS = int(os.environ.get("IDLE_TIMEOUT_SECONDS", "1500"))      # re-IDLE cada 25 min (RFC 2177: < 29 min)
+IDLE_RECONNECT_SECONDS = int(os.environ.get("IDLE_RECONNECT_SECONDS", "10"))    # espera antes de reconectar tras error
+IDLE_DONE_GRACE_SECONDS = int(os.environ.get("IDLE_DONE_GRACE_SECONDS", "60"))  # sin respuesta al DONE => sesión muerta
+
+# Descarga por lotes: el tamaño del lote se adapta al tamaño promedio de los correos
+FETCH_BATCH_INITIAL = int(os.environ.get("FETCH_BATCH_INITIAL", "50"))
+FETCH_BATCH_MIN = int(os.environ.get("FETCH_BATCH_MIN", "10"))
+FETCH_BATCH_MAX = int(os.environ.get("FETCH_BATCH_MAX", "500"))
+FETCH_BATCH_TARGET_BYTES = int(os.environ.get("FETCH_BATCH_TARGET_BYTES", str(4 * 1024 * 1024)))  # ~4 MB por FETCH
+# parts = BODYSTRUCTURE + solo la parte de texto que usa el parser | full = RFC822 completo
+FETCH_MODE = os.environ.get("ALERT_FETCH_MODE", "parts").strip().lower()
+
+# Pre-filtro por cabeceras (dedupe sin bajar el cuerpo)
+HEADER_PREFETCH_FIELDS = "(MESSAGE-ID SUBJECT DATE FROM)"
+HEADER_BATCH_SIZE = int(os.environ.get("HEADER_BATCH_SIZE", "500"))
+
+# En Gmail (X-GM-EXT-1): atajo de dedupe por X-GM-MSGID (descarta lo ya procesado sin bajar cabeceras).
+# La identidad sigue siendo la clave de cache (Message-ID); el mapa X-GM-MSGID -> clave es aparte.
+USE_GMAIL_MSGID = os.environ.get("ALERT_USE_GMAIL_MSGID", "1") == "1"
+
+# CONDSTORE: si el buzón no cambió desde el último MODSEQ, el poll se salta el ciclo
+USE_CONDSTORE = os.environ.get("ALERT_USE_CONDSTORE", "1") == "1"
+
+# \Seen de lo entregado: un STORE por lote (no uno por alerta)
+SEEN_FLUSH_SIZE = int(os.environ.get("ALERT_SEEN_FLUSH_SIZE", "200"))
+
+# COMPRESS=DEFLATE (RFC 4978) si el servidor lo ofrece (ver imap_compress.py)
+USE_COMPRESS = os.environ.get("ALERT_IMAP_COMPRESS", "1") == "1"
+
+# Spool local de correos crudos (ver raw_spool.py): lo bajado una vez se relee de disco
+# en las siguientes corridas. Con spool activo se baja el RFC822 completo (para guardarlo).
+USE_SPOOL = os.environ.get("ALERT_SPOOL", "0") == "1"
+SPOOL_DIR = os.environ.get("ALERT_SPOOL_DIR", os.path.join("cache", "spool"))
+SPOOL_MAX_MB = int(os.environ.get("ALERT_SPOOL_MAX_MB", "1024"))
+SPOOL_MAX_DAYS = int(os.environ.get("ALERT_SPOOL_MAX_DAYS", "60"))
+SPOOL = RawSpool(SPOOL_DIR, SPOOL_MAX_MB * 1048576, SPOOL_MAX_DAYS * 86400) if USE_SPOOL else None
+
+FETCHER = ImapFetcher(
+    FETCH_MODE, FETCH_BATCH_INITIAL, FETCH_BATCH_MIN, FETCH_BATCH_MAX, FETCH_BATCH_TARGET_BYTES,
+    HEADER_PREFETCH_FIELDS, HEADER_BATCH_SIZE, spool=SPOOL,
+)
+
+# asunto primero: correos resueltos sin decodificar el cuerpo / con cuerpo (solo para el resumen)
+FAST_PATH = {"subjectOnly": 0, "withBody": 0}
+
+# Registro de plantillas (ver alert_templates.py): planta / área / operador / Fecha-Hora
+# desde el plan aprendido para cada remitente + formato de cuerpo, guardado en cache/alert_templates.json.
+# 0 = siempre el parser genérico
+USE_TEMPLATES = os.environ.get("ALERT_TEMPLATES", "1") == "1"
+TEMPLATES = TemplateRegistry(int(os.environ.get("ALERT_TEMPLATES_MAX", "256"))) if USE_TEMPLATES else None
+
+# Varios buzones en un proceso (--mailboxes archivo.json, ver load_mailboxes_config)
+MAILBOXES_FILE = os.environ.get("ALERT_MAILBOXES_FILE", "")
+FANIN_WORKERS = int(os.environ.get("ALERT_FANIN_WORKERS", "4"))              # buzones chequeados a la vez
+FANIN_REPORT_SECONDS = int(os.environ.get("ALERT_FANIN_REPORT_SECONDS", "300"))  # resumen de métricas
+
+# Receptor SMTP/LMTP local en vez de IMAP (--smtp HOST:PUERTO, ver smtp_ingest.py)
+SMTP_LISTEN = os.environ.get("ALERT_SMTP_LISTEN", "")                   # ej: "127.0.0.1:2525" (vacío = apagado)
+SMTP_QUEUE_DIR = os.environ.get("ALERT_SMTP_QUEUE_DIR", os.path.join("cache", "smtp_queue"))
+SMTP_WORKERS = int(os.environ.get("ALERT_SMTP_WORKERS", "4"))           # correos procesados a la vez
+SMTP_RETRY_SECONDS = int(os.environ.get("ALERT_SMTP_RETRY_SECONDS", "30"))  # reintento si falla la API (x2 cada vez, tope 1 h)
+SMTP_MAX_ATTEMPTS = int(os.environ.get("ALERT_SMTP_MAX_ATTEMPTS", "30"))    # después, a <cola>/dead/ (~1 día)
+SMTP_MAX_MB = int(os.environ.get("ALERT_SMTP_MAX_MB", "25"))
+
+# Filtro del lado del servidor (para que SEARCH devuelva solo candidatos a alarma), opcional:
+#   none  = sin filtro: SEARCH trae todo el rango y se filtra en el cliente (default)
+#   imap  = OR TEXT "<raíz>" ... con las raíces del filtro del cliente (RELEVANT_STEMS)
+#   gmraw = X-GM-RAW (Gmail) | auto = gmraw si el servidor es Gmail (X-GM-EXT-1), si no imap
+# OJO: Gmail busca por palabra completa (también con TEXT): 'fren' no encuentra 'frenazo' y
+# 'frenada' no encuentra 'FRENO'. En Gmail cualquier filtro de servidor puede perder alarmas.
+SERVER_QUERY_MODE = os.environ.get("ALERT_SERVER_QUERY", "none").strip().lower()
+SERVER_QUERY_KEYWORDS = [
+    k.strip() for k in os.environ.get("ALERT_SERVER_KEYWORDS", ",".join(RELEVANT_STEMS)).split(",") if k.strip()
+]  # solo ASCII
+GMAIL_RAW_QUERY = os.environ.get(
+    "ALERT_GMAIL_RAW_QUERY", "alarma OR checklist OR impacto OR frenada OR frenado OR aceleracion"
+)
+SERVER_FROM_FILTER = os.environ.get("ALERT_FROM_FILTER", "")  # ej: "geomov" (vacío = cualquier remitente)
+SERVER_QUERY = ServerQuery(SERVER_QUERY_MODE, SERVER_QUERY_KEYWORDS, GMAIL_RAW_QUERY, SERVER_FROM_FILTER)
+
 # Caché diario
 CACHE_DIR = "cache"
 LIMA_TZ = timezone(timedelta(hours=-5))
@@ -56,26 +167,344 @@ def decode_maybe(encoded_header):
     return "".join(decoded)
 
 
-def connect():
-    mail = imaplib.IMAP4_SSL(IMAP_HOST)
-    mail.login(GMAIL_USER, GMAIL_PASS)
-    mail.select(IMAP_FOLDER)
+def connect(mbox=None):
+    mbox = mbox or DEFAULT_MAILBOX
+    if mbox.ssl:
+        mail = imaplib.IMAP4_SSL(mbox.host, mbox.port)
+    else:
+        mail = imaplib.IMAP4(mbox.host, mbox.port)
+    mail.login(mbox.user, mbox.password)
+    if USE_COMPRESS:
+        enable_compression(mail)
+    folder = imap_quote(mbox.folder)
+    if supports_condstore(mail):
+        # para que el SELECT devuelva HIGHESTMODSEQ; sin ENABLE, RFC 7162 permite SELECT ... (CONDSTORE)
+        if "ENABLE" in mail.capabilities:
+            mail.enable("CONDSTORE")
+        else:
+            folder += " (CONDSTORE)"
+    mail.select(folder)
     return mail
 
 
 def fetch_recent_any(mail, days_back: int = 1):
     """
-    Devuelve IDs de correos (LEÍDOS y NO LEÍDOS) desde hace 'days_back' días.
+    Devuelve UIDs de correos (LEÍDOS y NO LEÍDOS) desde hace 'days_back' días.
     OJO: no filtramos UNSEEN. Dedupe se maneja por cache.
+    Solo candidatos a alarma si hay filtro de servidor (ver ServerQuery en imap_fetch.py).
     """
     date_from = (datetime.now() - timedelta(days=days_back)).strftime("%d-%b-%Y")
-    status, data = mail.search(None, "SINCE", date_from)
+    status, data = mail.uid("SEARCH", None, "SINCE", date_from, *SERVER_QUERY.criteria(mail))
     if status != "OK":
         print("Error al buscar mensajes SINCE", date_from, ":", status)
         return []
     return data[0].split()
 
 
+def fetch_new_since_uid(mail, last_uid: int):
+    """
+    Devuelve UIDs mayores a 'last_uid' (solo lo nuevo desde el último poll).
+    OJO: 'UID n:*' siempre devuelve al menos el último mensaje, por eso filtramos.
+    """
+    status, data = mail.uid("SEARCH", None, "UID", f"{last_uid + 1}:*", *SERVER_QUERY.criteria(mail))
+    if status != "OK":
+        print(f"Error al buscar mensajes UID {last_uid + 1}:* :", status)
+        return []
+    return [u for u in data[0].split() if int(u) > last_uid]
+
+
+def get_mailbox_uid_info(mail, folder: str = IMAP_FOLDER):
+    """
+    Lee UIDVALIDITY y UIDNEXT de la respuesta del SELECT (sin round trip extra).
+    Si el servidor no los mandó, los pide con STATUS.
+    """
+    uidvalidity = None
+    uidnext = None
+
+    _, data = mail.response("UIDVALIDITY")
+    if data and data[0]:
+        uidvalidity = int(data[0])
+    _, data = mail.response("UIDNEXT")
+    if data and data[0]:
+        uidnext = int(data[0])
+
+    if uidvalidity is None:
+        status, data = mail.status(imap_quote(folder), "(UIDVALIDITY UIDNEXT)")
+        if status == "OK" and data and data[0]:
+            m = re.search(rb"UIDVALIDITY (\d+)", data[0])
+            if m:
+                uidvalidity = int(m.group(1))
+            m = re.search(rb"UIDNEXT (\d+)", data[0])
+            if m:
+                uidnext = int(m.group(1))
+
+    return uidvalidity, uidnext
+
+
+# ---------- SESIÓN IMAP PERSISTENTE ----------
+
+class ImapSession:
+    """
+    Mantiene UNA sesión autenticada y con INBOX seleccionado entre polls
+    (TLS + LOGIN + SELECT solo al conectar / reconectar).
+    get() valida la sesión con NOOP y reconecta si murió.
+    """
+
+    def __init__(self, mbox=None):
+        self.mbox = mbox
+        self.mail = None
+        self.uid_info = (None, None)  # (uidvalidity, uidnext) del último SELECT
+        self.highest_modseq = None    # HIGHESTMODSEQ del último SELECT (CONDSTORE)
+        self.connected_at = None
+        self.connects = 0
+        self.reconnects = 0
+        self.last_error = None
+
+    def _open(self):
+        mbox = self.mbox or DEFAULT_MAILBOX
+        self.mail = connect(mbox)
+        self.uid_info = get_mailbox_uid_info(self.mail, mbox.folder)
+        _, data = self.mail.response("HIGHESTMODSEQ")
+        self.highest_modseq = int(data[0]) if data and data[0] else None
+        self.connected_at = time.monotonic()
+        self.connects += 1
+        if self.connects > 1:
+            self.reconnects += 1
+            print(f"Sesión IMAP reconectada (reconexiones={self.reconnects})")
+
+    def get(self):
+        if self.mail is not None:
+            try:
+                status, _ = self.mail.noop()
+                if status == "OK":
+                    # Si el servidor avisó un UIDVALIDITY nuevo, lo tomamos
+                    _, data = self.mail.response("UIDVALIDITY")
+                    if data and data[0]:
+                        self.uid_info = (int(data[0]), self.uid_info[1])
+                    return self.mail
+                self.last_error = f"NOOP {status}"
+            except Exception as e:
+                self.last_error = str(e)
+                print("Sesión IMAP caída (NOOP falló):", e)
+            self.close()
+
+        self._open()
+        return self.mail
+
+    def close(self):
+        if self.mail is None:
+            return
+        try:
+            self.mail.logout()
+        except Exception:
+            pass
+        self.mail = None
+        self.connected_at = None
+
+    def age_seconds(self) -> float:
+        if self.connected_at is None:
+            return 0.0
+        return time.monotonic() - self.connected_at
+
+    def stats(self) -> dict:
+        return {
+            "connected": self.mail is not None,
+            "connectionAgeSeconds": round(self.age_seconds(), 1),
+            "connects": self.connects,
+            "reconnects": self.reconnects,
+            "lastError": self.last_error,
+            "compression": compression_stats(self.mail) if self.mail is not None else None,
+        }
+
+
+# ---------- BUZONES (cuenta + carpeta + companyId + API) ----------
+
+class Mailbox:
+    """
+    Una fuente de alertas. Cada buzón tiene su propia sesión IMAP, su cursor
+    (checkpoint UID / MODSEQ en cache/) y sus métricas; el cache diario de
+    dedupe y el pool HTTP son compartidos.
+    El buzón por defecto (name="") usa las variables de entorno y los mismos
+    archivos de estado de siempre.
+    """
+
+    def __init__(self, name: str = "", user: str = GMAIL_USER, password: str = GMAIL_PASS,
+                 folder: str = IMAP_FOLDER, company_id: int = COMPANY_ID,
+                 api_base: str = API_BASE_URL, host: str = IMAP_HOST, port: int = IMAP_PORT,
+                 ssl: bool = IMAP_SSL):
+        self.name = name
+        self.user = user
+        self.password = password
+        self.folder = folder
+        self.company_id = company_id
+        self.endpoint = f"{api_base.rstrip('/')}/api/alerts"
+        self.host = host
+        self.port = port
+        self.ssl = ssl
+        self.session = ImapSession(self)
+        self.scheduler = PollScheduler(self)
+        self.next_check = 0.0
+        self.metrics = {"checks": 0, "sent": 0, "skipped": 0, "failed": 0, "errors": 0,
+                        "lastCheck": None, "lastCheckSeconds": None, "lastArrivals": 0}
+
+    @property
+    def label(self) -> str:
+        return self.name or f"{self.user}/{self.folder}"
+
+    @property
+    def state_suffix(self) -> str:
+        # "" => archivos de siempre (listener_uid_state.json, ...)
+        return f"_{re.sub(r'[^A-Za-z0-9_.-]+', '_', self.name)}" if self.name else ""
+
+    @property
+    def key_prefix(self) -> str:
+        # Dedupe por empresa: el mismo correo puede llegar a dos empresas distintas
+        return "" if self.company_id == COMPANY_ID else f"{self.company_id}|"
+
+    def stats(self) -> dict:
+        return {"mailbox": self.label, "companyId": self.company_id, **self.metrics,
+                "scheduler": self.scheduler.stats(), "session": self.session.stats()}
+
+
+# ---------- PLANIFICADOR DE POLLING ADAPTATIVO ----------
+
+def parse_poll_bounds(spec: str) -> dict:
+    """
+    "2=30:600,3=5:60" -> {2: (30, 600), 3: (5, 60)}
+    """
+    bounds = {}
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        company, _, rng = item.partition("=")
+        lo, _, hi = rng.partition(":")
+        try:
+            bounds[int(company)] = (int(lo or POLL_MIN_SECONDS), int(hi or POLL_MAX_SECONDS))
+        except ValueError:
+            print(f"ALERT_POLL_BOUNDS: entrada inválida {item!r}, se ignora")
+    return bounds
+
+
+COMPANY_POLL_BOUNDS = parse_poll_bounds(POLL_BOUNDS)
+
+
+class PollScheduler:
+    """
+    Decide cada cuánto chequear un buzón:
+      - Aprende la tasa de alarmas por hora del día (hora Lima, 24 casilleros,
+        promedio exponencial) y la guarda en cache/ para el próximo arranque.
+      - Intervalo base = 3600 / tasa esperada (más alarmas => polls más seguidos).
+        Cerca del cambio de hora (>= :45) también mira la hora siguiente.
+      - Si el último poll trajo alarmas => intervalo mínimo (suelen venir en ráfaga).
+      - Polls vacíos seguidos => backoff exponencial (x2 por poll vacío).
+      - Todo acotado por [mínimo, máximo] de la empresa (ALERT_POLL_BOUNDS).
+    """
+
+    def __init__(self, mbox):
+        self.mbox = mbox
+        self.min_seconds, self.max_seconds = COMPANY_POLL_BOUNDS.get(
+            mbox.company_id, (POLL_MIN_SECONDS, POLL_MAX_SECONDS)
+        )
+        self.hourly = None          # alarmas/hora por hora del día (None = sin datos aún)
+        self.hour = None            # hora (0-23) que se está contando
+        self.hour_count = 0
+        self.hour_started = None    # monotonic del primer poll de esa hora
+        self.empty_streak = 0
+        self.interval = POLL_INTERVAL_SECONDS
+
+    def path(self) -> str:
+        ensure_cache_dir()
+        return os.path.join(CACHE_DIR, f"listener_arrivals{self.mbox.state_suffix}.json")
+
+    def load(self):
+        self.hourly = [None] * 24
+        try:
+            with open(self.path(), "r", encoding="utf-8") as f:
+                data = json.load(f)
+            hours = data.get("hourly") if isinstance(data, dict) else None
+            if isinstance(hours, list) and len(hours) == 24:
+                self.hourly = [float(h) if h is not None else None for h in hours]
+        except Exception:
+            pass
+
+    def save(self):
+        with open(self.path(), "w", encoding="utf-8") as f:
+            json.dump({"hourly": self.hourly}, f, indent=2)
+
+    def fold_hour(self, now_mono: float):
+        """
+        Cierra la hora en curso: tasa observada (extrapolada a 60 min) -> promedio exponencial.
+        Horas observadas menos de 10 min no se cuentan (muy poco dato).
+        """
+        observed = now_mono - self.hour_started
+        if observed >= 600:
+            rate = self.hour_count * 3600.0 / min(observed, 3600.0)
+            prev = self.hourly[self.hour]
+            self.hourly[self.hour] = rate if prev is None else (
+                ARRIVAL_EWMA_ALPHA * rate + (1 - ARRIVAL_EWMA_ALPHA) * prev
+            )
+            self.save()
+
+    def expected_rate(self, now_lima: datetime, now_mono: float):
+        """
+        Alarmas/hora esperadas ahora. None = no hay historia para esta hora.
+        """
+        candidates = [self.hourly[now_lima.hour]]
+        if now_lima.minute >= 45:
+            candidates.append(self.hourly[(now_lima.hour + 1) % 24])
+        observed = now_mono - self.hour_started
+        if observed >= 300:
+            candidates.append(self.hour_count * 3600.0 / observed)
+        known = [c for c in candidates if c is not None]
+        return max(known) if known else None
+
+    def record(self, arrivals: int) -> float:
+        """
+        Anota cuántas alarmas nuevas trajo el último poll y devuelve el próximo intervalo (s).
+        """
+        if self.hourly is None:
+            self.load()
+
+        now_lima = datetime.now(LIMA_TZ)
+        now_mono = time.monotonic()
+        if self.hour != now_lima.hour:
+            if self.hour is not None:
+                self.fold_hour(now_mono)
+            self.hour = now_lima.hour
+            self.hour_count = 0
+            self.hour_started = now_mono
+        self.hour_count += arrivals
+
+        rate = self.expected_rate(now_lima, now_mono)
+        if rate is None:
+            base = float(POLL_INTERVAL_SECONDS)
+        elif rate <= 0:
+            base = float(self.max_seconds)
+        else:
+            base = 3600.0 * ALARMS_PER_POLL / rate
+
+        if arrivals > 0:
+            self.empty_streak = 0
+            interval = self.min_seconds
+        else:
+            self.empty_streak += 1
+            interval = base * (2 ** min(self.empty_streak - 1, 16))
+
+        self.interval = max(self.min_seconds, min(self.max_seconds, int(round(interval))))
+        self.mbox.metrics["pollIntervalSeconds"] = self.interval
+        self.mbox.metrics["arrivalRatePerHour"] = round(rate, 2) if rate is not None else None
+        return self.interval
+
+    def stats(self) -> dict:
+        return {
+            "pollIntervalSeconds": self.interval,
+            "minSeconds": self.min_seconds,
+            "maxSeconds": self.max_seconds,
+            "emptyStreak": self.empty_streak,
+            "currentHourArrivals": self.hour_count,
+        }
+
+
 def get_message_datetime(msg):
     date_hdr = msg.get("Date")
     if not date_hdr:
@@ -90,6 +519,45 @@ def get_message_datetime(msg):
         return datetime.now(timezone.utc)
 
 
+# ---------- X-GM-MSGID (dedupe compacto en Gmail) ----------
+
+def supports_gmail_ext(mail) -> bool:
+    return USE_GMAIL_MSGID and "X-GM-EXT-1" in mail.capabilities
+
+
+def load_gmid_map(path: str) -> dict:
+    """
+    Mapa { ámbito + X-GM-MSGID (str) -> clave de cache } de mensajes ya procesados
+    (ámbito = Mailbox.key_prefix: "" para la empresa por defecto, "2|" para companyId 2, ...).
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except Exception:
+        return {}
+
+
+def save_gmid_map(path: str, mapping: dict):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(mapping, f, ensure_ascii=False, indent=2, sort_keys=True)
+
+
+# ---------- CLAVE DE CACHE (la usa también el pre-filtro por cabeceras) ----------
+
+def build_cache_key(message_id: str, subject: str, msg_dt_utc: datetime) -> str:
+    return message_id or f"{subject}|{msg_dt_utc.isoformat()}"
+
+
+def header_cache_key(header_bytes: bytes) -> str:
+    msg = email.message_from_bytes(header_bytes)
+    subject = decode_maybe(msg.get("Subject"))
+    message_id = (msg.get("Message-ID") or "").strip()
+    return build_cache_key(message_id, subject, get_message_datetime(msg))
+
+
 # ---------- CACHÉ DIARIO ----------
 
 def ensure_cache_dir():
@@ -103,6 +571,12 @@ def get_today_cache_path():
     return os.path.join(CACHE_DIR, f"alerts_cache_{today_lima}.json")
 
 
+def get_today_gmid_map_path():
+    ensure_cache_dir()
+    today_lima = datetime.now(LIMA_TZ).strftime("%Y%m%d")
+    return os.path.join(CACHE_DIR, f"alerts_gmid_{today_lima}.json")
+
+
 def load_today_cache():
     path = get_today_cache_path()
     if not os.path.exists(path):
@@ -115,123 +589,224 @@ def load_today_cache():
         return set()
 
 
+def get_templates_path():
+    ensure_cache_dir()
+    return os.path.join(CACHE_DIR, "alert_templates.json")
+
+
+def load_templates():
+    """
+    Planes de plantillas aprendidos en corridas anteriores (listener y backfill comparten el archivo).
+    """
+    if TEMPLATES is not None:
+        loaded = TEMPLATES.load(get_templates_path())
+        if loaded:
+            print(f"Plantillas cargadas de cache: {loaded}")
+
+
+def save_templates():
+    if TEMPLATES is not None:
+        TEMPLATES.save(get_templates_path())
+
+
+# Con varios buzones (--mailboxes) el cache diario lo escriben varios hilos
+CACHE_LOCK = threading.Lock()
+IN_FLIGHT_KEYS = set()  # claves que se están enviando ahora (para no duplicar entre buzones)
+PROCESSED_KEYS = {"day": None, "keys": set()}  # claves de HOY, compartidas por todos los buzones
+
+
+def load_processed_keys() -> set:
+    """
+    Set de claves ya procesadas hoy, el MISMO objeto para todos los buzones del proceso.
+    En cada ciclo se le suma lo que haya en el archivo (ej. lo que escribió el backfill).
+    """
+    today_lima = datetime.now(LIMA_TZ).strftime("%Y%m%d")
+    with CACHE_LOCK:
+        if PROCESSED_KEYS["day"] != today_lima:
+            PROCESSED_KEYS["day"] = today_lima
+            PROCESSED_KEYS["keys"] = set()
+        PROCESSED_KEYS["keys"] |= load_today_cache()
+        return PROCESSED_KEYS["keys"]
+
+
 def append_cache_key(cache_key: str):
+    if NDJSON_SINK is not None:
+        return  # replay a NDJSON: no se marca nada como procesado
     path = get_today_cache_path()
-    keys = load_today_cache()
-    if cache_key in keys:
-        return
-    keys.add(cache_key)
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(sorted(keys), f, ensure_ascii=False, indent=2)
+    with CACHE_LOCK:
+        keys = load_today_cache()
+        if cache_key in keys:
+            return
+        keys.add(cache_key)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(sorted(keys), f, ensure_ascii=False, indent=2)
     print(f">>> Cache actualizado ({path}): {cache_key}")
 
 
-# ---------- PARSEO DEL CORREO ----------
+def claim_cache_key(cache_key: str, processed_keys: set) -> bool:
+    """
+    Reserva la clave antes de enviar. False si ya se procesó o la está enviando otro buzón.
+    """
+    with CACHE_LOCK:
+        if cache_key in processed_keys or cache_key in IN_FLIGHT_KEYS:
+            return False
+        IN_FLIGHT_KEYS.add(cache_key)
+        return True
 
-def extract_body_text(msg):
-    """
-    Devuelve el cuerpo como texto.
-    Preferimos text/plain; si no hay, usamos text/html como texto crudo.
-    """
-    if msg.is_multipart():
-        for part in msg.walk():
-            content_type = part.get_content_type()
-            content_disp = str(part.get("Content-Disposition", ""))
-            if content_type == "text/plain" and "attachment" not in content_disp:
-                try:
-                    return part.get_payload(decode=True).decode(
-                        part.get_content_charset() or "utf-8",
-                        errors="ignore",
-                    )
-                except Exception:
-                    pass
-
-        for part in msg.walk():
-            content_type = part.get_content_type()
-            content_disp = str(part.get("Content-Disposition", ""))
-            if content_type == "text/html" and "attachment" not in content_disp:
-                try:
-                    return part.get_payload(decode=True).decode(
-                        part.get_content_charset() or "utf-8",
-                        errors="ignore",
-                    )
-                except Exception:
-                    pass
-        return ""
-    else:
-        try:
-            return msg.get_payload(decode=True).decode(
-                msg.get_content_charset() or "utf-8",
-                errors="ignore",
-            )
-        except Exception:
-            return ""
 
+def release_cache_key(cache_key: str):
+    with CACHE_LOCK:
+        IN_FLIGHT_KEYS.discard(cache_key)
+
+
+# ---------- CHECKPOINT UID (UIDVALIDITY + último UID) ----------
+
+def get_uid_state_path(mbox=None):
+    ensure_cache_dir()
+    suffix = mbox.state_suffix if mbox else ""
+    return os.path.join(CACHE_DIR, f"listener_uid_state{suffix}.json")
+
+
+def load_uid_state(mbox=None) -> dict:
+    path = get_uid_state_path(mbox)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except Exception:
+        return {}
 
-def looks_like_html(s: str) -> bool:
-    if not s:
-        return False
-    low = s.lower()
-    return "<html" in low or "<body" in low or "<br" in low or "</div" in low or "<p" in low
 
+def save_uid_state(state: dict, mbox=None):
+    path = get_uid_state_path(mbox)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
 
-def html_to_text(s: str) -> str:
+
+def fetch_candidate_uids(mail, state: dict, uidvalidity):
     """
-    Convierte HTML básico a texto para poder parsear campos (Área, Planta, Operador, etc).
-    Sin dependencias externas.
+    - Si UIDVALIDITY coincide con el checkpoint => solo UIDs nuevos (UID last+1:*).
+    - Si cambió (o no hay checkpoint) => búsqueda por fecha (SINCE) como antes.
     """
-    if not s:
-        return ""
+    last_uid = state.get("last_uid")
 
-    s = re.sub(r"(?i)<br\s*/?>", "\n", s)
-    s = re.sub(r"(?i)</p\s*>", "\n", s)
-    s = re.sub(r"(?i)</div\s*>", "\n", s)
+    if uidvalidity is not None and state.get("uidvalidity") == uidvalidity and last_uid is not None:
+        print(f"Checkpoint UID OK (UIDVALIDITY={uidvalidity}), buscando UID > {last_uid}…")
+        return fetch_new_since_uid(mail, int(last_uid))
 
-    s = re.sub(r"<[^>]+>", " ", s)
-    s = html_lib.unescape(s)
+    print(f"Sin checkpoint válido (UIDVALIDITY={uidvalidity}), buscando desde hace {DAYS_BACK} día(s)…")
+    return fetch_recent_any(mail, days_back=DAYS_BACK)
 
-    s = s.replace("\xa0", " ")
-    s = re.sub(r"[ \t]+", " ", s)
-    s = re.sub(r"\n\s*\n+", "\n", s)
 
-    return s.strip()
+def next_uid_state(state: dict, uids, first_failed_uid, uidvalidity, uidnext) -> dict:
+    """
+    Calcula el nuevo checkpoint.
+    Si la API falló para algún UID, el checkpoint se queda justo antes de él
+    para que el siguiente poll lo reintente (los ya enviados los frena el cache).
+    """
+    if uidvalidity is None:
+        return state
+
+    prev_last = state.get("last_uid") if state.get("uidvalidity") == uidvalidity else None
+
+    if first_failed_uid is not None:
+        last_uid = int(first_failed_uid) - 1
+    elif uids:
+        last_uid = max(int(u) for u in uids)
+    elif prev_last is not None:
+        last_uid = prev_last
+    elif uidnext:
+        last_uid = uidnext - 1
+    else:
+        return state
 
+    if prev_last is not None:
+        last_uid = max(int(prev_last), last_uid)
+
+    return {"uidvalidity": uidvalidity, "last_uid": last_uid}
+
+
+# ---------- CONDSTORE / MODSEQ ----------
+
+def supports_condstore(mail) -> bool:
+    return USE_CONDSTORE and "CONDSTORE" in mail.capabilities
+
+
+def get_modseq_state_path(mbox=None):
+    ensure_cache_dir()
+    suffix = mbox.state_suffix if mbox else ""
+    return os.path.join(CACHE_DIR, f"listener_modseq_state{suffix}.json")
+
+
+def load_modseq_state(mbox=None) -> dict:
+    path = get_modseq_state_path(mbox)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except Exception:
+        return {}
 
-def normalize_alert_text(s: str) -> str:
-    if not s:
-        return ""
-    x = s.strip().upper()
-    x = (x.replace("Ó", "O")
-           .replace("Á", "A")
-           .replace("É", "E")
-           .replace("Í", "I")
-           .replace("Ú", "U"))
-    return x
 
+def save_modseq_state(state: dict, mbox=None):
+    with open(get_modseq_state_path(mbox), "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
 
-def canonical_alert_type(s: str) -> str:
+
+def fetch_changes_since(mail, modseq: int):
     """
-    Mapea variaciones a los 3 tipos permitidos:
-      - contiene IMPACTO => IMPACTO
-      - contiene FREN => FRENADA
-      - contiene ACELER => ACELERACION
+    UID FETCH 1:* (UID FLAGS) (CHANGEDSINCE modseq): una sola respuesta con
+    SOLO los mensajes que cambiaron (nuevos o flags tocados por otro cliente).
+    Devuelve lista de (uid, modseq); lista vacía = nada cambió; None = error.
     """
-    x = normalize_alert_text(s)
-    if "IMPACTO" in x:
-        return "IMPACTO"
-    if "FREN" in x:
-        return "FRENADA"
-    if "ACELER" in x:
-        return "ACELERACION"
-    return ""
+    status, data = mail.uid("FETCH", "1:*", "(UID FLAGS)", f"(CHANGEDSINCE {modseq})")
+    if status != "OK":
+        print(f"Error en FETCH CHANGEDSINCE {modseq}: {status}")
+        return None
+
+    changes = []
+    for item in parse_fetch_response(data):
+        uid = fetch_uid_of(item)
+        m = re.search(rb"MODSEQ \((\d+)\)", item["meta"])
+        if uid is not None and m:
+            changes.append((int(uid), int(m.group(1))))
+    return changes
+
 
+def condstore_precheck(mail, uidvalidity, selected_modseq, mbox=None):
+    """
+    Decide si vale la pena sincronizar.
+    Devuelve (hay_que_sincronizar, modseq_a_guardar).
+    - Sin MODSEQ guardado (o cambió UIDVALIDITY) => sincronizar.
+    - Sin cambios desde el MODSEQ guardado => saltar el ciclo.
+    - Solo cambios de flags (UIDs ya cubiertos por el checkpoint) => saltar, pero avanzar MODSEQ.
+    - Hay UIDs por encima del checkpoint (nuevos o reintentos) => sincronizar.
+    """
+    state = load_modseq_state(mbox)
+    last = state.get("highestmodseq") if state.get("uidvalidity") == uidvalidity else None
+    if last is None:
+        return True, selected_modseq
+
+    changes = fetch_changes_since(mail, int(last))
+    if changes is None:
+        return True, None
+    if not changes:
+        return False, int(last)
+
+    uid_state = load_uid_state(mbox)
+    last_uid = uid_state.get("last_uid") if uid_state.get("uidvalidity") == uidvalidity else None
+    new_uids = [uid for uid, _ in changes if last_uid is None or uid > int(last_uid)]
+    current = max(ms for _, ms in changes)
+    print(f"CONDSTORE: {len(changes)} cambio(s) desde MODSEQ {last} "
+          f"(nuevos={len(new_uids)} | solo flags={len(changes) - len(new_uids)})")
+    return bool(new_uids), current
 
-def guess_allowed_type(subject: str, body_text: str) -> str:
-    t = canonical_alert_type(subject or "")
-    if t:
-        return t
-    return canonical_alert_type(body_text or "")
 
+# ---------- PARSEO DEL CORREO ----------
 
 def parse_subject(subject: str):
     """
@@ -269,84 +844,8 @@ def parse_subject(subject: str):
     return alert_type, vehicle_code, license_plate, template_source
 
 
-def parse_plant(body_text: str):
-    if not body_text:
-        return None
-
-    for line in body_text.splitlines():
-        line_clean = line.strip()
-        m = re.search(r"(Planta|Sede)\s*:\s*(.+)", line_clean, re.IGNORECASE)
-        if m:
-            val = m.group(2).strip()
-            val = re.split(r"\s{2,}|\t|\|", val)[0].strip()
-            return val or None
-
-    m2 = re.search(r"(Planta|Sede)\s*:\s*([^\n\r]+)", body_text, re.IGNORECASE)
-    if m2:
-        val = m2.group(2).strip()
-        val = re.split(r"\s{2,}|\t|\|", val)[0].strip()
-        return val or None
-
-    return None
-
-
-def parse_area(body_text: str):
-    if not body_text:
-        return None
-
-    for line in body_text.splitlines():
-        line_clean = line.strip()
-        if not line_clean:
-            continue
-
-        m = re.search(
-            r"(?:\bÁrea\b|\bArea\b|\bZona\b|\bUbicación\b|\bUbicacion\b|\bLugar\b)\s*:\s*(.+)",
-            line_clean,
-            re.IGNORECASE,
-        )
-        if m:
-            val = m.group(1).strip()
-            val = re.split(r"\s{2,}|\t|\|", val)[0].strip()
-            return val or None
-
-    m2 = re.search(
-        r"(?:\bÁrea\b|\bArea\b|\bZona\b|\bUbicación\b|\bUbicacion\b|\bLugar\b)\s*:\s*([^\n\r]+)",
-        body_text,
-        re.IGNORECASE,
-    )
-    if m2:
-        val = m2.group(1).strip()
-        val = re.split(r"\s{2,}|\t|\|", val)[0].strip()
-        return val or None
-
-    return None
-
-
-def parse_operator(body_text: str):
-    operator_name = None
-    operator_id = None
-
-    for line in body_text.splitlines():
-        line_clean = line.strip()
-
-        m_name = re.search(r"Operador\s*:\s*(.+)", line_clean, re.IGNORECASE)
-        if m_name and not operator_name:
-            operator_name = m_name.group(1).strip()
-
-        m_id = re.search(r"(ID\s*Operador|DNI)\s*:\s*(.+)", line_clean, re.IGNORECASE)
-        if m_id and not operator_id:
-            operator_id = m_id.group(2).strip()
-
-    return operator_name, operator_id
-
-
 def parse_event_time_from_body(body_text: str, fallback_dt_utc: datetime):
-    pattern = re.compile(
-        r"(?:Alarma\s+Fecha|Fecha)\s*:\s*([0-9]{2}-[A-Za-z]{3}-[0-9]{4}).*?Hora\s*:\s*([0-9]{2}:[0-9]{2})",
-        re.IGNORECASE | re.DOTALL,
-    )
-
-    match = pattern.search(body_text)
+    match = EVENT_TIME_RE.search(body_text)
     if not match:
         return fallback_dt_utc
 
@@ -375,36 +874,33 @@ def parse_event_time_from_body(body_text: str, fallback_dt_utc: datetime):
         return fallback_dt_utc
 
 
-def guess_severity(alert_type: str, body_text: str) -> str:
-    t = normalize_alert_text(alert_type or "")
-    text = (body_text or "").lower()
-
-    if "sin condiciones" in text or "bloquea" in text:
-        return "BLOQUEA_OPERACION"
-    if "IMPACTO" in t:
-        return "CRITICAL"
-    if "FREN" in t or "ACELER" in t:
-        return "WARNING"
-    return "INFO"
-
-
-def build_alert_payload(subject: str, body_text: str, msg_dt_utc: datetime) -> dict:
+def build_alert_payload(subject: str, body_text: str, msg_dt_utc: datetime, company_id: int = COMPANY_ID,
+                        keywords=None, origin=None) -> dict:
+    """
+    'keywords' = (KeywordScan del asunto, KeywordScan del cuerpo) que ya armó el filtro, para no repetir búsquedas.
+    'origin' = message_origin(From, Message-ID): con TEMPLATES activo, los campos salen del plan de esa plantilla.
+    """
     alert_type_raw, vehicle_code, license_plate, template_source = parse_subject(subject)
 
-    parse_text = html_to_text(body_text) if looks_like_html(body_text) else (body_text or "")
+    parse_text = body_to_text(body_text)
+
+    if TEMPLATES is not None and origin is not None:
+        (plant, area, operator_name, operator_id), event_text = TEMPLATES.extract(origin, parse_text)
+    else:
+        (plant, area, operator_name, operator_id), event_text = extract_fields(parse_text), parse_text
 
-    plant = parse_plant(parse_text)
-    area = parse_area(parse_text)
-    operator_name, operator_id = parse_operator(parse_text)
+    event_time_dt = parse_event_time_from_body(event_text, msg_dt_utc)
 
-    event_time_dt = parse_event_time_from_body(parse_text, msg_dt_utc)
+    subject_kw, body_kw = keywords or (KeywordScan(subject), None)
+    # cuerpo sin HTML: parse_text ES el cuerpo, sirve la misma búsqueda
+    parse_kw = body_kw if body_kw is not None and parse_text is body_kw.text else KeywordScan(parse_text)
 
     # Tipificación SOLO a los permitidos (o DESCONOCIDO)
     alert_type = canonical_alert_type(alert_type_raw or "")
     if not alert_type:
-        alert_type = guess_allowed_type(subject, parse_text) or "DESCONOCIDO"
+        alert_type = guess_allowed_type(subject_kw, parse_kw) or "DESCONOCIDO"
 
-    severity = guess_severity(alert_type, parse_text)
+    severity = guess_severity(alert_type, parse_kw)
 
     if not vehicle_code:
         vehicle_code = "UNKNOWN"
@@ -424,7 +920,7 @@ def build_alert_payload(subject: str, body_text: str, msg_dt_utc: datetime) -> d
         "vehicleCode": vehicle_code,
         "alertType": alert_type,
         "eventTime": event_time_dt.isoformat(),
-        "companyId": COMPANY_ID,
+        "companyId": company_id,
 
         "licensePlate": license_plate,
         "alertSubtype": None,
@@ -447,9 +943,21 @@ def build_alert_payload(subject: str, body_text: str, msg_dt_utc: datetime) -> d
     }
 
 
-def send_alert_to_api(payload: dict) -> bool:
+# Un solo pool HTTP (keep-alive) para todos los buzones
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=max(FANIN_WORKERS, 10)))
+HTTP_SESSION.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=max(FANIN_WORKERS, 10)))
+
+
+# --ndjson: los payloads van a un archivo en vez de a la API (ver mail_replay.py)
+NDJSON_SINK = None
+
+
+def send_alert_to_api(payload: dict, endpoint: str = ALERT_ENDPOINT) -> bool:
+    if NDJSON_SINK is not None:
+        return NDJSON_SINK.write(payload)
     try:
-        resp = requests.post(ALERT_ENDPOINT, json=payload, timeout=15)
+        resp = HTTP_SESSION.post(endpoint, json=payload, timeout=15)
         if 200 <= resp.status_code < 300:
             print(f">>> API OK ({resp.status_code}) - alerta registrada")
             return True
@@ -460,54 +968,96 @@ def send_alert_to_api(payload: dict) -> bool:
         return False
 
 
-def cache_as_processed(cache_key: str, processed_keys: set):
+def cache_as_processed(cache_key: str, processed_keys: set, gmid: str = None, gmid_map: dict = None):
     append_cache_key(cache_key)
     processed_keys.add(cache_key)
+    if gmid is not None and gmid_map is not None:
+        gmid_map[gmid] = cache_key
 
 
 # ---------- PROCESO PRINCIPAL POR MENSAJE (MISMAS REGLAS QUE BACKFILL) ----------
 
-def process_message(mail, msg_id, processed_keys: set):
-    status, msg_data = mail.fetch(msg_id, "(RFC822)")
-    if status != "OK":
-        print(f"Error al descargar mensaje {msg_id}: {status}")
-        return False
+# los contadores del asunto primero se suman desde el pool de --fan-in y los workers SMTP
+FAST_PATH_LOCK = threading.Lock()
+
+
+def count_fast_path(path: str):
+    with FAST_PATH_LOCK:
+        FAST_PATH[path] += 1
+
+
+def format_fast_path_stats() -> str:
+    subject_only, with_body = FAST_PATH["subjectOnly"], FAST_PATH["withBody"]
+    rate = 100.0 * subject_only / (subject_only + with_body) if subject_only + with_body else 0.0
+    return f"Asunto primero: resueltos sin cuerpo={subject_only} ({rate:.1f}%) | con cuerpo={with_body}"
 
-    msg = email.message_from_bytes(msg_data[0][1])
 
+def process_message(mail, msg_id, msg, processed_keys: set, gmid: str = None, gmid_map: dict = None, mbox=None):
+    """
+    'msg_id' es un UID IMAP y 'msg' el correo ya descargado (ver ImapFetcher.fetch_messages);
+    con mail=None (--replay / SMTP) 'msg_id' es la referencia del archivo o de la cola.
+    'gmid' (X-GM-MSGID, solo Gmail) se guarda en 'gmid_map' al cachear.
+    'mbox' = buzón de origen (companyId, endpoint de la API, ámbito del dedupe).
+    Devuelve True (enviada), False (saltada/cacheada) o None (falló descarga/API => reintentar).
+    El \\Seen de lo enviado lo marca quien llama, en lote (ver flag_seen_batch).
+    """
+    if msg is None:
+        print(f"Error al descargar mensaje {msg_id}")
+        return None
+
+    mbox = mbox or DEFAULT_MAILBOX
     subject = decode_maybe(msg.get("Subject"))
     from_ = decode_maybe(msg.get("From"))
     msg_dt_utc = get_message_datetime(msg)
     message_id = (msg.get("Message-ID") or "").strip()
 
-    cache_key = message_id or f"{subject}|{msg_dt_utc.isoformat()}"
+    cache_key = mbox.key_prefix + build_cache_key(message_id, subject, msg_dt_utc)
 
     if cache_key in processed_keys:
         return False
 
+    # Asunto primero: un checklist en el asunto se cachea sin decodificar el cuerpo.
+    # Lo demás necesita el cuerpo aunque el asunto traiga el tipo: checklist en el cuerpo,
+    # planta / área / operador / Fecha, severidad ("bloquea"), y un tipo no permitido en el
+    # asunto todavía puede salir del cuerpo (guess_allowed_type)
+    subject_kw = KeywordScan(subject)
+    if subject_kw.checklist():
+        count_fast_path("subjectOnly")
+        cache_as_processed(cache_key, processed_keys, gmid, gmid_map)
+        return False
+    count_fast_path("withBody")
+
     body_text = extract_body_text(msg)
 
     # Filtro rápido: si no parece relevante, ni lo cacheamos
-    text_to_search = (subject or "") + "\n" + (body_text or "")
-    low = text_to_search.lower()
-    if ("alarma" not in low) and ("checklist" not in low) and ("impacto" not in low) and ("fren" not in low) and ("aceler" not in low):
+    keywords = (subject_kw, KeywordScan(body_text))
+    if not is_relevant(*keywords):
         return False
 
     # 1) Si es checklist, NO enviar, pero SÍ cachear
-    if "checklist" in low:
-        cache_as_processed(cache_key, processed_keys)
+    if is_checklist(*keywords):
+        cache_as_processed(cache_key, processed_keys, gmid, gmid_map)
         return False
 
-    payload = build_alert_payload(subject, body_text, msg_dt_utc)
+    payload = build_alert_payload(subject, body_text, msg_dt_utc, mbox.company_id, keywords,
+                                  message_origin(from_, message_id))
 
     # 2) Solo enviar si el tipo es uno de los permitidos (y si no, cachear igual)
     alert_type = payload.get("alertType") or ""
     if alert_type not in ALLOWED_TYPES:
-        cache_as_processed(cache_key, processed_keys)
+        cache_as_processed(cache_key, processed_keys, gmid, gmid_map)
+        return False
+
+    if not claim_cache_key(cache_key, processed_keys):
         return False
 
     print("=" * 60)
-    print(f"IMAP ID: {msg_id}")
+    if mbox.name:
+        print(f"Buzón: {mbox.label}")
+    if mail is not None:
+        print(f"IMAP UID: {msg_id}")
+    else:
+        print(f"Ref: {msg_id}")
     print(f"Message-ID: {message_id}")
     print(f"From: {from_}")
     print(f"Subject: {subject}")
@@ -516,49 +1066,289 @@ def process_message(mail, msg_id, processed_keys: set):
     print("Payload a enviar a la API:")
     print(json.dumps(payload, ensure_ascii=False, indent=2))
 
-    if send_alert_to_api(payload):
-        cache_as_processed(cache_key, processed_keys)
-
-        # opcional: marcar como leído si se registró OK
-        mail.store(msg_id, "+FLAGS", "\\Seen")
-        return True
+    try:
+        if send_alert_to_api(payload, mbox.endpoint):
+            cache_as_processed(cache_key, processed_keys, gmid, gmid_map)
+            return True
+    finally:
+        release_cache_key(cache_key)
 
     # Si falló la API, NO cacheamos => permitirá reintentar
-    return False
+    return None
+
+
+def sync_mailbox(mail, uid_info, mbox=None):
+    """
+    Un ciclo de sincronización sobre una sesión ya seleccionada:
+    busca UIDs nuevos (o por fecha), procesa y avanza el checkpoint.
+    'uid_info' = (uidvalidity, uidnext) leídos del SELECT.
+    Devuelve True si no quedó nada pendiente de reintento.
+    """
+    mbox = mbox or DEFAULT_MAILBOX
+    processed_keys = load_processed_keys()
+    print(f"Claves ya procesadas hoy: {len(processed_keys)}")
+
+    use_gmid = supports_gmail_ext(mail)
+    gmid_map_fp = get_today_gmid_map_path()
+    gmid_map = load_gmid_map(gmid_map_fp) if use_gmid else {}
+    gmid_count = len(gmid_map)
+
+    uid_state = load_uid_state(mbox)
+    uidvalidity, uidnext = uid_info
+
+    msg_ids = fetch_candidate_uids(mail, uid_state, uidvalidity)
+    # Llegadas = alarmas que pasan el filtro (enviadas o con la API caída) sobre un checkpoint
+    # válido: ni el barrido inicial por fecha ni el resto del correo cuentan para la tasa
+    checkpoint_ok = (
+        uidvalidity is not None and uid_state.get("uidvalidity") == uidvalidity
+        and uid_state.get("last_uid") is not None
+    )
+    arrivals = 0
+    first_failed = None
+    if msg_ids:
+        print(f"Encontrados {len(msg_ids)} correo(s) nuevos/en el rango.")
+        sent = 0
+        skipped = 0
+
+        pending_ids, gmids = msg_ids, {}
+        if use_gmid:
+            pending_ids, gmids = FETCHER.filter_processed_by_gmid(
+                mail, pending_ids, gmid_map, use_uid=True, key_prefix=mbox.key_prefix,
+            )
+        header_keys = {}
+        pending_ids = FETCHER.filter_unprocessed_by_headers(
+            mail, pending_ids, processed_keys, header_cache_key, use_uid=True, gmids=gmids, gmid_map=gmid_map,
+            key_prefix=mbox.key_prefix, header_keys=header_keys,
+        )
+        skipped += len(msg_ids) - len(pending_ids)
+
+        delivered = []
+        for msg_id, msg in FETCHER.fetch_messages(mail, pending_ids, use_uid=True, spool_keys=header_keys):
+            ok = process_message(mail, msg_id, msg, processed_keys, gmids.get(int(msg_id)), gmid_map, mbox)
+            if ok or (ok is None and msg is not None):
+                arrivals += 1
+            if ok:
+                sent += 1
+                delivered.append(msg_id)
+                if len(delivered) >= SEEN_FLUSH_SIZE:
+                    flag_seen_batch(mail, delivered, use_uid=True)
+                    delivered = []
+            else:
+                skipped += 1
+                if ok is None:
+                    mbox.metrics["failed"] += 1
+                    if first_failed is None:
+                        first_failed = msg_id
+        flag_seen_batch(mail, delivered, use_uid=True)
+        mbox.metrics["sent"] += sent
+        mbox.metrics["skipped"] += skipped
+        print(f"Resumen check: enviadas={sent} | saltadas={skipped}")
+        print(format_fast_path_stats())
+        print(format_template_stats(TEMPLATES))
+        save_templates()
+        if SPOOL is not None:
+            print(format_spool_stats(SPOOL))
+    else:
+        print("Sin correos nuevos.")
+    mbox.metrics["lastArrivals"] = arrivals if checkpoint_ok else 0
+
+    if use_gmid and len(gmid_map) != gmid_count:
+        with CACHE_LOCK:
+            gmid_map = {**load_gmid_map(gmid_map_fp), **gmid_map}
+            save_gmid_map(gmid_map_fp, gmid_map)
+
+    new_state = next_uid_state(uid_state, msg_ids, first_failed, uidvalidity, uidnext)
+    if new_state != uid_state:
+        save_uid_state(new_state, mbox)
+        print(f"Checkpoint UID: {new_state}")
+
+    return first_failed is None
+
+
+def sync_session(session, mail, mbox):
+    """
+    Un ciclo sobre la sesión ya abierta (poll o despertar de IDLE).
+    Con CONDSTORE, si nada cambió desde el último MODSEQ se salta la sincronización.
+    """
+    uidvalidity = session.uid_info[0]
+    modseq = None
+    if supports_condstore(mail):
+        must_sync, modseq = condstore_precheck(mail, uidvalidity, session.highest_modseq, mbox)
+        if not must_sync:
+            print(f"CONDSTORE: sin correo nuevo desde MODSEQ {modseq}, se salta el ciclo.")
+            save_modseq_state({"uidvalidity": uidvalidity, "highestmodseq": modseq}, mbox)
+            return
+
+    clean = sync_mailbox(mail, session.uid_info, mbox)
+    if modseq is not None and clean:
+        save_modseq_state({"uidvalidity": uidvalidity, "highestmodseq": modseq}, mbox)
 
 
-def check_mail_once():
+def check_mail_once(session=None):
+    """
+    Un poll usando la sesión persistente (no hace LOGIN/LOGOUT cada vez).
+    Si la conexión se cae a mitad del ciclo, reconecta y reintenta una vez
+    (el cache evita reenviar lo que ya se procesó).
+    Con CONDSTORE, si nada cambió desde el último MODSEQ se salta el ciclo.
+    """
+    session = session or IMAP_SESSION
+    mbox = session.mbox or DEFAULT_MAILBOX
+    mbox.metrics["lastArrivals"] = 0
+
     now_lima = datetime.now(LIMA_TZ)
-    print(f"Chequeando correos a las {now_lima.isoformat()} (hora Lima)")
+    where = f" [{mbox.label}]" if mbox.name else ""
+    print(f"Chequeando correos{where} a las {now_lima.isoformat()} (hora Lima)")
 
-    processed_keys = load_today_cache()
-    print(f"Claves ya procesadas hoy: {len(processed_keys)}")
+    for attempt in (1, 2):
+        mail = session.get()
+        try:
+            sync_session(session, mail, mbox)
+            break
+        except (imaplib.IMAP4.abort, OSError) as e:
+            session.last_error = str(e)
+            session.close()
+            if attempt == 2:
+                raise
+            print("Conexión IMAP perdida durante el check, reconectando:", e)
+
+    print(f"Sesión IMAP: {session.stats()}")
+
+
+DEFAULT_MAILBOX = Mailbox()
+IMAP_SESSION = DEFAULT_MAILBOX.session
+
+
+# ---------- MODO IDLE (push) ----------
 
-    mail = connect()
-    print(f"Conectado a Gmail IMAP, buscando correos (leídos y no leídos) desde hace {DAYS_BACK} día(s)…")
+def supports_idle(mail) -> bool:
+    return "IDLE" in mail.capabilities
 
+
+IDLE_TAGS = itertools.count(1)
+EXISTS_RE = re.compile(rb"\* \d+ EXISTS")
+
+
+def idle_wait(mail, timeout: int) -> bool:
+    """
+    Manda IDLE y bloquea hasta que el servidor avise un EXISTS (correo nuevo)
+    o hasta 'timeout' segundos. Devuelve True si llegó correo nuevo.
+    imaplib (3.11) no trae IDLE: se habla el protocolo con send() / readline() (API pública),
+    con tag propio y SIEMPRE sobre el mismo file de la sesión (no se pierde nada ya leído).
+    El timeout no corta la lectura: un timer manda DONE y se lee hasta la respuesta
+    etiquetada, igual que tras un EXISTS. Si ni así contesta, el socket vence y la sesión
+    se descarta (la reconecta idle_loop).
+    """
+    tag = f"IDLE{next(IDLE_TAGS)}".encode()
+    done_lock = threading.Lock()
+    done_sent = []
+
+    def send_done():
+        with done_lock:
+            if not done_sent:
+                done_sent.append(True)
+                mail.send(b"DONE\r\n")
+
+    got_new = False
+    mail.send(tag + b" IDLE\r\n")
+    line = mail.readline()
+    while not line.startswith(b"+"):
+        if not line or line.startswith(tag + b" "):
+            raise mail.error(f"IDLE rechazado: {line!r}")
+        got_new = got_new or bool(EXISTS_RE.match(line))
+        line = mail.readline()
+
+    timer = threading.Timer(timeout, send_done)
+    timer.daemon = True
+    mail.socket().settimeout(timeout + IDLE_DONE_GRACE_SECONDS)
+    timer.start()
     try:
-        msg_ids = fetch_recent_any(mail, days_back=DAYS_BACK)
-        if msg_ids:
-            print(f"Encontrados {len(msg_ids)} correo(s) en el rango.")
-            sent = 0
-            skipped = 0
-            for msg_id in msg_ids:
-                ok = process_message(mail, msg_id, processed_keys)
-                if ok:
-                    sent += 1
-                else:
-                    skipped += 1
-            print(f"Resumen check: enviadas={sent} | saltadas={skipped}")
-        else:
-            print("Sin correos en el rango.")
+        while True:
+            line = mail.readline()
+            if not line:
+                raise mail.abort("conexión cerrada durante IDLE")
+            if line.startswith(tag + b" "):
+                break
+            if EXISTS_RE.match(line):
+                got_new = True
+                send_done()
+            # EXPUNGE / FETCH (flags) de otros clientes: se ignoran
     finally:
-        mail.logout()
-        print("Desconectado de IMAP.")
+        timer.cancel()
+    mail.socket().settimeout(None)
 
+    if not line[len(tag):].strip().upper().startswith(b"OK"):
+        raise mail.error(f"IDLE terminó con error: {line!r}")
+    return got_new
+
+
+def idle_loop() -> bool:
+    """
+    Modo push: mantiene UNA sesión con INBOX seleccionado, espera en IDLE
+    y al despertar (EXISTS o timeout) procesa solo lo nuevo (checkpoint UID).
+    Devuelve False si el servidor no soporta IDLE (=> usar polling).
+    """
+    session = IMAP_SESSION
+    mbox = session.mbox or DEFAULT_MAILBOX
+    while True:
+        try:
+            mail = session.get()
+        except Exception as e:
+            print("Error conectando para IDLE:", e)
+            session.last_error = str(e)
+            time.sleep(IDLE_RECONNECT_SECONDS)
+            continue
+
+        try:
+            if not supports_idle(mail):
+                print("El servidor no soporta IDLE. Usando polling (ventana/pausa).")
+                return False
+
+            print("Conectado en modo IDLE. Sincronizando pendientes…")
+            sync_session(session, mail, mbox)
+
+            while True:
+                print(f"IDLE: esperando correo nuevo (máx {IDLE_TIMEOUT_SECONDS}s)…")
+                got_new = idle_wait(mail, IDLE_TIMEOUT_SECONDS)
+                now_lima = datetime.now(LIMA_TZ)
+                if got_new:
+                    print(f"IDLE: correo nuevo a las {now_lima.isoformat()} (hora Lima)")
+                else:
+                    print("IDLE: timeout sin novedades, re-sincronizando por si acaso…")
+                sync_session(session, mail, mbox)
+                print(f"Sesión IMAP: {session.stats()}")
+        except Exception as e:
+            print("Error en modo IDLE, reconectando:", e)
+            session.last_error = str(e)
+            session.close()
+            time.sleep(IDLE_RECONNECT_SECONDS)
+
+
+def adaptive_poll_loop():
+    """
+    Polling con intervalo adaptativo (ver PollScheduler): corto en horas de
+    muchas alarmas y justo después de una, largo (backoff) cuando no llega nada.
+    """
+    mbox = DEFAULT_MAILBOX
+    print(f"Polling adaptativo: {mbox.scheduler.min_seconds}-{mbox.scheduler.max_seconds}s (hora Lima)")
+    while True:
+        try:
+            check_mail_once()
+        except Exception as e:
+            print("Error en check_mail_once():", e)
+
+        interval = mbox.scheduler.record(mbox.metrics["lastArrivals"])
+        rate = mbox.metrics.get("arrivalRatePerHour")
+        print(f"Próximo chequeo en {interval}s (llegadas={mbox.metrics['lastArrivals']} | "
+              f"tasa esperada={rate if rate is not None else 'sin historia'}/h | "
+              f"polls vacíos seguidos={mbox.scheduler.empty_streak})")
+        time.sleep(interval)
+
+
+def poll_loop():
+    if POLL_SCHEDULER == "adaptive":
+        adaptive_poll_loop()
+        return
 
-def main():
-    print(f"Listener iniciado. ALLOWED_TYPES={sorted(ALLOWED_TYPES)} | DAYS_BACK={DAYS_BACK}")
     while True:
         # ===== Ventana activa =====
         window_start = datetime.now(timezone.utc)
@@ -581,5 +1371,217 @@ def main():
         time.sleep(SLEEP_BETWEEN_CYCLES_SECONDS)
 
 
+# ---------- FAN-IN (varios buzones en un proceso) ----------
+
+def load_mailboxes_config(path: str) -> list:
+    """
+    Lee la lista de buzones desde un JSON:
+      {"mailboxes": [
+        {"name": "empresa2", "user": "alertas2@gmail.com", "passwordEnv": "GMAIL_PASS_2",
+         "folder": "INBOX", "companyId": 2, "apiBase": "https://samloto.com:4016"},
+        ...
+      ]}
+    (también vale una lista directa). Lo que falte se toma de las variables de entorno.
+    La contraseña puede ir en "password" o, mejor, en una variable de entorno ("passwordEnv").
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    entries = data.get("mailboxes", []) if isinstance(data, dict) else data
+
+    mailboxes = []
+    for i, entry in enumerate(entries, start=1):
+        password = entry.get("password")
+        if entry.get("passwordEnv"):
+            password = os.environ.get(entry["passwordEnv"], password)
+        mailboxes.append(Mailbox(
+            name=str(entry.get("name") or f"buzon{i}"),
+            user=entry.get("user", GMAIL_USER),
+            password=password or GMAIL_PASS,
+            folder=entry.get("folder", IMAP_FOLDER),
+            company_id=int(entry.get("companyId", COMPANY_ID)),
+            api_base=entry.get("apiBase", API_BASE_URL),
+            host=entry.get("host", IMAP_HOST),
+            port=int(entry.get("port", IMAP_PORT)),
+            ssl=bool(entry.get("ssl", IMAP_SSL)),
+        ))
+
+    names = [m.name for m in mailboxes]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Nombres de buzón repetidos en {path}: {names}")
+    return mailboxes
+
+
+def check_mailbox(mbox) -> None:
+    """
+    Un chequeo de un buzón (lo corre el pool del fan-in) + métricas propias.
+    """
+    t0 = time.monotonic()
+    try:
+        check_mail_once(mbox.session)
+    except Exception as e:
+        mbox.metrics["errors"] += 1
+        print(f"Error en check de {mbox.label}:", e)
+    finally:
+        mbox.metrics["checks"] += 1
+        mbox.metrics["lastCheck"] = datetime.now(LIMA_TZ).isoformat()
+        mbox.metrics["lastCheckSeconds"] = round(time.monotonic() - t0, 3)
+        if POLL_SCHEDULER == "adaptive":
+            interval = mbox.scheduler.record(mbox.metrics["lastArrivals"])
+        else:
+            interval = POLL_INTERVAL_SECONDS
+        mbox.next_check = time.monotonic() + interval
+
+
+def fanin_loop(mailboxes: list):
+    """
+    Un solo planificador para todos los buzones: cuando le toca a un buzón
+    (intervalo propio, ver PollScheduler) se encola su chequeo en un pool de
+    FANIN_WORKERS hilos (nunca dos chequeos del mismo buzón a la vez). Con
+    CONDSTORE un buzón sin novedades cuesta un NOOP + un FETCH CHANGEDSINCE vacío.
+    """
+    print(f"Fan-in: {len(mailboxes)} buzón(es) | workers={FANIN_WORKERS} | planificador={POLL_SCHEDULER}")
+    for mbox in mailboxes:
+        print(f"  - {mbox.label}: {mbox.user} / {mbox.folder} -> companyId={mbox.company_id} ({mbox.endpoint}) "
+              f"| poll {mbox.scheduler.min_seconds}-{mbox.scheduler.max_seconds}s")
+
+    pool = ThreadPoolExecutor(max_workers=FANIN_WORKERS)
+    running = {}
+    next_report = time.monotonic() + FANIN_REPORT_SECONDS
+
+    while True:
+        now = time.monotonic()
+        for name, future in list(running.items()):
+            if future.done():
+                del running[name]
+
+        for mbox in mailboxes:
+            if mbox.name not in running and mbox.next_check <= now:
+                running[mbox.name] = pool.submit(check_mailbox, mbox)
+
+        if now >= next_report:
+            print("=" * 60)
+            print("Métricas por buzón:")
+            for mbox in mailboxes:
+                print(f"  {json.dumps(mbox.stats(), ensure_ascii=False)}")
+            next_report = now + FANIN_REPORT_SECONDS
+
+        idle_for = min((m.next_check for m in mailboxes if m.name not in running), default=now + 1) - now
+        time.sleep(min(max(idle_for, 0.2), 1.0))
+
+
+# ---------- MODO --replay (mbox / Maildir / .eml, sin IMAP) ----------
+
+def run_replay(path: str, processed_keys: set, mbox=None):
+    """
+    Mismas reglas que el listener (process_message) sobre un export local, sin ventana
+    DAYS_BACK: se procesa todo el export. Devuelve (total, enviadas, saltadas).
+    """
+    total = sent = skipped = 0
+    for ref, raw in iter_replay_messages(path):
+        total += 1
+        ok = process_message(None, ref, parse_message_lazy(raw), processed_keys, mbox=mbox)
+        if ok:
+            sent += 1
+        else:
+            skipped += 1
+    return total, sent, skipped
+
+
+# ---------- MODO SMTP / LMTP (el correo llega directo, sin poll) ----------
+
+def ingest_smtp_message(raw: bytes, ref: str):
+    """
+    Handler del receptor SMTP: mismas reglas que IMAP (dedupe, filtro, API).
+    El correo ya está en la cola de disco; True/False = terminado, None = reintentar.
+    """
+    return process_message(None, ref, parse_message_lazy(raw), load_processed_keys(), mbox=DEFAULT_MAILBOX)
+
+
+def start_smtp_server(listen: str) -> SmtpIngestServer:
+    host, port = parse_listen(listen)
+    server = SmtpIngestServer(
+        (host, port), ingest_smtp_message, SMTP_QUEUE_DIR,
+        workers=SMTP_WORKERS, max_bytes=SMTP_MAX_MB * 1048576, retry_seconds=SMTP_RETRY_SECONDS,
+        max_attempts=SMTP_MAX_ATTEMPTS,
+    )
+    threading.Thread(target=server.serve_forever, name="smtp-ingest", daemon=True).start()
+    print(f"Receptor SMTP/LMTP en {host}:{server.server_address[1]} | cola: {SMTP_QUEUE_DIR} | workers={SMTP_WORKERS}")
+    return server
+
+
+def smtp_loop(listen: str):
+    server = start_smtp_server(listen)
+    try:
+        while True:
+            time.sleep(FANIN_REPORT_SECONDS)
+            print(f"SMTP: {server.stats_snapshot()}")
+            save_templates()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+def main():
+    global NDJSON_SINK
+    mailboxes_file = MAILBOXES_FILE
+    if "--mailboxes" in sys.argv:
+        idx = sys.argv.index("--mailboxes")
+        if idx + 1 < len(sys.argv):
+            mailboxes_file = sys.argv[idx + 1]
+
+    smtp_listen = SMTP_LISTEN
+    if "--smtp" in sys.argv:
+        idx = sys.argv.index("--smtp")
+        smtp_listen = sys.argv[idx + 1] if idx + 1 < len(sys.argv) else "127.0.0.1:2525"
+
+    if "--bench-query" in sys.argv:
+        mail = connect()
+        try:
+            date_from = (datetime.now() - timedelta(days=DAYS_BACK)).strftime("%d-%b-%Y")
+            SERVER_QUERY.benchmark(mail, ["SINCE", date_from])
+        finally:
+            mail.logout()
+        return
+
+    replay_path, ndjson_path = replay_options(sys.argv)
+    if replay_path:
+        # a NDJSON: corrida "en seco" y determinística (ni lee ni escribe caches)
+        if ndjson_path:
+            NDJSON_SINK = NdjsonSink(ndjson_path)
+            processed_keys = set()
+        else:
+            processed_keys = load_processed_keys()
+            print(f"Claves ya procesadas hoy: {len(processed_keys)}")
+            load_templates()
+        print(f"Replay offline desde {replay_path}")
+        t0 = time.perf_counter()
+        try:
+            total, sent, skipped = run_replay(replay_path, processed_keys)
+        finally:
+            if NDJSON_SINK is not None:
+                NDJSON_SINK.close()
+        print("=" * 60)
+        print(format_replay_stats(total, sent, skipped, time.perf_counter() - t0, NDJSON_SINK))
+        print(format_fast_path_stats())
+        print(format_template_stats(TEMPLATES))
+        if not ndjson_path:
+            save_templates()
+        return
+
+    load_templates()
+    if smtp_listen:
+        print(f"Listener iniciado (SMTP/LMTP). ALLOWED_TYPES={sorted(ALLOWED_TYPES)}")
+        smtp_loop(smtp_listen)
+        return
+
+    print(f"Listener iniciado. ALLOWED_TYPES={sorted(ALLOWED_TYPES)} | DAYS_BACK={DAYS_BACK} | MODE={LISTENER_MODE}")
+    if mailboxes_file:
+        # Varios buzones: polling compartido (IDLE necesitaría una conexión bloqueada por buzón)
+        fanin_loop(load_mailboxes_config(mailboxes_file))
+        return
+    if LISTENER_MODE in ("auto", "idle"):
+        idle_loop()
+    poll_loop()
+
+
 if __name__ == "__main__":
     main()
@@ -4,19 +4,41 @@ import email
 from email.header import decode_header
 from email.utils import parsedate_to_datetime
 import os
+import sys
+import time
 from datetime import datetime, timedelta, timezone
 import re
 import json
 import glob
-import html as html_lib
+import asyncio
+import queue
+import threading
 
 import requests  # pip install requests
 
+import imap_async  # cliente IMAP asyncio (modo --async)
+from imap_compress import enable_compression, compression_stats, format_compression_stats  # COMPRESS=DEFLATE
+from raw_spool import RawSpool, format_spool_stats  # spool local de correos crudos
+from mail_replay import replay_options, iter_replay_messages, NdjsonSink, format_replay_stats  # --replay
+from mime_body import parse_message_lazy, extract_body_text  # cuerpo en una pasada, adjuntos sin decodificar
+from html_text import body_to_text  # HTML -> texto (mismo resultado que la copia anterior)
+from alert_fields import extract_fields, EVENT_TIME_RE  # planta / área / operador en una pasada
+from alert_keywords import (  # palabras clave: filtro, tipo y severidad en un módulo
+    RELEVANT_STEMS, KeywordScan, canonical_alert_type, guess_allowed_type, guess_severity, is_checklist, is_relevant,
+)
+from alert_templates import TemplateRegistry, message_origin, format_template_stats  # plantillas aprendidas
+from imap_fetch import (  # FETCH por lotes, pre-filtros de dedupe y filtro de SEARCH
+    ImapFetcher, ServerQuery, compact_id_set, flag_seen_batch, parse_gmids, parse_header_keys, parse_raw_messages,
+    parse_text_parts, parse_text_sections, text_part_items,
+)
+
 # =============== CONFIG ===============
 GMAIL_USER = os.environ.get("GMAIL_USER", "yap32k@gmail.com")  # (Reemplazar por la real)
 GMAIL_PASS = os.environ.get("GMAIL_PASS", "intn rkry alig xhtl")  # app password (NO hardcodear)
 
-IMAP_HOST = "imap.gmail.com"
+IMAP_HOST = os.environ.get("ALERT_IMAP_HOST", "imap.gmail.com")
+IMAP_PORT = int(os.environ.get("ALERT_IMAP_PORT", "993"))
+IMAP_SSL = os.environ.get("ALERT_IMAP_SSL", "1") == "1"  # 0 = IMAP plano (ej. imap_standin.py local)
 IMAP_FOLDER = "INBOX"
 
 API_BASE_URL = os.environ.get("ALERT_API_BASE", "https://samloto.com:4016")
@@ -33,6 +55,75 @@ FORCE_MONTH = os.environ.get("ALERT_MONTH")
 
 # SOLO estos tipos se guardan en /api/alerts
 ALLOWED_TYPES = {"IMPACTO", "FRENADA", "ACELERACION"}
+
+# Descarga por lotes: el tamaño del lote se adapta al tamaño promedio de los correos
+FETCH_BATCH_INITIAL = int(os.environ.get("FETCH_BATCH_INITIAL", "50"))
+FETCH_BATCH_MIN = int(os.environ.get("FETCH_BATCH_MIN", "10"))
+FETCH_BATCH_MAX = int(os.environ.get("FETCH_BATCH_MAX", "500"))
+FETCH_BATCH_TARGET_BYTES = int(os.environ.get("FETCH_BATCH_TARGET_BYTES", str(4 * 1024 * 1024)))  # ~4 MB por FETCH
+# parts = BODYSTRUCTURE + solo la parte de texto que usa el parser | full = RFC822 completo
+FETCH_MODE = os.environ.get("ALERT_FETCH_MODE", "parts").strip().lower()
+
+# Pre-filtro por cabeceras (dedupe sin bajar el cuerpo)
+HEADER_PREFETCH_FIELDS = "(MESSAGE-ID SUBJECT DATE FROM)"
+HEADER_BATCH_SIZE = int(os.environ.get("HEADER_BATCH_SIZE", "500"))
+
+# En Gmail (X-GM-EXT-1): atajo de dedupe por X-GM-MSGID (descarta lo ya procesado sin bajar cabeceras).
+# La identidad sigue siendo la clave de cache (Message-ID); el mapa X-GM-MSGID -> clave es aparte.
+USE_GMAIL_MSGID = os.environ.get("ALERT_USE_GMAIL_MSGID", "1") == "1"
+
+# COMPRESS=DEFLATE (RFC 4978) si el servidor lo ofrece (ver imap_compress.py)
+USE_COMPRESS = os.environ.get("ALERT_IMAP_COMPRESS", "1") == "1"
+
+# Modo --async (imap_async.py): comandos en vuelo por conexión, tamaño de lote y workers de envío.
+# Solo el backfill del mes: el listener trae pocos correos por poll y no gana con el pipelining.
+ASYNC_PIPELINE_DEPTH = int(os.environ.get("ASYNC_PIPELINE_DEPTH", "4"))
+ASYNC_FETCH_BATCH = int(os.environ.get("ASYNC_FETCH_BATCH", "100"))
+ASYNC_SEND_WORKERS = int(os.environ.get("ASYNC_SEND_WORKERS", "4"))
+
+# Modo --shards: el mes se parte por día y cada día lo procesa un worker con su propia conexión
+SHARD_WORKERS = int(os.environ.get("ALERT_SHARD_WORKERS", "4"))
+
+# \Seen de lo entregado: un STORE por lote (no uno por alerta)
+SEEN_FLUSH_SIZE = int(os.environ.get("ALERT_SEEN_FLUSH_SIZE", "200"))
+
+# Spool local de correos crudos (ver raw_spool.py): lo bajado una vez se relee de disco
+# en las siguientes corridas. Con spool activo se baja el RFC822 completo (para guardarlo).
+USE_SPOOL = os.environ.get("ALERT_SPOOL", "0") == "1"
+SPOOL_DIR = os.environ.get("ALERT_SPOOL_DIR", os.path.join("cache", "spool"))
+SPOOL_MAX_MB = int(os.environ.get("ALERT_SPOOL_MAX_MB", "1024"))
+SPOOL_MAX_DAYS = int(os.environ.get("ALERT_SPOOL_MAX_DAYS", "60"))
+SPOOL = RawSpool(SPOOL_DIR, SPOOL_MAX_MB * 1048576, SPOOL_MAX_DAYS * 86400) if USE_SPOOL else None
+
+FETCHER = ImapFetcher(
+    FETCH_MODE, FETCH_BATCH_INITIAL, FETCH_BATCH_MIN, FETCH_BATCH_MAX, FETCH_BATCH_TARGET_BYTES,
+    HEADER_PREFETCH_FIELDS, HEADER_BATCH_SIZE, spool=SPOOL,
+)
+
+# asunto primero: correos resueltos sin decodificar el cuerpo / con cuerpo (solo para el resumen)
+FAST_PATH = {"subjectOnly": 0, "withBody": 0}
+
+# Registro de plantillas (ver alert_templates.py): planta / área / operador / Fecha-Hora
+# desde el plan aprendido para cada remitente + formato de cuerpo, guardado en cache/alert_templates.json.
+# 0 = siempre el parser genérico
+USE_TEMPLATES = os.environ.get("ALERT_TEMPLATES", "1") == "1"
+TEMPLATES = TemplateRegistry(int(os.environ.get("ALERT_TEMPLATES_MAX", "256"))) if USE_TEMPLATES else None
+
+# Filtro del lado del servidor (para que SEARCH devuelva solo candidatos a alarma), opcional:
+#   none  = sin filtro: SEARCH trae todo el rango y se filtra en el cliente (default)
+#   imap  = OR TEXT "<raíz>" ... con las raíces del filtro del cliente (RELEVANT_STEMS)
+#   gmraw = X-GM-RAW (Gmail) | auto = gmraw si el servidor es Gmail (X-GM-EXT-1), si no imap
+# OJO: Gmail busca por palabra completa (también con TEXT): 'fren' no encuentra 'frenazo' y
+# 'frenada' no encuentra 'FRENO'. En Gmail cualquier filtro de servidor puede perder alarmas.
+SERVER_QUERY_MODE = os.environ.get("ALERT_SERVER_QUERY", "none").strip().lower()
+SERVER_QUERY_KEYWORDS = [
+    k.strip() for k in os.environ.get("ALERT_SERVER_KEYWORDS", ",".join(RELEVANT_STEMS)).split(",") if k.strip()
+]  # solo ASCII
+GMAIL_RAW_QUERY = os.environ.get(
+    "ALERT_GMAIL_RAW_QUERY", "alarma OR checklist OR impacto OR frenada OR frenado OR aceleracion"
+)
+SERVER_FROM_FILTER = os.environ.get("ALERT_FROM_FILTER", "")  # ej: "geomov" (vacío = cualquier remitente)
+SERVER_QUERY = ServerQuery(SERVER_QUERY_MODE, SERVER_QUERY_KEYWORDS, GMAIL_RAW_QUERY, SERVER_FROM_FILTER)
 # ======================================
 
 
@@ -50,8 +141,13 @@ def decode_maybe(encoded_header):
 
 
 def connect():
-    mail = imaplib.IMAP4_SSL(IMAP_HOST)
+    if IMAP_SSL:
+        mail = imaplib.IMAP4_SSL(IMAP_HOST, IMAP_PORT)
+    else:
+        mail = imaplib.IMAP4(IMAP_HOST, IMAP_PORT)
     mail.login(GMAIL_USER, GMAIL_PASS)
+    if USE_COMPRESS:
+        enable_compression(mail)
     mail.select(IMAP_FOLDER)
     return mail
 
@@ -79,11 +175,12 @@ def fetch_month_any(mail, month_start_lima: datetime, next_month_start_lima: dat
     """
     Devuelve IDs de correos (leídos y no leídos) del mes.
     IMAP usa rango por día: SINCE start, BEFORE end
+    (+ filtro del servidor, ver ServerQuery en imap_fetch.py)
     """
     date_from = imap_date(month_start_lima)
     date_to = imap_date(next_month_start_lima)
 
-    status, data = mail.search(None, "SINCE", date_from, "BEFORE", date_to)
+    status, data = mail.search(None, "SINCE", date_from, "BEFORE", date_to, *SERVER_QUERY.criteria(mail))
     if status != "OK":
         print("Error al buscar mensajes del mes:", status)
         return []
@@ -104,6 +201,45 @@ def get_message_datetime(msg):
         return datetime.now(timezone.utc)
 
 
+# ---------- X-GM-MSGID (dedupe compacto en Gmail) ----------
+
+def supports_gmail_ext(mail) -> bool:
+    return USE_GMAIL_MSGID and "X-GM-EXT-1" in mail.capabilities
+
+
+def load_gmid_map(path: str) -> dict:
+    """
+    Mapa { X-GM-MSGID (str) -> clave de cache (Message-ID) } de mensajes ya procesados.
+    Las entradas de otras empresas del listener van con prefijo ("2|...") y no coinciden.
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except Exception:
+        return {}
+
+
+def save_gmid_map(path: str, mapping: dict):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(mapping, f, ensure_ascii=False, indent=2, sort_keys=True)
+
+
+# ---------- CLAVE DE CACHE (la usa también el pre-filtro por cabeceras) ----------
+
+def build_cache_key(message_id: str, subject: str, msg_dt_utc: datetime) -> str:
+    return message_id or f"{subject}|{msg_dt_utc.isoformat()}"
+
+
+def header_cache_key(header_bytes: bytes) -> str:
+    msg = email.message_from_bytes(header_bytes)
+    subject = decode_maybe(msg.get("Subject"))
+    message_id = (msg.get("Message-ID") or "").strip()
+    return build_cache_key(message_id, subject, get_message_datetime(msg))
+
+
 # ---------- CACHÉS (diario + mensual) ----------
 
 def ensure_cache_dir():
@@ -122,6 +258,31 @@ def month_cache_path(year: int, month: int):
     return os.path.join(CACHE_DIR, f"alerts_cache_month_{year}{month:02d}.json")
 
 
+def month_gmid_map_path(year: int, month: int):
+    ensure_cache_dir()
+    return os.path.join(CACHE_DIR, f"alerts_gmid_month_{year}{month:02d}.json")
+
+
+def get_templates_path():
+    ensure_cache_dir()
+    return os.path.join(CACHE_DIR, "alert_templates.json")
+
+
+def load_templates():
+    """
+    Planes de plantillas aprendidos en corridas anteriores (listener y backfill comparten el archivo).
+    """
+    if TEMPLATES is not None:
+        loaded = TEMPLATES.load(get_templates_path())
+        if loaded:
+            print(f"Plantillas cargadas de cache: {loaded}")
+
+
+def save_templates():
+    if TEMPLATES is not None:
+        TEMPLATES.save(get_templates_path())
+
+
 def load_cache_file(path: str) -> set:
     if not os.path.exists(path):
         return set()
@@ -134,6 +295,8 @@ def load_cache_file(path: str) -> set:
 
 
 def append_cache_key(path: str, cache_key: str):
+    if NDJSON_SINK is not None:
+        return  # replay a NDJSON: no se marca nada como procesado
     keys = load_cache_file(path)
     if cache_key in keys:
         return
@@ -165,107 +328,44 @@ def load_all_month_daily_caches(year: int, month: int) -> set:
     return all_keys
 
 
-# ---------- PARSEO DEL CORREO ----------
-
-def extract_body_text(msg):
-    if msg.is_multipart():
-        for part in msg.walk():
-            content_type = part.get_content_type()
-            content_disp = str(part.get("Content-Disposition", ""))
-            if content_type == "text/plain" and "attachment" not in content_disp:
-                try:
-                    return part.get_payload(decode=True).decode(
-                        part.get_content_charset() or "utf-8",
-                        errors="ignore",
-                    )
-                except Exception:
-                    pass
-        for part in msg.walk():
-            content_type = part.get_content_type()
-            content_disp = str(part.get("Content-Disposition", ""))
-            if content_type == "text/html" and "attachment" not in content_disp:
-                try:
-                    return part.get_payload(decode=True).decode(
-                        part.get_content_charset() or "utf-8",
-                        errors="ignore",
-                    )
-                except Exception:
-                    pass
-        return ""
-    else:
-        try:
-            return msg.get_payload(decode=True).decode(
-                msg.get_content_charset() or "utf-8",
-                errors="ignore",
-            )
-        except Exception:
-            return ""
-
-
-def looks_like_html(s: str) -> bool:
-    if not s:
-        return False
-    low = s.lower()
-    return "<html" in low or "<body" in low or "<br" in low or "</div" in low or "<p" in low
+def month_shard_state_path(year: int, month: int):
+    ensure_cache_dir()
+    return os.path.join(CACHE_DIR, f"backfill_shards_{year}{month:02d}.json")
 
 
-def html_to_text(s: str) -> str:
+def load_shard_state(path: str) -> dict:
     """
-    Convierte HTML básico a texto para poder parsear campos (Área, Planta, Operador, etc).
-    Sin dependencias externas.
+    Checkpoint de --shards: { "YYYY-MM-DD": {"done": bool, "found": n, "sent": n, "skipped": n} }
     """
-    if not s:
-        return ""
-
-    s = re.sub(r"(?i)<br\s*/?>", "\n", s)
-    s = re.sub(r"(?i)</p\s*>", "\n", s)
-    s = re.sub(r"(?i)</div\s*>", "\n", s)
-
-    s = re.sub(r"<[^>]+>", " ", s)
-    s = html_lib.unescape(s)
-
-    s = s.replace("\xa0", " ")
-    s = re.sub(r"[ \t]+", " ", s)
-    s = re.sub(r"\n\s*\n+", "\n", s)
-
-    return s.strip()
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except Exception:
+        return {}
 
 
-def normalize_alert_text(s: str) -> str:
-    if not s:
-        return ""
-    x = s.strip().upper()
-    x = (x.replace("Ó", "O")
-           .replace("Á", "A")
-           .replace("É", "E")
-           .replace("Í", "I")
-           .replace("Ú", "U"))
-    return x
+def save_shard_state(path: str, state: dict):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2, sort_keys=True)
 
 
-def canonical_alert_type(s: str) -> str:
+def load_all_month_gmid_maps(year: int, month: int) -> dict:
     """
-    Mapea variaciones a los 3 tipos permitidos:
-      - cualquier cosa que contenga IMPACTO => IMPACTO
-      - que contenga FREN (FRENADA, FRENADO, etc) => FRENADA
-      - que contenga ACELER (ACELERACION, ACELERACIÓN, etc) => ACELERACION
+    X-GM-MSGID ya procesados: mapas diarios del listener + mapa mensual.
     """
-    x = normalize_alert_text(s)
-    if "IMPACTO" in x:
-        return "IMPACTO"
-    if "FREN" in x:
-        return "FRENADA"
-    if "ACELER" in x:
-        return "ACELERACION"
-    return ""
-
+    ensure_cache_dir()
+    pattern = os.path.join(CACHE_DIR, f"alerts_gmid_{year}{month:02d}*.json")
+    mapping = {}
+    for fp in glob.glob(pattern):
+        mapping.update(load_gmid_map(fp))
+    mapping.update(load_gmid_map(month_gmid_map_path(year, month)))
+    return mapping
 
-def guess_allowed_type(subject: str, body_text: str) -> str:
-    t = canonical_alert_type(subject or "")
-    if t:
-        return t
-    return canonical_alert_type(body_text or "")
 
+# ---------- PARSEO DEL CORREO ----------
 
 def parse_subject(subject: str):
     alert_type = None
@@ -299,82 +399,8 @@ def parse_subject(subject: str):
     return alert_type, vehicle_code, license_plate, template_source
 
 
-def parse_plant(body_text: str):
-    if not body_text:
-        return None
-
-    for line in body_text.splitlines():
-        line_clean = line.strip()
-        m = re.search(r"(Planta|Sede)\s*:\s*(.+)", line_clean, re.IGNORECASE)
-        if m:
-            val = m.group(2).strip()
-            val = re.split(r"\s{2,}|\t|\|", val)[0].strip()
-            return val or None
-
-    m2 = re.search(r"(Planta|Sede)\s*:\s*([^\n\r]+)", body_text, re.IGNORECASE)
-    if m2:
-        val = m2.group(2).strip()
-        val = re.split(r"\s{2,}|\t|\|", val)[0].strip()
-        return val or None
-
-    return None
-
-
-def parse_area(body_text: str):
-    if not body_text:
-        return None
-
-    for line in body_text.splitlines():
-        line_clean = line.strip()
-        if not line_clean:
-            continue
-
-        m = re.search(
-            r"(?:\bÁrea\b|\bArea\b|\bZona\b|\bUbicación\b|\bUbicacion\b|\bLugar\b)\s*:\s*(.+)",
-            line_clean,
-            re.IGNORECASE,
-        )
-        if m:
-            val = m.group(1).strip()
-            val = re.split(r"\s{2,}|\t|\|", val)[0].strip()
-            return val or None
-
-    m2 = re.search(
-        r"(?:\bÁrea\b|\bArea\b|\bZona\b|\bUbicación\b|\bUbicacion\b|\bLugar\b)\s*:\s*([^\n\r]+)",
-        body_text,
-        re.IGNORECASE,
-    )
-    if m2:
-        val = m2.group(1).strip()
-        val = re.split(r"\s{2,}|\t|\|", val)[0].strip()
-        return val or None
-
-    return None
-
-
-def parse_operator(body_text: str):
-    operator_name = None
-    operator_id = None
-
-    for line in body_text.splitlines():
-        line_clean = line.strip()
-        m_name = re.search(r"Operador\s*:\s*(.+)", line_clean, re.IGNORECASE)
-        if m_name and not operator_name:
-            operator_name = m_name.group(1).strip()
-
-        m_id = re.search(r"(ID\s*Operador|DNI)\s*:\s*(.+)", line_clean, re.IGNORECASE)
-        if m_id and not operator_id:
-            operator_id = m_id.group(2).strip()
-
-    return operator_name, operator_id
-
-
 def parse_event_time_from_body(body_text: str, fallback_dt_utc: datetime):
-    pattern = re.compile(
-        r"(?:Alarma\s+Fecha|Fecha)\s*:\s*([0-9]{2}-[A-Za-z]{3}-[0-9]{4}).*?Hora\s*:\s*([0-9]{2}:[0-9]{2})",
-        re.IGNORECASE | re.DOTALL,
-    )
-    match = pattern.search(body_text)
+    match = EVENT_TIME_RE.search(body_text)
     if not match:
         return fallback_dt_utc
 
@@ -403,36 +429,33 @@ def parse_event_time_from_body(body_text: str, fallback_dt_utc: datetime):
         return fallback_dt_utc
 
 
-def guess_severity(alert_type: str, body_text: str) -> str:
-    t = normalize_alert_text(alert_type or "")
-    text = (body_text or "").lower()
-
-    if "sin condiciones" in text or "bloquea" in text:
-        return "BLOQUEA_OPERACION"
-    if "IMPACTO" in t:
-        return "CRITICAL"
-    if "FREN" in t or "ACELER" in t:
-        return "WARNING"
-    return "INFO"
-
-
-def build_alert_payload(subject: str, body_text: str, msg_dt_utc: datetime) -> dict:
+def build_alert_payload(subject: str, body_text: str, msg_dt_utc: datetime, keywords=None,
+                        origin=None) -> dict:
+    """
+    'keywords' = (KeywordScan del asunto, KeywordScan del cuerpo) que ya armó el filtro, para no repetir búsquedas.
+    'origin' = message_origin(From, Message-ID): con TEMPLATES activo, los campos salen del plan de esa plantilla.
+    """
     alert_type_raw, vehicle_code, license_plate, template_source = parse_subject(subject)
 
-    parse_text = html_to_text(body_text) if looks_like_html(body_text) else (body_text or "")
+    parse_text = body_to_text(body_text)
+
+    if TEMPLATES is not None and origin is not None:
+        (plant, area, operator_name, operator_id), event_text = TEMPLATES.extract(origin, parse_text)
+    else:
+        (plant, area, operator_name, operator_id), event_text = extract_fields(parse_text), parse_text
 
-    plant = parse_plant(parse_text)
-    area = parse_area(parse_text)
-    operator_name, operator_id = parse_operator(parse_text)
+    event_time_dt = parse_event_time_from_body(event_text, msg_dt_utc)
 
-    event_time_dt = parse_event_time_from_body(parse_text, msg_dt_utc)
+    subject_kw, body_kw = keywords or (KeywordScan(subject), None)
+    # cuerpo sin HTML: parse_text ES el cuerpo, sirve la misma búsqueda
+    parse_kw = body_kw if body_kw is not None and parse_text is body_kw.text else KeywordScan(parse_text)
 
     # Tipificación SOLO a los permitidos (o DESCONOCIDO)
     alert_type = canonical_alert_type(alert_type_raw or "")
     if not alert_type:
-        alert_type = guess_allowed_type(subject, parse_text) or "DESCONOCIDO"
+        alert_type = guess_allowed_type(subject_kw, parse_kw) or "DESCONOCIDO"
 
-    severity = guess_severity(alert_type, parse_text)
+    severity = guess_severity(alert_type, parse_kw)
 
     if not vehicle_code:
         vehicle_code = "UNKNOWN"
@@ -475,7 +498,13 @@ def build_alert_payload(subject: str, body_text: str, msg_dt_utc: datetime) -> d
     }
 
 
+# --ndjson: los payloads van a un archivo en vez de a la API (ver mail_replay.py)
+NDJSON_SINK = None
+
+
 def send_alert_to_api(payload: dict) -> bool:
+    if NDJSON_SINK is not None:
+        return NDJSON_SINK.write(payload)
     try:
         resp = requests.post(ALERT_ENDPOINT, json=payload, timeout=15)
         if 200 <= resp.status_code < 300:
@@ -488,110 +517,648 @@ def send_alert_to_api(payload: dict) -> bool:
         return False
 
 
-def cache_as_processed(cache_key: str, processed_keys: set, month_cache_fp: str, today_cache_fp: str):
+# Con --shards varios hilos comparten processed_keys / gmid_map / archivos de cache
+CACHE_LOCK = threading.Lock()
+IN_FLIGHT_KEYS = set()  # claves que se están enviando ahora (para no duplicar entre hilos)
+PRINT_LOCK = threading.Lock()
+
+
+def cache_as_processed(cache_key: str, processed_keys: set, month_cache_fp: str, today_cache_fp: str,
+                       gmid: str = None, gmid_map: dict = None):
     """
     Marca el mensaje como procesado (aunque NO se haya enviado a la API),
     para que no se re-procese en re-ejecuciones.
     """
-    append_cache_key(month_cache_fp, cache_key)
-    append_cache_key(today_cache_fp, cache_key)
-    processed_keys.add(cache_key)
+    with CACHE_LOCK:
+        append_cache_key(month_cache_fp, cache_key)
+        append_cache_key(today_cache_fp, cache_key)
+        processed_keys.add(cache_key)
+        if gmid is not None and gmid_map is not None:
+            gmid_map[gmid] = cache_key
 
 
-def process_message(mail, msg_id, processed_keys: set, month_cache_fp: str, today_cache_fp: str):
-    status, msg_data = mail.fetch(msg_id, "(RFC822)")
-    if status != "OK":
-        print(f"Error al descargar mensaje {msg_id}: {status}")
-        return False
+def claim_cache_key(cache_key: str, processed_keys: set) -> bool:
+    """
+    Reserva la clave antes de enviar. False si ya se procesó o la está enviando otro hilo.
+    """
+    with CACHE_LOCK:
+        if cache_key in processed_keys or cache_key in IN_FLIGHT_KEYS:
+            return False
+        IN_FLIGHT_KEYS.add(cache_key)
+        return True
+
+
+def release_cache_key(cache_key: str):
+    with CACHE_LOCK:
+        IN_FLIGHT_KEYS.discard(cache_key)
+
+
+# los contadores del asunto primero se suman desde los hilos de --shards / --async
+FAST_PATH_LOCK = threading.Lock()
 
-    msg = email.message_from_bytes(msg_data[0][1])
 
+def count_fast_path(info: dict):
+    path = info.get("fastPath")
+    if path is not None:
+        with FAST_PATH_LOCK:
+            FAST_PATH[path] += 1
+
+
+def format_fast_path_stats() -> str:
+    subject_only, with_body = FAST_PATH["subjectOnly"], FAST_PATH["withBody"]
+    rate = 100.0 * subject_only / (subject_only + with_body) if subject_only + with_body else 0.0
+    return f"Asunto primero: resueltos sin cuerpo={subject_only} ({rate:.1f}%) | con cuerpo={with_body}"
+
+
+def evaluate_message(msg, processed_keys: set):
+    """
+    Aplica las reglas (cache, filtro, checklist, tipos permitidos) SIN efectos secundarios.
+    info["fastPath"] dice si hizo falta el cuerpo; lo cuenta quien llama (count_fast_path).
+    Devuelve (accion, cache_key, payload, info):
+      "skip"  = ya procesado o irrelevante (no se cachea)
+      "cache" = checklist / tipo no permitido (se cachea, no se envía)
+      "send"  = enviar 'payload' a la API
+    """
     subject = decode_maybe(msg.get("Subject"))
     from_ = decode_maybe(msg.get("From"))
     msg_dt_utc = get_message_datetime(msg)
     message_id = (msg.get("Message-ID") or "").strip()
+    info = {"subject": subject, "from": from_, "date": msg_dt_utc, "message_id": message_id}
 
-    cache_key = message_id or f"{subject}|{msg_dt_utc.isoformat()}"
+    cache_key = build_cache_key(message_id, subject, msg_dt_utc)
 
     if cache_key in processed_keys:
-        return False
+        return "skip", cache_key, None, info
+
+    # Asunto primero: un checklist en el asunto se cachea sin decodificar el cuerpo.
+    # Lo demás necesita el cuerpo aunque el asunto traiga el tipo: checklist en el cuerpo,
+    # planta / área / operador / Fecha, severidad ("bloquea"), y un tipo no permitido en el
+    # asunto todavía puede salir del cuerpo (guess_allowed_type)
+    subject_kw = KeywordScan(subject)
+    if subject_kw.checklist():
+        info["fastPath"] = "subjectOnly"
+        return "cache", cache_key, None, info
+    info["fastPath"] = "withBody"
 
     body_text = extract_body_text(msg)
 
     # Filtro rápido: si no parece relevante, ni lo cacheamos
-    text_to_search = (subject or "") + "\n" + (body_text or "")
-    low = text_to_search.lower()
-    if ("alarma" not in low) and ("checklist" not in low) and ("impacto" not in low) and ("fren" not in low) and ("aceler" not in low):
-        return False
+    keywords = (subject_kw, KeywordScan(body_text))
+    if not is_relevant(*keywords):
+        return "skip", cache_key, None, info
 
     # 1) Si es checklist, NO enviar, pero SÍ cachear para no re-procesar
-    if "checklist" in low:
-        cache_as_processed(cache_key, processed_keys, month_cache_fp, today_cache_fp)
-        return False
+    if is_checklist(*keywords):
+        return "cache", cache_key, None, info
 
-    payload = build_alert_payload(subject, body_text, msg_dt_utc)
+    payload = build_alert_payload(subject, body_text, msg_dt_utc, keywords, message_origin(from_, message_id))
 
     # 2) Solo enviar si el tipo es uno de los permitidos (y también cachear si no lo es)
     alert_type = payload.get("alertType") or ""
     if alert_type not in ALLOWED_TYPES:
         # Ej: ALARMA / DESCONOCIDO / EXCESO VELOCIDAD, etc.
-        cache_as_processed(cache_key, processed_keys, month_cache_fp, today_cache_fp)
-        return False
+        return "cache", cache_key, None, info
 
-    print("=" * 60)
-    print(f"IMAP ID: {msg_id}")
-    print(f"Message-ID: {message_id}")
-    print(f"From: {from_}")
-    print(f"Subject: {subject}")
-    print(f"Header date (UTC): {msg_dt_utc}")
-    print(f"AlertType (allowed): {alert_type}")
+    return "send", cache_key, payload, info
 
-    if send_alert_to_api(payload):
-        cache_as_processed(cache_key, processed_keys, month_cache_fp, today_cache_fp)
 
-        # opcional: marcar como leído si se registró OK
-        mail.store(msg_id, "+FLAGS", "\\Seen")
-        return True
+def print_alert_summary(msg_id, info: dict, payload: dict):
+    with PRINT_LOCK:
+        print("=" * 60)
+        print(f"IMAP ID: {msg_id}")
+        print(f"Message-ID: {info['message_id']}")
+        print(f"From: {info['from']}")
+        print(f"Subject: {info['subject']}")
+        print(f"Header date (UTC): {info['date']}")
+        print(f"AlertType (allowed): {payload.get('alertType')}")
+
+
+def process_message(mail, msg_id, msg, processed_keys: set, month_cache_fp: str, today_cache_fp: str,
+                    gmid: str = None, gmid_map: dict = None):
+    """
+    True = enviado | False = saltado (cache/irrelevante) | None = falló (se reintenta en otro run)
+    El \\Seen de lo enviado lo marca quien llama, en lote (ver flag_seen_batch).
+    """
+    if msg is None:
+        print(f"Error al descargar mensaje {msg_id}")
+        return None
+
+    action, cache_key, payload, info = evaluate_message(msg, processed_keys)
+    count_fast_path(info)
+    if action == "skip":
+        return False
+    if action == "cache":
+        cache_as_processed(cache_key, processed_keys, month_cache_fp, today_cache_fp, gmid, gmid_map)
+        return False
+    if not claim_cache_key(cache_key, processed_keys):
+        return False
+
+    try:
+        print_alert_summary(msg_id, info, payload)
+
+        if send_alert_to_api(payload):
+            cache_as_processed(cache_key, processed_keys, month_cache_fp, today_cache_fp, gmid, gmid_map)
+            return True
+    finally:
+        release_cache_key(cache_key)
 
     # Si falló la API, NO cacheamos => permitirá reintentar en otro run
-    return False
+    return None
+
+
+# ---------- MODO --shards (un día por worker, conexiones en paralelo) ----------
+
+def month_day_shards(month_start: datetime, next_month_start: datetime):
+    """
+    [(día, inicio, fin), ...] en hora Lima. IMAP SINCE/BEFORE trabajan por día.
+    """
+    shards = []
+    day = month_start
+    while day < next_month_start:
+        nxt = day + timedelta(days=1)
+        shards.append((day.strftime("%Y-%m-%d"), day, nxt))
+        day = nxt
+    return shards
+
+
+def process_day_shard(mail, day_start: datetime, day_end: datetime, processed_keys: set,
+                      month_fp: str, today_fp: str, gmid_map: dict):
+    """
+    Procesa un día completo en la conexión 'mail'.
+    Devuelve {"found", "sent", "skipped", "failed"}. failed > 0 => el día no queda cerrado.
+    """
+    criteria = ["SINCE", imap_date(day_start), "BEFORE", imap_date(day_end)] + SERVER_QUERY.criteria(mail)
+    status, data = mail.search(None, *criteria)
+    if status != "OK":
+        raise RuntimeError(f"SEARCH falló: {status}")
+    msg_ids = data[0].split() if data and data[0] else []
+
+    result = {"found": len(msg_ids), "sent": 0, "skipped": 0, "failed": 0}
+
+    pending_ids, gmids = msg_ids, {}
+    if supports_gmail_ext(mail):
+        pending_ids, gmids = FETCHER.filter_processed_by_gmid(mail, pending_ids, gmid_map)
+    header_keys = {}
+    pending_ids = FETCHER.filter_unprocessed_by_headers(
+        mail, pending_ids, processed_keys, header_cache_key, gmids=gmids, gmid_map=gmid_map, header_keys=header_keys
+    )
+    result["skipped"] += len(msg_ids) - len(pending_ids)
+
+    delivered = []
+    for msg_id, msg in FETCHER.fetch_messages(mail, pending_ids, spool_keys=header_keys):
+        ok = process_message(
+            mail, msg_id, msg, processed_keys, month_fp, today_fp, gmids.get(int(msg_id)), gmid_map
+        )
+        if ok:
+            result["sent"] += 1
+            delivered.append(msg_id)
+        elif ok is None:
+            result["failed"] += 1
+        else:
+            result["skipped"] += 1
+    flag_seen_batch(mail, delivered)
+    return result
+
+
+def run_sharded_backfill(month_start, next_month_start, year: int, month: int, processed_keys: set,
+                         month_fp: str, today_fp: str):
+    """
+    Reparte los días del mes entre SHARD_WORKERS hilos (cada uno con su conexión IMAP).
+    Dedupe compartido (processed_keys + mapa X-GM-MSGID) y checkpoint por día:
+    los días cerrados sin fallos no se vuelven a pedir al re-ejecutar
+    (borrar cache/backfill_shards_YYYYMM.json para rehacer todo el mes).
+    Devuelve (enviadas, saltadas, fallidas).
+    """
+    state_fp = month_shard_state_path(year, month)
+    state = load_shard_state(state_fp)
+    now = datetime.now(LIMA_TZ)
+
+    shards = [sh for sh in month_day_shards(month_start, next_month_start) if sh[1] <= now]
+    todo = [sh for sh in shards if not state.get(sh[0], {}).get("done")]
+    print(f"Shards (días): {len(shards)} | ya cerrados: {len(shards) - len(todo)} | a procesar: {len(todo)} | workers: {SHARD_WORKERS}")
+
+    gmid_fp = month_gmid_map_path(year, month)
+    gmid_map = load_all_month_gmid_maps(year, month) if USE_GMAIL_MSGID else {}
+    gmid_count = len(gmid_map)
+
+    jobs = queue.Queue()
+    for sh in todo:
+        jobs.put(sh)
+
+    totals = {"sent": 0, "skipped": 0, "failed": 0, "days": 0}
+    wire = {"plainIn": 0, "wireIn": 0}  # COMPRESS sumado de todas las conexiones
+    totals_lock = threading.Lock()
+    t0 = time.perf_counter()
+
+    def worker():
+        mail = None
+        while True:
+            try:
+                day, day_start, day_end = jobs.get_nowait()
+            except queue.Empty:
+                break
+
+            t_day = time.perf_counter()
+            try:
+                if mail is None:
+                    mail = connect()
+                result = process_day_shard(mail, day_start, day_end, processed_keys, month_fp, today_fp, gmid_map)
+            except (imaplib.IMAP4.abort, OSError) as e:
+                print(f"[{day}] Conexión IMAP caída: {e}")
+                mail = None
+                result = {"found": 0, "sent": 0, "skipped": 0, "failed": 1}
+            except Exception as e:
+                print(f"[{day}] Error: {e}")
+                result = {"found": 0, "sent": 0, "skipped": 0, "failed": 1}
+
+            # El día de hoy puede seguir recibiendo correos: nunca se cierra
+            done = result["failed"] == 0 and day_end <= now
+            with totals_lock:
+                state[day] = {"done": done, **{k: result[k] for k in ("found", "sent", "skipped")}}
+                save_shard_state(state_fp, state)
+                totals["sent"] += result["sent"]
+                totals["skipped"] += result["skipped"]
+                totals["failed"] += result["failed"]
+                totals["days"] += 1
+                with PRINT_LOCK:
+                    print(
+                        f"[{totals['days']}/{len(todo)}] {day}: encontrados={result['found']} | "
+                        f"enviadas={result['sent']} | saltadas={result['skipped']} | fallos={result['failed']} "
+                        f"({time.perf_counter() - t_day:.1f}s) | total enviadas={totals['sent']}"
+                    )
+
+        if mail is not None:
+            stats = compression_stats(mail)
+            if stats:
+                with totals_lock:
+                    wire["plainIn"] += stats["plainIn"]
+                    wire["wireIn"] += stats["wireIn"]
+            try:
+                mail.logout()
+            except Exception:
+                pass
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(max(1, min(SHARD_WORKERS, len(todo))))]
+    try:
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+    finally:
+        if len(gmid_map) != gmid_count:
+            save_gmid_map(gmid_fp, gmid_map)
+            print(f"Mapa X-GM-MSGID: {gmid_fp}")
+
+    print(f"Shards terminados en {time.perf_counter() - t0:.1f}s | fallos: {totals['failed']} | checkpoint: {state_fp}")
+    if wire["plainIn"]:
+        print(f"COMPRESS=DEFLATE (todas las conexiones): recibidos {wire['plainIn'] / 1048576:.2f} MB -> "
+              f"{wire['wireIn'] / 1048576:.2f} MB en el cable")
+    return totals["sent"], totals["skipped"], totals["failed"]
+
+
+# ---------- MODO ASYNC (pipelining sobre una conexión, ver imap_async.py) ----------
+
+def uid_batches(uids, size: int) -> dict:
+    """
+    {message set compacto: [uids del lote]} en lotes de 'size' (claves para fetch_pipelined).
+    """
+    batches = {}
+    for i in range(0, len(uids), size):
+        batch = uids[i:i + size]
+        batches[compact_id_set(batch)] = batch
+    return batches
+
+
+async def run_async_backfill(month_start, next_month_start, year: int, month: int, processed_keys: set,
+                             month_fp: str, today_fp: str):
+    """
+    Mismo backfill pero con varios FETCH en vuelo a la vez en UNA conexión:
+      SEARCH -> X-GM-MSGID (Gmail) -> cabeceras (dedupe) -> cuerpos en lotes -> cola -> workers (process_message)
+    Mismos pre-filtros, FETCH_MODE (parts/full), spool y COMPRESS=DEFLATE que el modo normal.
+    Los \\Seen de lo enviado se marcan en lote (un UID STORE cada SEEN_FLUSH_SIZE).
+    Devuelve (enviadas, saltadas, fallidas); las fallidas (lote con error, UID que no volvió
+    en el FETCH, API caída) no se cachean y se reintentan en otro run.
+    """
+    client = imap_async.AsyncImapClient(IMAP_HOST, IMAP_PORT, use_ssl=IMAP_SSL)
+    await client.connect()
+    await client.login(GMAIL_USER, GMAIL_PASS)
+    if USE_COMPRESS:
+        await client.enable_compression()
+    await client.select(IMAP_FOLDER)
+    print(f"Conectado (async, {ASYNC_PIPELINE_DEPTH} comandos en vuelo). Buscando correos del mes...")
+
+    use_gmid = supports_gmail_ext(client)
+    gmid_fp = month_gmid_map_path(year, month)
+    gmid_map = load_all_month_gmid_maps(year, month) if use_gmid else {}
+    gmid_count = len(gmid_map)
+    if use_gmid:
+        print(f"X-GM-MSGID ya procesados (diarios del mes + mensual): {gmid_count}")
+
+    try:
+        criteria = ["SINCE", imap_date(month_start), "BEFORE", imap_date(next_month_start)]
+        uids = [int(u) for u in await client.search_uids(*(criteria + SERVER_QUERY.criteria(client)))]
+        print(f"Encontrados {len(uids)} correos en el rango del mes.")
+
+        # 0) X-GM-MSGID en paralelo (Gmail) => lo ya procesado sin bajar cabeceras
+        pending = uids
+        gmids = {}
+        if use_gmid:
+            batches = uid_batches(uids, HEADER_BATCH_SIZE)
+            async for msg_set, status, data in imap_async.fetch_pipelined(
+                client, list(batches), "(UID X-GM-MSGID)", ASYNC_PIPELINE_DEPTH
+            ):
+                if status != "OK":
+                    print(f"Error al pedir X-GM-MSGID ({msg_set}): {status}")
+                    continue
+                gmids.update(parse_gmids(data))
+            pending = [u for u in uids if gmids.get(u) not in gmid_map]
+            print(f"Pre-filtro X-GM-MSGID: {len(uids)} candidato(s) | ya procesados={len(uids) - len(pending)}")
+
+        # 1) cabeceras en paralelo => solo lo no cacheado
+        to_fetch = []
+        header_keys = {}
+        batches = uid_batches(pending, HEADER_BATCH_SIZE)
+        item = f"(UID BODY.PEEK[HEADER.FIELDS {HEADER_PREFETCH_FIELDS}])"
+        async for msg_set, status, data in imap_async.fetch_pipelined(client, list(batches), item, ASYNC_PIPELINE_DEPTH):
+            if status != "OK":
+                # sin cabeceras no podemos decidir => se descargan completos
+                print(f"Error al bajar cabeceras ({msg_set}): {status}")
+                to_fetch += batches[msg_set]
+                continue
+            keys = parse_header_keys(data, header_cache_key)
+            header_keys.update(keys)
+            for uid in batches[msg_set]:
+                key = keys.get(uid)
+                if key is not None and key in processed_keys:
+                    if uid in gmids:
+                        gmid_map[gmids[uid]] = key
+                else:
+                    to_fetch.append(uid)
+        print(f"Pre-filtro cabeceras: {len(pending)} candidato(s) | ya en cache={len(pending) - len(to_fetch)} | "
+              f"a descargar={len(to_fetch)}")
+
+        # 2) cuerpos en paralelo -> cola -> workers
+        counters = {"sent": 0, "skipped": len(uids) - len(to_fetch), "failed": 0}
+        jobs = asyncio.Queue(maxsize=ASYNC_FETCH_BATCH * 2)
+        store_tasks = []
+        delivered = []
+
+        def flush_seen():
+            if delivered:
+                msg_set = compact_id_set(delivered)
+                delivered.clear()
+                store_tasks.append(asyncio.ensure_future(client.uid_store(msg_set, "+FLAGS.SILENT", "(\\Seen)")))
+
+        async def fetch_full(ids):
+            # RFC822 completo (FETCH_MODE=full o spool activo: el spool guarda el crudo)
+            batches = uid_batches(ids, ASYNC_FETCH_BATCH)
+            async for msg_set, status, data in imap_async.fetch_pipelined(
+                client, list(batches), "(UID RFC822)", ASYNC_PIPELINE_DEPTH
+            ):
+                raws = {}
+                if status == "OK":
+                    raws = parse_raw_messages(data)
+                else:
+                    print(f"Error al descargar lote ({msg_set}): {status}")
+                for uid in batches[msg_set]:
+                    raw = raws.get(uid)
+                    if raw is not None and SPOOL is not None:
+                        SPOOL.put(header_keys.get(uid), raw)
+                    await jobs.put((uid, parse_message_lazy(raw) if raw is not None else None))
+
+        async def fetch_parts(ids):
+            # BODYSTRUCTURE => solo la parte de texto que usa el parser, agrupando por sección
+            sections = {}
+            batches = uid_batches(ids, ASYNC_FETCH_BATCH)
+            async for msg_set, status, data in imap_async.fetch_pipelined(
+                client, list(batches), "(UID BODYSTRUCTURE)", ASYNC_PIPELINE_DEPTH
+            ):
+                if status != "OK":
+                    print(f"Error al pedir BODYSTRUCTURE ({msg_set}): {status}")
+                    continue
+                for section, choices in parse_text_sections(data).items():
+                    sections.setdefault(section, {}).update(choices)
+
+            known = set()
+            for section, choices in sections.items():
+                known.update(choices)
+                batches = uid_batches(sorted(choices), ASYNC_FETCH_BATCH)
+                async for msg_set, status, data in imap_async.fetch_pipelined(
+                    client, list(batches), text_part_items(HEADER_PREFETCH_FIELDS, section), ASYNC_PIPELINE_DEPTH
+                ):
+                    msgs = {}
+                    if status == "OK":
+                        msgs, _ = parse_text_parts(data, section, choices)
+                    else:
+                        print(f"Error al descargar lote ({msg_set}): {status}")
+                    for uid in batches[msg_set]:
+                        await jobs.put((uid, msgs.get(uid)))
+            for uid in ids:
+                if uid not in known:
+                    await jobs.put((uid, None))
+
+        async def producer():
+            # lo que ya está en el spool va directo a la cola, sin FETCH
+            rest = to_fetch
+            if SPOOL is not None:
+                rest = []
+                for uid in to_fetch:
+                    raw = SPOOL.get(header_keys.get(uid))
+                    if raw is None:
+                        rest.append(uid)
+                    else:
+                        await jobs.put((uid, parse_message_lazy(raw)))
+            if FETCH_MODE == "full" or SPOOL is not None:
+                await fetch_full(rest)
+            else:
+                await fetch_parts(rest)
+            for _ in range(ASYNC_SEND_WORKERS):
+                await jobs.put(None)
+
+        async def worker():
+            while True:
+                job = await jobs.get()
+                if job is None:
+                    return
+                uid, msg = job
+                ok = await asyncio.to_thread(
+                    process_message, None, str(uid), msg, processed_keys, month_fp, today_fp, gmids.get(uid), gmid_map
+                )
+                if ok:
+                    counters["sent"] += 1
+                    delivered.append(uid)
+                    if len(delivered) >= SEEN_FLUSH_SIZE:
+                        flush_seen()
+                elif ok is None:
+                    counters["failed"] += 1
+                else:
+                    counters["skipped"] += 1
+
+        await asyncio.gather(producer(), *[worker() for _ in range(ASYNC_SEND_WORKERS)])
+        flush_seen()
+        for result in await asyncio.gather(*store_tasks, return_exceptions=True):
+            if isinstance(result, Exception) or result[0] != "OK":
+                print(f"No se pudo marcar como leídos: {result}")
+
+        print(f"Bytes IMAP: recibidos={client.bytes_in} | enviados={client.bytes_out}")
+        return counters["sent"], counters["skipped"], counters["failed"]
+    finally:
+        if use_gmid and len(gmid_map) != gmid_count:
+            save_gmid_map(gmid_fp, gmid_map)
+            print(f"Mapa X-GM-MSGID: {gmid_fp}")
+        print(format_compression_stats(client))
+        await client.logout()
+        print("Desconectado de IMAP (async).")
+
+
+# ---------- MODO --replay (mbox / Maildir / .eml, sin IMAP) ----------
+
+def run_replay(path: str, processed_keys: set, month_fp: str, today_fp: str):
+    """
+    Mismas reglas que el backfill (evaluate_message / process_message) sobre un export local.
+    No filtra por mes: se procesa todo el export. Devuelve (total, enviadas, saltadas).
+    """
+    total = sent = skipped = 0
+    for ref, raw in iter_replay_messages(path):
+        total += 1
+        ok = process_message(None, ref, parse_message_lazy(raw), processed_keys, month_fp, today_fp)
+        if ok:
+            sent += 1
+        else:
+            skipped += 1
+    return total, sent, skipped
 
 
 def main():
+    global NDJSON_SINK
     month_start, next_month_start, year, month = month_range_lima()
     print(f"Backfill del mes: {year}-{month:02d}")
     print(f"Rango IMAP (Lima): {month_start} -> {next_month_start}")
     print(f"ALLOWED_TYPES: {sorted(ALLOWED_TYPES)} (CHECKLIST bloqueado y cacheado)")
 
+    if "--bench-query" in sys.argv:
+        mail = connect()
+        try:
+            SERVER_QUERY.benchmark(
+                mail, ["SINCE", imap_date(month_start), "BEFORE", imap_date(next_month_start)]
+            )
+        finally:
+            mail.logout()
+        return
+
     month_fp = month_cache_path(year, month)
     today_fp = today_cache_path()
 
+    replay_path, ndjson_path = replay_options(sys.argv)
+    if replay_path:
+        # a NDJSON: corrida "en seco" y determinística (ni lee ni escribe caches)
+        processed_keys = set()
+        if ndjson_path:
+            NDJSON_SINK = NdjsonSink(ndjson_path)
+        else:
+            processed_keys = load_all_month_daily_caches(year, month)
+            print(f"Claves ya procesadas (diarios del mes + mensual + hoy): {len(processed_keys)}")
+            load_templates()
+        print(f"Replay offline desde {replay_path}")
+        t0 = time.perf_counter()
+        try:
+            total, sent, skipped = run_replay(replay_path, processed_keys, month_fp, today_fp)
+        finally:
+            if NDJSON_SINK is not None:
+                NDJSON_SINK.close()
+        print("=" * 60)
+        print(format_replay_stats(total, sent, skipped, time.perf_counter() - t0, NDJSON_SINK))
+        print(format_fast_path_stats())
+        print(format_template_stats(TEMPLATES))
+        if not ndjson_path:
+            save_templates()
+        return
+
     processed_keys = load_all_month_daily_caches(year, month)
     print(f"Claves ya procesadas (diarios del mes + mensual + hoy): {len(processed_keys)}")
+    load_templates()
+
+    if "--async" in sys.argv or "--shards" in sys.argv:
+        if "--shards" in sys.argv:
+            sent, skipped, failed = run_sharded_backfill(
+                month_start, next_month_start, year, month, processed_keys, month_fp, today_fp
+            )
+        else:
+            sent, skipped, failed = asyncio.run(
+                run_async_backfill(month_start, next_month_start, year, month, processed_keys, month_fp, today_fp)
+            )
+        print("=" * 60)
+        print(f"FIN. Enviadas a API (solo allowed): {sent} | Saltadas (cache/irrelevante): {skipped} | "
+              f"Fallidas (se reintentan): {failed}")
+        print(f"Cache mensual: {month_fp}")
+        print(f"Cache hoy: {today_fp}")
+        print(format_fast_path_stats())
+        print(format_template_stats(TEMPLATES))
+        save_templates()
+        if SPOOL is not None:
+            print(format_spool_stats(SPOOL))
+        return
 
     mail = connect()
     print("Conectado a IMAP. Buscando correos del mes (leídos y no leídos)...")
 
+    use_gmid = supports_gmail_ext(mail)
+    gmid_fp = month_gmid_map_path(year, month)
+    gmid_map = load_all_month_gmid_maps(year, month) if use_gmid else {}
+    gmid_count = len(gmid_map)
+    if use_gmid:
+        print(f"X-GM-MSGID ya procesados (diarios del mes + mensual): {gmid_count}")
+
     try:
         msg_ids = fetch_month_any(mail, month_start, next_month_start)
         print(f"Encontrados {len(msg_ids)} correos en el rango del mes.")
 
         sent = 0
         skipped = 0
+        failed = 0
+
+        pending_ids, gmids = msg_ids, {}
+        if use_gmid:
+            pending_ids, gmids = FETCHER.filter_processed_by_gmid(mail, pending_ids, gmid_map)
+        header_keys = {}
+        pending_ids = FETCHER.filter_unprocessed_by_headers(
+            mail, pending_ids, processed_keys, header_cache_key, gmids=gmids, gmid_map=gmid_map, header_keys=header_keys
+        )
+        skipped += len(msg_ids) - len(pending_ids)
 
-        for msg_id in msg_ids:
-            ok = process_message(mail, msg_id, processed_keys, month_fp, today_fp)
+        delivered = []
+        for msg_id, msg in FETCHER.fetch_messages(mail, pending_ids, spool_keys=header_keys):
+            ok = process_message(
+                mail, msg_id, msg, processed_keys, month_fp, today_fp, gmids.get(int(msg_id)), gmid_map
+            )
             if ok:
                 sent += 1
+                delivered.append(msg_id)
+                if len(delivered) >= SEEN_FLUSH_SIZE:
+                    flag_seen_batch(mail, delivered)
+                    delivered = []
+            elif ok is None:
+                failed += 1
             else:
                 skipped += 1
+        flag_seen_batch(mail, delivered)
 
         print("=" * 60)
-        print(f"FIN. Enviadas a API (solo allowed): {sent} | Saltadas (cache/irrelevante/fallo): {skipped}")
+        print(f"FIN. Enviadas a API (solo allowed): {sent} | Saltadas (cache/irrelevante): {skipped} | "
+              f"Fallidas (se reintentan): {failed}")
         print(f"Cache mensual: {month_fp}")
         print(f"Cache hoy: {today_fp}")
 
     finally:
+        if use_gmid and len(gmid_map) != gmid_count:
+            save_gmid_map(gmid_fp, gmid_map)
+            print(f"Mapa X-GM-MSGID: {gmid_fp}")
+        print(format_compression_stats(mail))
+        print(format_fast_path_stats())
+        print(format_template_stats(TEMPLATES))
+        save_templates()
+        if SPOOL is not None:
+            print(format_spool_stats(SPOOL))
         mail.logout()
         print("Desconectado de IMAP.")
 
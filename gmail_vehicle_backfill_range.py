@@ -22,18 +22,30 @@ import email
 from email.header import decode_header
 from email.utils import parsedate_to_datetime
 import os
+import sys
+import time
+import threading
 from datetime import datetime, timedelta, timezone
 import re
 import json
-import html as html_lib
 
 import requests
 
+from imap_compress import enable_compression, format_compression_stats  # COMPRESS=DEFLATE
+from raw_spool import RawSpool, format_spool_stats  # spool local de correos crudos
+from mail_replay import replay_options, iter_replay_messages, NdjsonSink, format_replay_stats  # --replay
+from mime_body import parse_message_lazy, extract_body_text  # cuerpo en una pasada, adjuntos sin decodificar
+from html_text import body_to_text  # HTML -> texto (mismo resultado que la copia anterior)
+from alert_keywords import RELEVANT_STEMS, KeywordScan, is_relevant  # filtro de relevancia (palabras clave)
+from imap_fetch import ImapFetcher, ServerQuery  # FETCH por lotes, pre-filtro de cabeceras y filtro de SEARCH
+
 # =============== CONFIG ===============
 GMAIL_USER = os.environ.get("GMAIL_USER", "yap32k@gmail.com") # (Reemplazar por la real)
 GMAIL_PASS = os.environ.get("GMAIL_PASS", "intn rkry alig xhtl")  # app password (Reemplazar por la real)
 
-IMAP_HOST = "imap.gmail.com"
+IMAP_HOST = os.environ.get("ALERT_IMAP_HOST", "imap.gmail.com")
+IMAP_PORT = int(os.environ.get("ALERT_IMAP_PORT", "993"))
+IMAP_SSL = os.environ.get("ALERT_IMAP_SSL", "1") == "1"  # 0 = IMAP plano (ej. imap_standin.py local)
 IMAP_FOLDER = "INBOX"
 
 API_BASE_URL = os.environ.get("ALERT_API_BASE", "https://samloto.com:4016")
@@ -49,6 +61,54 @@ END_EXCLUSIVE_LIMA = datetime(2026, 1, 31, 0, 0, 0, tzinfo=LIMA_TZ)  # exclusivo
 
 # Tipos permitidos
 ALLOWED_TYPES = {"IMPACTO", "FRENADA", "ACELERACION"}
+
+# Descarga por lotes: el tamaño del lote se adapta al tamaño promedio de los correos
+FETCH_BATCH_INITIAL = int(os.environ.get("FETCH_BATCH_INITIAL", "50"))
+FETCH_BATCH_MIN = int(os.environ.get("FETCH_BATCH_MIN", "10"))
+FETCH_BATCH_MAX = int(os.environ.get("FETCH_BATCH_MAX", "500"))
+FETCH_BATCH_TARGET_BYTES = int(os.environ.get("FETCH_BATCH_TARGET_BYTES", str(4 * 1024 * 1024)))  # ~4 MB por FETCH
+# parts = BODYSTRUCTURE + solo la parte de texto que usa el parser | full = RFC822 completo
+FETCH_MODE = os.environ.get("ALERT_FETCH_MODE", "parts").strip().lower()
+
+# Pre-filtro por cabeceras (dedupe sin bajar el cuerpo)
+HEADER_PREFETCH_FIELDS = "(MESSAGE-ID SUBJECT DATE FROM)"
+HEADER_BATCH_SIZE = int(os.environ.get("HEADER_BATCH_SIZE", "500"))
+
+# COMPRESS=DEFLATE (RFC 4978) si el servidor lo ofrece (ver imap_compress.py)
+USE_COMPRESS = os.environ.get("ALERT_IMAP_COMPRESS", "1") == "1"
+
+# Spool local de correos crudos (ver raw_spool.py): lo bajado una vez se relee de disco
+# en las siguientes corridas. Con spool activo se baja el RFC822 completo (para guardarlo).
+USE_SPOOL = os.environ.get("ALERT_SPOOL", "0") == "1"
+SPOOL_DIR = os.environ.get("ALERT_SPOOL_DIR", os.path.join("cache", "spool"))
+SPOOL_MAX_MB = int(os.environ.get("ALERT_SPOOL_MAX_MB", "1024"))
+SPOOL_MAX_DAYS = int(os.environ.get("ALERT_SPOOL_MAX_DAYS", "60"))
+SPOOL = RawSpool(SPOOL_DIR, SPOOL_MAX_MB * 1048576, SPOOL_MAX_DAYS * 86400) if USE_SPOOL else None
+
+FETCHER = ImapFetcher(
+    FETCH_MODE, FETCH_BATCH_INITIAL, FETCH_BATCH_MIN, FETCH_BATCH_MAX, FETCH_BATCH_TARGET_BYTES,
+    HEADER_PREFETCH_FIELDS, HEADER_BATCH_SIZE, spool=SPOOL,
+)
+
+# asunto primero: correos resueltos sin decodificar el cuerpo / con cuerpo (solo para el resumen)
+FAST_PATH = {"subjectOnly": 0, "withBody": 0}
+FAST_PATH_LOCK = threading.Lock()
+
+# Filtro del lado del servidor (para que SEARCH devuelva solo candidatos a alarma), opcional:
+#   none  = sin filtro: SEARCH trae todo el rango y se filtra en el cliente (default)
+#   imap  = OR TEXT "<raíz>" ... con las raíces del filtro del cliente (RELEVANT_STEMS)
+#   gmraw = X-GM-RAW (Gmail) | auto = gmraw si el servidor es Gmail (X-GM-EXT-1), si no imap
+# OJO: Gmail busca por palabra completa (también con TEXT): 'fren' no encuentra 'frenazo' y
+# 'frenada' no encuentra 'FRENO'. En Gmail cualquier filtro de servidor puede perder alarmas.
+SERVER_QUERY_MODE = os.environ.get("ALERT_SERVER_QUERY", "none").strip().lower()
+SERVER_QUERY_KEYWORDS = [
+    k.strip() for k in os.environ.get("ALERT_SERVER_KEYWORDS", ",".join(RELEVANT_STEMS)).split(",") if k.strip()
+]  # solo ASCII
+GMAIL_RAW_QUERY = os.environ.get(
+    "ALERT_GMAIL_RAW_QUERY", "alarma OR checklist OR impacto OR frenada OR frenado OR aceleracion"
+)
+SERVER_FROM_FILTER = os.environ.get("ALERT_FROM_FILTER", "")  # ej: "geomov" (vacío = cualquier remitente)
+SERVER_QUERY = ServerQuery(SERVER_QUERY_MODE, SERVER_QUERY_KEYWORDS, GMAIL_RAW_QUERY, SERVER_FROM_FILTER)
 # ======================================
 
 
@@ -68,8 +128,13 @@ def decode_maybe(encoded_header):
 
 
 def connect():
-    mail = imaplib.IMAP4_SSL(IMAP_HOST)
+    if IMAP_SSL:
+        mail = imaplib.IMAP4_SSL(IMAP_HOST, IMAP_PORT)
+    else:
+        mail = imaplib.IMAP4(IMAP_HOST, IMAP_PORT)
     mail.login(GMAIL_USER, GMAIL_PASS)
+    if USE_COMPRESS:
+        enable_compression(mail)
     mail.select(IMAP_FOLDER)
     return mail
 
@@ -82,12 +147,12 @@ def imap_date(dt: datetime) -> str:
 def fetch_range_any(mail, start_lima: datetime, end_exclusive_lima: datetime):
     """
     Devuelve IDs de correos en el rango.
-    IMAP: SINCE start, BEFORE end
+    IMAP: SINCE start, BEFORE end (+ filtro del servidor, ver ServerQuery en imap_fetch.py)
     """
     date_from = imap_date(start_lima)
     date_to = imap_date(end_exclusive_lima)
 
-    status, data = mail.search(None, "SINCE", date_from, "BEFORE", date_to)
+    status, data = mail.search(None, "SINCE", date_from, "BEFORE", date_to, *SERVER_QUERY.criteria(mail))
     if status != "OK":
         print("Error al buscar mensajes del rango:", status)
         return []
@@ -108,6 +173,19 @@ def get_message_datetime(msg):
         return datetime.now(timezone.utc)
 
 
+# ---------- CLAVE DE CACHE (la usa también el pre-filtro por cabeceras) ----------
+
+def build_cache_key(message_id: str, subject: str, msg_dt_utc: datetime) -> str:
+    return message_id or f"{subject}|{msg_dt_utc.isoformat()}"
+
+
+def header_cache_key(header_bytes: bytes) -> str:
+    msg = email.message_from_bytes(header_bytes)
+    subject = decode_maybe(msg.get("Subject"))
+    message_id = (msg.get("Message-ID") or "").strip()
+    return build_cache_key(message_id, subject, get_message_datetime(msg))
+
+
 # ---------- CACHE (mensajes + códigos + placas) ----------
 
 def ensure_cache_dir():
@@ -147,6 +225,8 @@ def load_cache_file(path: str) -> set:
 
 
 def append_cache_key(path: str, cache_key: str):
+    if NDJSON_SINK is not None:
+        return  # replay a NDJSON: no se marca nada como procesado
     keys = load_cache_file(path)
     if cache_key in keys:
         return
@@ -157,59 +237,6 @@ def append_cache_key(path: str, cache_key: str):
 
 # ---------- PARSEO CORREO ----------
 
-def extract_body_text(msg):
-    if msg.is_multipart():
-        for part in msg.walk():
-            content_type = part.get_content_type()
-            content_disp = str(part.get("Content-Disposition", ""))
-            if content_type == "text/plain" and "attachment" not in content_disp:
-                try:
-                    return part.get_payload(decode=True).decode(
-                        part.get_content_charset() or "utf-8", errors="ignore"
-                    )
-                except Exception:
-                    pass
-        for part in msg.walk():
-            content_type = part.get_content_type()
-            content_disp = str(part.get("Content-Disposition", ""))
-            if content_type == "text/html" and "attachment" not in content_disp:
-                try:
-                    return part.get_payload(decode=True).decode(
-                        part.get_content_charset() or "utf-8", errors="ignore"
-                    )
-                except Exception:
-                    pass
-        return ""
-    else:
-        try:
-            return msg.get_payload(decode=True).decode(
-                msg.get_content_charset() or "utf-8", errors="ignore"
-            )
-        except Exception:
-            return ""
-
-
-def looks_like_html(s: str) -> bool:
-    if not s:
-        return False
-    low = s.lower()
-    return "<html" in low or "<body" in low or "<br" in low or "</div" in low or "<p" in low
-
-
-def html_to_text(s: str) -> str:
-    if not s:
-        return ""
-    s = re.sub(r"(?i)<br\s*/?>", "\n", s)
-    s = re.sub(r"(?i)</p\s*>", "\n", s)
-    s = re.sub(r"(?i)</div\s*>", "\n", s)
-    s = re.sub(r"<[^>]+>", " ", s)
-    s = html_lib.unescape(s)
-    s = s.replace("\xa0", " ")
-    s = re.sub(r"[ \t]+", " ", s)
-    s = re.sub(r"\n\s*\n+", "\n", s)
-    return s.strip()
-
-
 def parse_subject(subject: str):
     """
     "xxx - ALERT_TYPE - VEHCODE (PLATE)".
@@ -285,6 +312,17 @@ def guess_alert_type(subject: str, body_text: str) -> str:
     return ""
 
 
+def subject_decides_vehicle(subject: str) -> bool:
+    """
+    True si build_vehicle_payload no necesita el cuerpo: el asunto trae el tipo y,
+    si es uno de los permitidos, también el código de vehículo.
+    """
+    alert_type, vehicle_code, _ = parse_subject(subject)
+    if not alert_type:
+        return False
+    return normalize_alert_type(alert_type) not in ALLOWED_TYPES or bool(vehicle_code and vehicle_code.strip())
+
+
 def build_vehicle_payload(subject: str, body_text: str) -> dict | None:
     """
     Devuelve payload para POST /api/vehicles o None si:
@@ -293,7 +331,7 @@ def build_vehicle_payload(subject: str, body_text: str) -> dict | None:
     """
     alert_type, vehicle_code, license_plate = parse_subject(subject)
 
-    parse_text = html_to_text(body_text) if looks_like_html(body_text) else (body_text or "")
+    parse_text = body_to_text(body_text)
 
     if not alert_type:
         alert_type = guess_alert_type(subject, parse_text)
@@ -326,11 +364,17 @@ def build_vehicle_payload(subject: str, body_text: str) -> dict | None:
 
 # ---------- API ----------
 
+# --ndjson: los payloads van a un archivo en vez de a la API (ver mail_replay.py)
+NDJSON_SINK = None
+
+
 def send_vehicle_to_api(payload: dict) -> bool:
     """
     POST /api/vehicles
     Si ya existe, tu API devuelve 409 => lo tomamos como OK.
     """
+    if NDJSON_SINK is not None:
+        return NDJSON_SINK.write(payload)
     try:
         resp = requests.post(VEHICLE_ENDPOINT, json=payload, timeout=15)
         if 200 <= resp.status_code < 300:
@@ -348,9 +392,22 @@ def send_vehicle_to_api(payload: dict) -> bool:
 
 # ---------- Procesamiento ----------
 
+def count_fast_path(path: str):
+    # un solo hilo hoy; el lock es el mismo que en el listener / backfill por si eso cambia
+    with FAST_PATH_LOCK:
+        FAST_PATH[path] += 1
+
+
+def format_fast_path_stats() -> str:
+    subject_only, with_body = FAST_PATH["subjectOnly"], FAST_PATH["withBody"]
+    rate = 100.0 * subject_only / (subject_only + with_body) if subject_only + with_body else 0.0
+    return f"Asunto primero: resueltos sin cuerpo={subject_only} ({rate:.1f}%) | con cuerpo={with_body}"
+
+
 def process_message(
     mail,
     msg_id,
+    msg,
     processed_msgs: set,
     seen_codes: set,
     seen_plates: set,
@@ -358,29 +415,31 @@ def process_message(
     codes_cache_fp: str,
     plates_cache_fp: str,
 ):
-    status, msg_data = mail.fetch(msg_id, "(RFC822)")
-    if status != "OK":
-        print(f"Error al descargar mensaje {msg_id}: {status}")
+    if msg is None:
+        print(f"Error al descargar mensaje {msg_id}")
         return False
 
-    msg = email.message_from_bytes(msg_data[0][1])
-
     subject = decode_maybe(msg.get("Subject"))
     from_ = decode_maybe(msg.get("From"))
     msg_dt_utc = get_message_datetime(msg)
     message_id = (msg.get("Message-ID") or "").strip()
 
-    msg_key = message_id or f"{subject}|{msg_dt_utc.isoformat()}"
+    msg_key = build_cache_key(message_id, subject, msg_dt_utc)
     if msg_key in processed_msgs:
         return False
 
-    body_text = extract_body_text(msg)
+    # Asunto primero: asunto relevante que ya trae tipo (y código) => el cuerpo no se usa
+    subject_kw = KeywordScan(subject)
+    if subject_kw.relevant() and subject_decides_vehicle(subject):
+        count_fast_path("subjectOnly")
+        body_text = ""
+    else:
+        count_fast_path("withBody")
+        body_text = extract_body_text(msg)
 
-    # filtro básico: no procesar basura
-    text_to_search = (subject or "") + "\n" + (body_text or "")
-    low = text_to_search.lower()
-    if ("alarma" not in low) and ("checklist" not in low) and ("impacto" not in low) and ("fren" not in low) and ("aceler" not in low):
-        return False
+        # filtro básico: no procesar basura
+        if not is_relevant(subject_kw, KeywordScan(body_text)):
+            return False
 
     vehicle_payload = build_vehicle_payload(subject, body_text)
     if vehicle_payload is None:
@@ -431,10 +490,51 @@ def process_message(
     return False
 
 
+# ---------- MODO --replay (mbox / Maildir / .eml, sin IMAP) ----------
+
+def run_replay(path: str, processed_msgs: set, seen_codes: set, seen_plates: set,
+               msgs_cache_fp: str, codes_cache_fp: str, plates_cache_fp: str):
+    """
+    Mismas reglas que el backfill de vehículos sobre un export local.
+    No filtra por START_LIMA / END_EXCLUSIVE_LIMA: se procesa todo el export.
+    Devuelve (total, enviados, saltados).
+    """
+    total = sent = skipped = 0
+    for ref, raw in iter_replay_messages(path):
+        total += 1
+        ok = process_message(
+            mail=None,
+            msg_id=ref,
+            msg=parse_message_lazy(raw),
+            processed_msgs=processed_msgs,
+            seen_codes=seen_codes,
+            seen_plates=seen_plates,
+            msgs_cache_fp=msgs_cache_fp,
+            codes_cache_fp=codes_cache_fp,
+            plates_cache_fp=plates_cache_fp,
+        )
+        if ok:
+            sent += 1
+        else:
+            skipped += 1
+    return total, sent, skipped
+
+
 def main():
+    global NDJSON_SINK
     print("Backfill vehículos (IMPACTO/FRENADA/ACELERACION)")
     print(f"Rango IMAP (Lima): {START_LIMA} -> {END_EXCLUSIVE_LIMA} (end exclusivo)")
 
+    if "--bench-query" in sys.argv:
+        mail = connect()
+        try:
+            SERVER_QUERY.benchmark(
+                mail, ["SINCE", imap_date(START_LIMA), "BEFORE", imap_date(END_EXCLUSIVE_LIMA)]
+            )
+        finally:
+            mail.logout()
+        return
+
     msgs_cache_fp = msg_cache_path()
     codes_cache_fp = codes_cache_path()
     plates_cache_fp = plates_cache_path()
@@ -443,10 +543,32 @@ def main():
     seen_codes = load_cache_file(codes_cache_fp)
     seen_plates = load_cache_file(plates_cache_fp)
 
+    replay_path, ndjson_path = replay_options(sys.argv)
+    if replay_path and ndjson_path:
+        # a NDJSON: corrida "en seco" y determinística (ni lee ni escribe caches)
+        NDJSON_SINK = NdjsonSink(ndjson_path)
+        processed_msgs, seen_codes, seen_plates = set(), set(), set()
+
     print(f"Mensajes ya procesados (cache): {len(processed_msgs)}")
     print(f"Códigos ya vistos (cache): {len(seen_codes)}")
     print(f"Placas ya vistas (cache): {len(seen_plates)}")
 
+    if replay_path:
+        print(f"Replay offline desde {replay_path}")
+        t0 = time.perf_counter()
+        try:
+            total, sent, skipped = run_replay(
+                replay_path, processed_msgs, seen_codes, seen_plates,
+                msgs_cache_fp, codes_cache_fp, plates_cache_fp,
+            )
+        finally:
+            if NDJSON_SINK is not None:
+                NDJSON_SINK.close()
+        print("=" * 60)
+        print(format_replay_stats(total, sent, skipped, time.perf_counter() - t0, NDJSON_SINK))
+        print(format_fast_path_stats())
+        return
+
     mail = connect()
     print("Conectado a IMAP. Buscando correos del rango...")
 
@@ -457,10 +579,15 @@ def main():
         sent = 0
         skipped = 0
 
-        for msg_id in msg_ids:
+        header_keys = {}
+        pending_ids = FETCHER.filter_unprocessed_by_headers(mail, msg_ids, processed_msgs, header_cache_key, header_keys=header_keys)
+        skipped += len(msg_ids) - len(pending_ids)
+
+        for msg_id, msg in FETCHER.fetch_messages(mail, pending_ids, spool_keys=header_keys):
             ok = process_message(
                 mail=mail,
                 msg_id=msg_id,
+                msg=msg,
                 processed_msgs=processed_msgs,
                 seen_codes=seen_codes,
                 seen_plates=seen_plates,
@@ -478,8 +605,12 @@ def main():
         print(f"Cache msgs:   {msgs_cache_fp}")
         print(f"Cache codes:  {codes_cache_fp}")
         print(f"Cache plates: {plates_cache_fp}")
+        print(format_fast_path_stats())
 
     finally:
+        print(format_compression_stats(mail))
+        if SPOOL is not None:
+            print(format_spool_stats(SPOOL))
         mail.logout()
         print("Desconectado de IMAP.")
 
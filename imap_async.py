@@ -0,0 +1,356 @@
+# imap_async.py
+#
+# Cliente IMAP sobre asyncio con comandos en paralelo (pipelining) en UNA conexión:
+# varios SEARCH / FETCH / STORE "en vuelo" a la vez, cada uno con su tag, sin esperar
+# la respuesta del anterior. Así un solo proceso llena el enlace en vez de quedar
+# limitado por la latencia de ida y vuelta de cada comando.
+#
+# Lo usa gmail_alert_month_backfill.py con --async.
+#
+# Las respuestas se devuelven en el mismo formato que imaplib
+#   (status, [(b'12 (UID 34 RFC822 {1234}', b'<bytes>'), b')', ...])
+# para reutilizar parse_fetch_response / fetch_uid_of de imap_fetch.py.
+#
+# Sin dependencias externas (solo stdlib).
+
+import asyncio
+import re
+import ssl
+import zlib
+
+
+class AsyncImapError(Exception):
+    pass
+
+
+def uid_set_contains(msg_set: str, uid: int) -> bool:
+    """
+    '1:3,7,9:*' contiene 'uid'?
+    """
+    for part in msg_set.split(","):
+        if ":" in part:
+            a, b = part.split(":", 1)
+            lo = int(a) if a != "*" else float("inf")
+            hi = int(b) if b != "*" else float("inf")
+            if min(lo, hi) <= uid <= max(lo, hi):
+                return True
+        elif part == "*" or int(part) == uid:
+            return True
+    return False
+
+
+class DeflateStream:
+    """
+    COMPRESS=DEFLATE (RFC 4978) sobre los streams de asyncio, como DeflateSocket de
+    imap_compress.py: readline() / readexactly() descomprimen, compress() comprime lo que se manda.
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self.decompressor = zlib.decompressobj(-15)
+        self.buf = bytearray()
+        self.wire_in = 0
+        self.wire_out = 0
+        self.plain_in = 0
+        self.plain_out = 0
+
+    async def fill(self):
+        chunk = await self.reader.read(65536)
+        if not chunk:
+            raise AsyncImapError("Conexión cerrada por el servidor")
+        self.wire_in += len(chunk)
+        data = self.decompressor.decompress(chunk)
+        self.plain_in += len(data)
+        self.buf += data
+
+    async def readline(self) -> bytes:
+        start = 0
+        while True:
+            i = self.buf.find(b"\n", start)
+            if i >= 0:
+                break
+            start = len(self.buf)
+            await self.fill()
+        line = bytes(self.buf[:i + 1])
+        del self.buf[:i + 1]
+        return line
+
+    async def readexactly(self, n: int) -> bytes:
+        while len(self.buf) < n:
+            await self.fill()
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+    def compress(self, data: bytes) -> bytes:
+        out = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.plain_out += len(data)
+        self.wire_out += len(out)
+        return out
+
+
+class PendingCommand:
+    def __init__(self, tag: bytes, name: str, msg_set: str = None):
+        self.tag = tag
+        self.name = name
+        self.msg_set = msg_set
+        self.data = []
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class AsyncImapClient:
+    """
+    command() manda el comando y devuelve un Future (no espera la respuesta).
+    Una tarea lectora reparte las respuestas:
+      - tagged            -> al comando con ese tag
+      - * n FETCH (UID u) -> al FETCH/STORE pendiente cuyo set contiene u
+      - * SEARCH          -> al SEARCH pendiente más antiguo
+      - resto             -> al comando pendiente más antiguo (o se descarta)
+    """
+
+    def __init__(self, host: str, port: int = 993, use_ssl: bool = True, timeout: float = 120.0):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.stream = None   # de donde se leen las respuestas: reader o DeflateStream
+        self.deflate = None  # DeflateStream con COMPRESS=DEFLATE activo
+        self.capabilities = ()
+        self.pending = []
+        self.tag_counter = 0
+        self.reader_task = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    # ---------- conexión ----------
+
+    async def connect(self):
+        ctx = ssl.create_default_context() if self.use_ssl else None
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=ctx, limit=2 ** 24),
+            self.timeout,
+        )
+        self.stream = self.reader
+        greeting = await self.reader.readline()
+        self.bytes_in += len(greeting)
+        if not greeting.startswith(b"* OK") and not greeting.startswith(b"* PREAUTH"):
+            raise AsyncImapError(f"Saludo inesperado: {greeting!r}")
+
+        self.reader_task = asyncio.create_task(self.read_loop())
+
+        status, data = await self.command("CAPABILITY")
+        for line in data:
+            if isinstance(line, bytes) and line.upper().startswith(b"CAPABILITY "):
+                self.capabilities = tuple(line.decode().upper().split()[1:])
+
+    async def login(self, user: str, password: str):
+        status, _ = await self.command("LOGIN", quote(user), quote(password))
+        if status != "OK":
+            raise AsyncImapError("LOGIN falló")
+
+    async def enable_compression(self) -> bool:
+        """
+        Negocia COMPRESS=DEFLATE tras LOGIN, igual que imap_compress.enable_compression
+        (si la capacidad no aparece se vuelve a pedir CAPABILITY una vez).
+        Llamar sin otros comandos en vuelo. Devuelve True si la conexión quedó comprimida.
+        """
+        if self.deflate is not None:
+            return True
+        if "COMPRESS=DEFLATE" not in self.capabilities:
+            status, data = await self.command("CAPABILITY")
+            for line in data:
+                if isinstance(line, bytes) and line.upper().startswith(b"CAPABILITY "):
+                    self.capabilities = tuple(line.decode().upper().split()[1:])
+            if "COMPRESS=DEFLATE" not in self.capabilities:
+                return False
+        status, _ = await self.command("COMPRESS", "DEFLATE")
+        return status == "OK"
+
+    def compression_stats(self) -> dict:
+        """
+        Mismo formato que imap_compress.compression_stats (None si no está comprimida).
+        """
+        if self.deflate is None:
+            return None
+        return {"plainIn": self.deflate.plain_in, "wireIn": self.deflate.wire_in,
+                "plainOut": self.deflate.plain_out, "wireOut": self.deflate.wire_out}
+
+    async def select(self, folder: str = "INBOX"):
+        status, data = await self.command("SELECT", quote(folder))
+        if status != "OK":
+            raise AsyncImapError(f"SELECT {folder} falló")
+        return data
+
+    async def logout(self):
+        try:
+            await asyncio.wait_for(self.command("LOGOUT"), 10)
+        except Exception:
+            pass
+        await self.close()
+
+    async def close(self):
+        if self.reader_task:
+            self.reader_task.cancel()
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except Exception:
+                pass
+
+    # ---------- comandos ----------
+
+    def command(self, name: str, *args: str, msg_set: str = None):
+        """
+        Manda el comando YA (pipelining) y devuelve un Future con (status, data).
+        """
+        self.tag_counter += 1
+        tag = f"A{self.tag_counter:05d}".encode()
+        pending = PendingCommand(tag, name.upper(), msg_set)
+        self.pending.append(pending)
+
+        line = tag + b" " + " ".join((name,) + args).encode() + b"\r\n"
+        self.writer.write(self.deflate.compress(line) if self.deflate else line)
+        self.bytes_out += len(line)
+        return asyncio.wait_for(pending.future, self.timeout)
+
+    def uid_search(self, *criteria: str):
+        return self.command("UID SEARCH", *criteria)
+
+    def uid_fetch(self, msg_set: str, items: str):
+        return self.command("UID FETCH", msg_set, items, msg_set=msg_set)
+
+    def uid_store(self, msg_set: str, op: str, flags: str):
+        return self.command("UID STORE", msg_set, op, flags, msg_set=msg_set)
+
+    async def search_uids(self, *criteria: str):
+        status, data = await self.uid_search(*criteria)
+        if status != "OK":
+            raise AsyncImapError(f"UID SEARCH falló: {status}")
+        uids = []
+        for line in data:
+            if isinstance(line, bytes) and line.upper().startswith(b"SEARCH"):
+                uids += line.split()[1:]
+        return uids
+
+    # ---------- lectura ----------
+
+    async def read_response(self):
+        """
+        Lee una respuesta completa (con literales {n}) y la devuelve como
+        (línea_inicial, items_estilo_imaplib).
+        """
+        line = await self.stream.readline()
+        if not line:
+            raise AsyncImapError("Conexión cerrada por el servidor")
+        self.bytes_in += len(line)
+
+        items = []
+        head = line.rstrip(b"\r\n")
+        while True:
+            m = re.search(rb"\{(\d+)\}$", head)
+            if not m:
+                items.append(head)
+                break
+            literal = await self.stream.readexactly(int(m.group(1)))
+            self.bytes_in += len(literal)
+            items.append((head, literal))
+            nxt = await self.stream.readline()
+            self.bytes_in += len(nxt)
+            head = nxt.rstrip(b"\r\n")
+        return line, items
+
+    async def read_loop(self):
+        try:
+            while True:
+                line, items = await self.read_response()
+                if line.startswith(b"* "):
+                    self.route_untagged(items)
+                elif line.startswith(b"+"):
+                    continue
+                else:
+                    self.route_tagged(line.rstrip(b"\r\n"))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            for pending in self.pending:
+                if not pending.future.done():
+                    pending.future.set_exception(AsyncImapError(str(e)))
+            self.pending = []
+
+    def route_tagged(self, line: bytes):
+        tag, _, rest = line.partition(b" ")
+        for i, pending in enumerate(self.pending):
+            if pending.tag == tag:
+                del self.pending[i]
+                status = rest.split(b" ", 1)[0].decode().upper()
+                if pending.name == "COMPRESS" and status == "OK":
+                    # lo que sigue a este OK ya viene comprimido (y lo que se mande también)
+                    self.deflate = DeflateStream(self.reader)
+                    self.stream = self.deflate
+                if not pending.future.done():
+                    pending.future.set_result((status, pending.data))
+                return
+
+    def route_untagged(self, items):
+        # quitar el "* " inicial como hace imaplib
+        first = items[0]
+        if isinstance(first, tuple):
+            items[0] = (first[0][2:], first[1])
+            text = items[0][0]
+        else:
+            items[0] = first[2:]
+            text = items[0]
+
+        m = re.match(rb"(\d+) (\w+)", text)
+        kind = (m.group(2) if m else text.split(b" ", 1)[0]).upper()
+
+        target = None
+        if kind == b"FETCH":
+            # imaplib entrega b'12 (UID 34 ...' sin la palabra FETCH
+            if isinstance(items[0], tuple):
+                items[0] = (re.sub(rb"^(\d+) FETCH ", rb"\1 ", items[0][0], flags=re.I), items[0][1])
+            else:
+                items[0] = re.sub(rb"^(\d+) FETCH ", rb"\1 ", items[0], flags=re.I)
+            m_uid = re.search(rb"\bUID (\d+)", b" ".join(i[0] if isinstance(i, tuple) else i for i in items))
+            candidates = [p for p in self.pending if p.name in ("UID FETCH", "UID STORE")]
+            if m_uid:
+                uid = int(m_uid.group(1))
+                target = next((p for p in candidates if p.msg_set and uid_set_contains(p.msg_set, uid)), None)
+            target = target or (candidates[0] if candidates else None)
+        elif kind == b"SEARCH":
+            target = next((p for p in self.pending if p.name == "UID SEARCH"), None)
+        elif self.pending:
+            target = self.pending[0]
+
+        if target is None:
+            return
+        target.data.extend(items)
+
+
+def quote(s: str) -> str:
+    return '"' + s.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+async def fetch_pipelined(client: AsyncImapClient, batches, items: str, depth: int):
+    """
+    Manda los FETCH de 'batches' (lista de message sets) con hasta 'depth'
+    comandos en vuelo. Entrega (msg_set, status, data) a medida que terminan.
+    """
+    queue = asyncio.Queue()
+    sem = asyncio.Semaphore(depth)
+
+    async def one(msg_set):
+        async with sem:
+            try:
+                status, data = await client.uid_fetch(msg_set, items)
+            except Exception as e:
+                status, data = f"ERROR {e}", []
+        await queue.put((msg_set, status, data))
+
+    tasks = [asyncio.create_task(one(b)) for b in batches]
+    for _ in tasks:
+        yield await queue.get()
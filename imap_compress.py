@@ -0,0 +1,142 @@
+# imap_compress.py
+#
+# Extensión IMAP COMPRESS=DEFLATE (RFC 4978) para conexiones imaplib.
+# Tras LOGIN se manda "COMPRESS DEFLATE" y, si el servidor acepta, todo lo que
+# viaja por el socket va comprimido (zlib raw deflate, en ambos sentidos).
+# Los correos de alarma son texto/HTML y comprimen mucho: en backfills largos
+# baja el tráfico real y nos aleja del límite diario de descarga de Gmail.
+#
+# Lo usa connect() de los scripts:
+#   mail.login(...)
+#   enable_compression(mail)
+#   ...
+#   print(format_compression_stats(mail))
+#
+# Sin dependencias externas (solo stdlib).
+
+import io
+import zlib
+
+
+class DeflateSocket:
+    """
+    Envuelve el socket (SSL) de imaplib: sendall() comprime, la lectura
+    descomprime. imaplib solo usa sendall / makefile / settimeout / shutdown / close.
+    Cuenta bytes en el cable (comprimidos) y bytes reales (descomprimidos).
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self.decompressor = zlib.decompressobj(-15)
+        self.pending = b""
+        self.wire_in = 0
+        self.wire_out = 0
+        self.plain_in = 0
+        self.plain_out = 0
+
+    def sendall(self, data: bytes):
+        out = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.plain_out += len(data)
+        self.wire_out += len(out)
+        self.sock.sendall(out)
+
+    def recv(self, size: int) -> bytes:
+        while not self.pending:
+            chunk = self.sock.recv(max(size, 16384))
+            if not chunk:
+                return b""
+            self.wire_in += len(chunk)
+            self.pending = self.decompressor.decompress(chunk)
+            self.plain_in += len(self.pending)
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+    def makefile(self, mode: str = "rb"):
+        return io.BufferedReader(DeflateReader(self))
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def shutdown(self, how):
+        self.sock.shutdown(how)
+
+    def close(self):
+        self.sock.close()
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class DeflateReader(io.RawIOBase):
+    def __init__(self, dsock: DeflateSocket):
+        self.dsock = dsock
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buf) -> int:
+        data = self.dsock.recv(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+
+def supports_compression(mail) -> bool:
+    return "COMPRESS=DEFLATE" in mail.capabilities
+
+
+def enable_compression(mail) -> bool:
+    """
+    Negocia COMPRESS=DEFLATE en una conexión ya autenticada.
+    Muchos servidores (Gmail incluido) solo anuncian la capacidad después del
+    LOGIN, así que si no aparece se vuelve a pedir CAPABILITY una vez.
+    Devuelve True si la conexión quedó comprimida.
+    """
+    if isinstance(mail.sock, DeflateSocket):
+        return True
+
+    if not supports_compression(mail):
+        status, data = mail.capability()
+        if status == "OK" and data and data[-1]:
+            mail.capabilities = tuple(data[-1].decode().upper().split())
+        if not supports_compression(mail):
+            return False
+
+    status, _ = mail.xatom("COMPRESS", "DEFLATE")
+    if status != "OK":
+        return False
+
+    # desde aquí el servidor ya manda comprimido
+    mail.sock = DeflateSocket(mail.sock)
+    mail.file = mail.sock.makefile("rb")
+    return True
+
+
+def compression_stats(mail) -> dict:
+    """
+    Bytes reales vs bytes en el cable de la conexión (None si no está comprimida).
+    También sirve para imap_async.AsyncImapClient (modo --async del backfill).
+    """
+    if hasattr(mail, "deflate"):
+        return mail.compression_stats()
+    sock = getattr(mail, "sock", None)
+    if not isinstance(sock, DeflateSocket):
+        return None
+    return {
+        "plainIn": sock.plain_in,
+        "wireIn": sock.wire_in,
+        "plainOut": sock.plain_out,
+        "wireOut": sock.wire_out,
+    }
+
+
+def format_compression_stats(mail) -> str:
+    stats = compression_stats(mail)
+    if stats is None:
+        return "COMPRESS=DEFLATE: no activo (el servidor no lo ofrece o está deshabilitado)"
+    saved = 100.0 * (1 - stats["wireIn"] / stats["plainIn"]) if stats["plainIn"] else 0.0
+    return (
+        f"COMPRESS=DEFLATE: recibidos {stats['plainIn'] / 1048576:.2f} MB -> "
+        f"{stats['wireIn'] / 1048576:.2f} MB en el cable (ahorro {saved:.0f}%) | "
+        f"enviados {stats['plainOut']} B -> {stats['wireOut']} B"
+    )
@@ -0,0 +1,587 @@
+# imap_fetch.py
+#
+# Descarga IMAP compartida por los scripts (listener, backfill del mes, backfill de vehículos):
+#   - FETCH multi-mensaje por lotes de tamaño adaptativo: RFC822 completo o solo la
+#     parte de texto que usa extract_body_text (elegida por BODYSTRUCTURE)
+#   - pre-filtros de dedupe sin bajar cuerpos: cabeceras y X-GM-MSGID (Gmail)
+#   - filtro de SEARCH del lado del servidor (criterios IMAP o X-GM-RAW)
+#   - \Seen en lote (un STORE por lote)
+#
+# La configuración la leen los scripts de las variables de entorno:
+#   FETCHER = ImapFetcher(FETCH_MODE, FETCH_BATCH_INITIAL, ..., spool=SPOOL)
+#   SERVER_QUERY = ServerQuery(SERVER_QUERY_MODE, SERVER_QUERY_KEYWORDS, ...)
+#
+# Sin dependencias externas (solo stdlib).
+
+import email
+import imaplib
+import re
+import time
+
+from mime_body import parse_message_lazy
+
+
+def imap_quote(s: str) -> str:
+    return '"' + s.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def compact_id_set(msg_ids) -> str:
+    """
+    Arma un message set IMAP compacto: [1,2,3,7,9,10] -> '1:3,7,9:10'
+    """
+    nums = sorted({int(x) for x in msg_ids})
+    if not nums:
+        return ""
+    ranges = []
+    start = prev = nums[0]
+    for n in nums[1:]:
+        if n == prev + 1:
+            prev = n
+            continue
+        ranges.append(f"{start}:{prev}" if start != prev else str(start))
+        start = prev = n
+    ranges.append(f"{start}:{prev}" if start != prev else str(start))
+    return ",".join(ranges)
+
+
+def parse_fetch_response(data):
+    """
+    Agrupa la respuesta cruda de imaplib por mensaje.
+    imaplib entrega algo como:
+      [(b'12 (UID 34 RFC822 {1234}', b'<bytes>'), b')', (b'13 (UID 35 ...', ...), b')']
+    Devuelve lista de dicts: {"seq": b"12", "meta": b"UID 34 ...", "literals": {b"RFC822": b"..."}}
+    """
+    messages = []
+    current = None
+    for item in data or []:
+        if item is None:
+            continue
+        head, literal = item if isinstance(item, tuple) else (item, None)
+
+        m = re.match(rb"(\d+) \(", head)
+        if m:
+            current = {"seq": m.group(1), "meta": head[m.end():], "literals": {}}
+            messages.append(current)
+        elif current is None:
+            continue
+        else:
+            current["meta"] += head
+
+        if literal is not None:
+            m_name = re.search(rb"(RFC822(?:\.HEADER|\.TEXT)?|BODY\[[^\]]*\](?:<\d+>)?) \{\d+\}$", head, re.IGNORECASE)
+            if m_name:
+                current["literals"][m_name.group(1).upper()] = literal
+            else:
+                # literal dentro de una estructura (ej. BODYSTRUCTURE): se re-inserta como string
+                quoted = literal.replace(b"\\", b"\\\\").replace(b'"', b'\\"')
+                current["meta"] = re.sub(rb"\{\d+\}$", b"", current["meta"]) + b'"' + quoted + b'"'
+    return messages
+
+
+def fetch_uid_of(item):
+    m = re.search(rb"\bUID (\d+)", item["meta"])
+    return m.group(1) if m else None
+
+
+def parse_imap_list(data: bytes):
+    """
+    Parsea la primera lista IMAP de 'data' (ej. BODYSTRUCTURE) a listas de Python.
+    Strings/átomos -> bytes, NIL -> None.
+    """
+    tokens = re.findall(rb'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()"]+', data)
+    stack = []
+    for tok in tokens:
+        if tok == b"(":
+            stack.append([])
+            continue
+        if tok == b")":
+            done = stack.pop()
+            if not stack:
+                return done
+            stack[-1].append(done)
+            continue
+        if not stack:
+            continue
+        if tok.startswith(b'"'):
+            stack[-1].append(re.sub(rb"\\(.)", rb"\1", tok[1:-1]))
+        elif tok.upper() == b"NIL":
+            stack[-1].append(None)
+        else:
+            stack[-1].append(tok)
+    return None
+
+
+def bodystructure_parts(bs, section: str = ""):
+    """
+    Recorre un BODYSTRUCTURE en el mismo orden que msg.walk() y devuelve
+    (section, content_type, charset, encoding, is_attachment) por cada parte hoja.
+    """
+    if not isinstance(bs, list) or not bs:
+        return []
+
+    if isinstance(bs[0], list):
+        parts = []
+        idx = 0
+        for child in bs:
+            if not isinstance(child, list):
+                break
+            idx += 1
+            parts += bodystructure_parts(child, f"{section}.{idx}" if section else str(idx))
+        return parts
+
+    def s(x):
+        return x.decode("ascii", errors="ignore").lower() if isinstance(x, bytes) else ""
+
+    ctype = f"{s(bs[0])}/{s(bs[1])}"
+    params = bs[2] if len(bs) > 2 and isinstance(bs[2], list) else []
+    charset = None
+    for k, v in zip(params[::2], params[1::2]):
+        if s(k) == "charset":
+            charset = s(v)
+    encoding = s(bs[5]) if len(bs) > 5 else "7bit"
+    section = section or "1"
+
+    if ctype == "message/rfc822" and len(bs) > 8 and isinstance(bs[8], list):
+        inner = bs[8]
+        if isinstance(inner[0], list):
+            return bodystructure_parts(inner, section)
+        return bodystructure_parts(inner, f"{section}.1")
+
+    disp_idx = 9 if s(bs[0]) == "text" else 8
+    disp = bs[disp_idx] if len(bs) > disp_idx else None
+    is_attachment = isinstance(disp, list) and bool(disp) and s(disp[0]) == "attachment"
+
+    return [(section, ctype, charset, encoding or "7bit", is_attachment)]
+
+
+def choose_text_section(bs):
+    """
+    Misma elección que extract_body_text:
+    text/plain (no adjunto); si no hay, text/html (no adjunto).
+    Mensaje no multipart => su único cuerpo (sección 1).
+    Devuelve (section, content_type, charset, encoding) o None.
+    """
+    if not isinstance(bs, list) or not bs:
+        return None
+    parts = bodystructure_parts(bs)
+    if not isinstance(bs[0], list):
+        return parts[0][:4] if parts else None
+    for wanted in ("text/plain", "text/html"):
+        for section, ctype, charset, encoding, is_attachment in parts:
+            if ctype == wanted and not is_attachment:
+                return section, ctype, charset, encoding
+    return None
+
+
+def build_partial_message(header_bytes: bytes, choice, body: bytes):
+    """
+    Arma un email.message con las cabeceras pedidas + SOLO la parte de texto elegida.
+    extract_body_text la decodifica (base64 / quoted-printable / charset) igual que siempre.
+    """
+    ctype, charset, encoding = ("text/plain", None, "7bit") if choice is None else choice[1:]
+    head = header_bytes.rstrip(b"\r\n") + b"\r\n"
+    head += f"Content-Type: {ctype}".encode()
+    if charset:
+        head += f'; charset="{charset}"'.encode()
+    head += f"\r\nContent-Transfer-Encoding: {encoding}\r\n\r\n".encode()
+    return email.message_from_bytes(head + (body or b""))
+
+
+def flag_seen_batch(mail, msg_ids, use_uid: bool = False):
+    """
+    Marca como leídos los mensajes ya entregados con UN solo STORE
+    (+FLAGS.SILENT: el servidor no devuelve un FETCH por mensaje).
+    Si falla solo se avisa: la alerta ya está en la API y en cache.
+    """
+    if not msg_ids:
+        return
+    msg_set = compact_id_set(msg_ids)
+    try:
+        if use_uid:
+            status, _ = mail.uid("STORE", msg_set, "+FLAGS.SILENT", "(\\Seen)")
+        else:
+            status, _ = mail.store(msg_set, "+FLAGS.SILENT", "(\\Seen)")
+        if status != "OK":
+            print(f"No se pudo marcar como leídos ({len(msg_ids)}): {status}")
+    except Exception as e:
+        print(f"No se pudo marcar como leídos ({len(msg_ids)}): {e}")
+
+
+# ---------- RESPUESTAS DE FETCH (las usa ImapFetcher y el modo --async del backfill) ----------
+
+def parse_raw_messages(data, use_uid: bool = True) -> dict:
+    """
+    Respuesta de FETCH RFC822 -> {id: bytes crudos}.
+    """
+    raws = {}
+    for item in parse_fetch_response(data):
+        raw = item["literals"].get(b"RFC822")
+        key = fetch_uid_of(item) if use_uid else item["seq"]
+        if raw is not None and key is not None:
+            raws[int(key)] = raw
+    return raws
+
+
+def parse_text_sections(data, use_uid: bool = True) -> dict:
+    """
+    Respuesta de FETCH BODYSTRUCTURE -> {sección: {id: elección}} con la parte de texto
+    que usaría extract_body_text (sección None = sin parte de texto, solo cabeceras).
+    """
+    by_section = {}
+    for item in parse_fetch_response(data):
+        key = fetch_uid_of(item) if use_uid else item["seq"]
+        pos = item["meta"].upper().find(b"BODYSTRUCTURE")
+        if key is None or pos < 0:
+            continue
+        choice = choose_text_section(parse_imap_list(item["meta"][pos + len(b"BODYSTRUCTURE"):]))
+        by_section.setdefault(choice[0] if choice else None, {})[int(key)] = choice
+    return by_section
+
+
+def text_part_items(header_fields: str, section) -> str:
+    items = f"(UID BODY.PEEK[HEADER.FIELDS {header_fields}]"
+    return items + (f" BODY.PEEK[{section}])" if section else ")")
+
+
+def parse_text_parts(data, section, choices: dict, use_uid: bool = True):
+    """
+    Respuesta de FETCH text_part_items(...) -> ({id: msg parcial}, bytes_descargados).
+    """
+    by_id = {}
+    total_bytes = 0
+    for item in parse_fetch_response(data):
+        key = fetch_uid_of(item) if use_uid else item["seq"]
+        if key is None or int(key) not in choices:
+            continue
+        header_bytes = b""
+        body = b""
+        for name, value in item["literals"].items():
+            if name.startswith(b"BODY[HEADER"):
+                header_bytes = value
+            elif section and name.startswith(f"BODY[{section}]".encode()):
+                body = value
+        by_id[int(key)] = build_partial_message(header_bytes, choices[int(key)], body)
+        total_bytes += len(header_bytes) + len(body)
+    return by_id, total_bytes
+
+
+def parse_gmids(data, use_uid: bool = True) -> dict:
+    """
+    Respuesta de FETCH X-GM-MSGID -> {id: x_gm_msgid}.
+    """
+    gmids = {}
+    for item in parse_fetch_response(data):
+        key = fetch_uid_of(item) if use_uid else item["seq"]
+        m = re.search(rb"X-GM-MSGID (\d+)", item["meta"])
+        if key is not None and m:
+            gmids[int(key)] = m.group(1).decode()
+    return gmids
+
+
+def parse_header_keys(data, cache_key_of, use_uid: bool = True) -> dict:
+    """
+    Respuesta de FETCH BODY.PEEK[HEADER.FIELDS ...] -> {id: cache_key_of(bytes_cabeceras)}.
+    """
+    keys = {}
+    for item in parse_fetch_response(data):
+        header_bytes = next((v for k, v in item["literals"].items() if k.startswith(b"BODY[HEADER")), None)
+        key = fetch_uid_of(item) if use_uid else item["seq"]
+        if header_bytes is not None and key is not None:
+            keys[int(key)] = cache_key_of(header_bytes)
+    return keys
+
+
+# ---------- DESCARGA POR LOTES Y PRE-FILTROS ----------
+
+class ImapFetcher:
+    """
+    mode = "parts" (BODYSTRUCTURE + solo la parte de texto) | "full" (RFC822 completo).
+    El tamaño del lote se adapta al tamaño promedio de los correos (~target_bytes por FETCH).
+    Con 'spool' (raw_spool.RawSpool) lo ya guardado se lee de disco y lo que falta se baja completo.
+    """
+
+    def __init__(self, mode: str = "parts", batch_initial: int = 50, batch_min: int = 10,
+                 batch_max: int = 500, target_bytes: int = 4 * 1024 * 1024,
+                 header_fields: str = "(MESSAGE-ID SUBJECT DATE FROM)", header_batch_size: int = 500,
+                 spool=None):
+        self.mode = mode
+        self.batch_initial = batch_initial
+        self.batch_min = batch_min
+        self.batch_max = batch_max
+        self.target_bytes = target_bytes
+        self.header_fields = header_fields
+        self.header_batch_size = header_batch_size
+        self.spool = spool
+
+    def fetch_batch_full(self, mail, msg_set: str, use_uid: bool, spool_keys: dict = None):
+        """
+        Un FETCH RFC822 para todo el lote. Devuelve ({id: msg}, bytes_descargados) o None si falló.
+        Con spool activo guarda cada correo crudo bajo spool_keys[id].
+        """
+        if use_uid:
+            status, data = mail.uid("FETCH", msg_set, "(UID RFC822)")
+        else:
+            status, data = mail.fetch(msg_set, "(RFC822)")
+        if status != "OK":
+            print(f"Error al descargar lote ({msg_set}): {status}")
+            return None
+
+        by_id = {}
+        total_bytes = 0
+        for key, raw in parse_raw_messages(data, use_uid).items():
+            by_id[key] = parse_message_lazy(raw)
+            total_bytes += len(raw)
+            if self.spool is not None and spool_keys:
+                self.spool.put(spool_keys.get(key), raw)
+        return by_id, total_bytes
+
+    def fetch_batch_text_parts(self, mail, msg_set: str, use_uid: bool):
+        """
+        Igual que fetch_batch_full pero sin bajar adjuntos ni partes alternativas:
+          1) FETCH BODYSTRUCTURE del lote y se elige la parte que usaría extract_body_text
+          2) FETCH cabeceras + BODY.PEEK[<sección>] agrupando los mensajes por sección
+        """
+        fetch = (lambda ids, items: mail.uid("FETCH", ids, items)) if use_uid else mail.fetch
+
+        status, data = fetch(msg_set, "(UID BODYSTRUCTURE)")
+        if status != "OK":
+            print(f"Error al pedir BODYSTRUCTURE ({msg_set}): {status}")
+            return None
+
+        by_id = {}
+        total_bytes = 0
+        for section, choices in parse_text_sections(data, use_uid).items():
+            status, data = fetch(compact_id_set(choices), text_part_items(self.header_fields, section))
+            if status != "OK":
+                print(f"Error al descargar partes de texto ({section}): {status}")
+                return None
+            part_msgs, part_bytes = parse_text_parts(data, section, choices, use_uid)
+            by_id.update(part_msgs)
+            total_bytes += part_bytes
+        return by_id, total_bytes
+
+    def fetch_messages(self, mail, msg_ids, use_uid: bool = False, spool_keys: dict = None):
+        """
+        Descarga en lotes (un FETCH por lote, no uno por mensaje) y entrega un
+        stream de (msg_id, msg) ya parseados, en el orden de 'msg_ids'.
+        Con spool activo y 'spool_keys' ({id: clave}, ver filter_unprocessed_by_headers)
+        lo que ya está en disco no se pide al servidor.
+        Si un lote falla, entrega (msg_id, None) para cada ID del lote; igual para
+        cada ID que el servidor no devolvió en un FETCH que sí respondió OK.
+        """
+        use_spool = self.spool is not None and bool(spool_keys)
+        fetch_batch = self.fetch_batch_text_parts if self.mode == "parts" else self.fetch_batch_full
+        batch_size = self.batch_initial
+        avg_size = None
+        i = 0
+
+        while i < len(msg_ids):
+            batch = msg_ids[i:i + batch_size]
+            i += len(batch)
+
+            spooled = {}
+            if use_spool:
+                for msg_id in batch:
+                    raw = self.spool.get(spool_keys.get(int(msg_id)))
+                    if raw is not None:
+                        spooled[int(msg_id)] = parse_message_lazy(raw)
+                if len(spooled) == len(batch):
+                    for msg_id in batch:
+                        yield msg_id, spooled[int(msg_id)]
+                    continue
+
+            to_fetch = [m for m in batch if int(m) not in spooled]
+            try:
+                if use_spool:
+                    result = self.fetch_batch_full(mail, compact_id_set(to_fetch), use_uid, spool_keys)
+                else:
+                    result = fetch_batch(mail, compact_id_set(to_fetch), use_uid)
+            except (imaplib.IMAP4.abort, OSError):
+                raise
+            except Exception as e:
+                print(f"Error al descargar lote ({len(batch)} mensajes): {e}")
+                result = None
+
+            if result is None:
+                for msg_id in batch:
+                    yield msg_id, spooled.get(int(msg_id))
+                continue
+
+            # un ID pedido que no vino en la respuesta sale como None (falló): no se da por procesado
+            by_id, total_bytes = result
+            for msg_id in batch:
+                yield msg_id, spooled.get(int(msg_id)) or by_id.get(int(msg_id))
+
+            if by_id:
+                batch_avg = total_bytes / len(by_id)
+                avg_size = batch_avg if avg_size is None else 0.7 * avg_size + 0.3 * batch_avg
+                batch_size = int(self.target_bytes / max(avg_size, 1.0))
+                batch_size = max(self.batch_min, min(self.batch_max, batch_size))
+
+    def fetch_gmids(self, mail, msg_ids, use_uid: bool = False) -> dict:
+        """
+        FETCH (UID X-GM-MSGID) por lotes, sin cabeceras (solo Gmail). Devuelve {id: x_gm_msgid}.
+        """
+        gmids = {}
+        for i in range(0, len(msg_ids), self.header_batch_size):
+            batch = msg_ids[i:i + self.header_batch_size]
+            msg_set = compact_id_set(batch)
+            try:
+                if use_uid:
+                    status, data = mail.uid("FETCH", msg_set, "(UID X-GM-MSGID)")
+                else:
+                    status, data = mail.fetch(msg_set, "(X-GM-MSGID)")
+            except (imaplib.IMAP4.abort, OSError):
+                raise
+            except Exception as e:
+                status, data = f"ERROR {e}", None
+
+            if status != "OK":
+                print(f"Error al pedir X-GM-MSGID ({msg_set}): {status}")
+                continue
+
+            gmids.update(parse_gmids(data, use_uid))
+        return gmids
+
+    def filter_processed_by_gmid(self, mail, msg_ids, gmid_map: dict, use_uid: bool = False,
+                                 key_prefix: str = ""):
+        """
+        Pasada mínima (solo Gmail): descarta los mensajes cuyo X-GM-MSGID ya está en el mapa.
+        'key_prefix' = ámbito, igual que en la clave de cache: el mapa guarda key_prefix + X-GM-MSGID,
+        así el mismo correo leído para dos empresas no se descarta en la segunda.
+        Devuelve (ids_pendientes, {id: key_prefix + x_gm_msgid}).
+        """
+        gmids = {k: key_prefix + v for k, v in self.fetch_gmids(mail, msg_ids, use_uid).items()}
+        pending = [x for x in msg_ids if gmids.get(int(x)) not in gmid_map]
+        print(f"Pre-filtro X-GM-MSGID: {len(msg_ids)} candidato(s) | ya procesados={len(msg_ids) - len(pending)}")
+        return pending, gmids
+
+    def filter_unprocessed_by_headers(self, mail, msg_ids, processed_keys: set, cache_key_of,
+                                      use_uid: bool = False, gmids: dict = None, gmid_map: dict = None,
+                                      key_prefix: str = "", header_keys: dict = None):
+        """
+        Primera pasada liviana: baja SOLO las cabeceras
+        (BODY.PEEK[HEADER.FIELDS (MESSAGE-ID SUBJECT DATE FROM)]), arma la clave de cache
+        con 'cache_key_of(bytes_cabeceras)' (la misma que process_message) y descarta lo ya procesado.
+        Si se conoce el X-GM-MSGID de un mensaje ya procesado, se anota en 'gmid_map'
+        para que la próxima vez se descarte sin bajar cabeceras.
+        'key_prefix' = ámbito de la clave (ver Mailbox.key_prefix del listener).
+        Si se pasa 'header_keys' se llena con {id: clave sin ámbito} (la usa el spool, ver raw_spool.py).
+        Devuelve los IDs que sí hay que descargar completos (mismo orden).
+        """
+        if not msg_ids:
+            return []
+
+        item = f"(UID BODY.PEEK[HEADER.FIELDS {self.header_fields}])"
+        pending = []
+        cached = 0
+
+        for i in range(0, len(msg_ids), self.header_batch_size):
+            batch = msg_ids[i:i + self.header_batch_size]
+            msg_set = compact_id_set(batch)
+            try:
+                if use_uid:
+                    status, data = mail.uid("FETCH", msg_set, item)
+                else:
+                    status, data = mail.fetch(msg_set, item)
+            except (imaplib.IMAP4.abort, OSError):
+                raise
+            except Exception as e:
+                status, data = f"ERROR {e}", None
+
+            if status != "OK":
+                # sin cabeceras no podemos decidir => se descargan completos
+                print(f"Error al bajar cabeceras ({msg_set}): {status}")
+                pending.extend(batch)
+                continue
+
+            keys = parse_header_keys(data, cache_key_of, use_uid)
+            if header_keys is not None:
+                header_keys.update(keys)
+
+            for msg_id in batch:
+                key = keys.get(int(msg_id))
+                if key is not None and key_prefix + key in processed_keys:
+                    cached += 1
+                    gmid = (gmids or {}).get(int(msg_id))
+                    if gmid is not None and gmid_map is not None:
+                        gmid_map[gmid] = key_prefix + key
+                else:
+                    pending.append(msg_id)
+
+        print(f"Pre-filtro cabeceras: {len(msg_ids)} candidato(s) | ya en cache={cached} | a descargar={len(pending)}")
+        return pending
+
+
+# ---------- FILTRO DEL LADO DEL SERVIDOR (IMAP / X-GM-RAW) ----------
+
+def or_criteria(key: str, values) -> list:
+    """
+    OR anidado de IMAP: ["a","b","c"] -> OR TEXT "a" OR TEXT "b" TEXT "c"
+    """
+    if len(values) == 1:
+        return [key, imap_quote(values[0])]
+    return ["OR", key, imap_quote(values[0])] + or_criteria(key, values[1:])
+
+
+class ServerQuery:
+    """
+    Criterios extra de SEARCH para que el servidor devuelva solo candidatos a alarma:
+      none  = sin filtro | imap = OR TEXT "<palabra>" ... (substring en un servidor IMAP común)
+      gmraw = X-GM-RAW | auto = gmraw si el servidor es Gmail (X-GM-EXT-1), si no imap
+    Gmail busca por palabra completa (X-GM-RAW y también TEXT): ahí el filtro puede dejar
+    afuera correos que el filtro del cliente acepta, por eso los scripts lo dejan en none.
+    """
+
+    def __init__(self, mode: str, keywords, gmail_raw_query: str = "", from_filter: str = ""):
+        self.mode = mode
+        self.keywords = list(keywords)
+        self.gmail_raw_query = gmail_raw_query or " OR ".join(self.keywords)
+        self.from_filter = from_filter
+
+    def resolve_mode(self, mail, mode: str = None) -> str:
+        mode = mode or self.mode
+        if mode == "auto":
+            return "gmraw" if "X-GM-EXT-1" in mail.capabilities else "imap"
+        return mode
+
+    def criteria(self, mail, mode: str = None) -> list:
+        """
+        Lista vacía = sin filtro (se filtra en el cliente como siempre).
+        """
+        mode = self.resolve_mode(mail, mode)
+
+        if mode == "gmraw":
+            query = self.gmail_raw_query
+            if self.from_filter:
+                query = f"from:{self.from_filter} ({query})"
+            return ["X-GM-RAW", imap_quote(query)]
+
+        if mode == "imap" and self.keywords:
+            criteria = or_criteria("TEXT", self.keywords)
+            if self.from_filter:
+                criteria += ["FROM", imap_quote(self.from_filter)]
+            return criteria
+
+        return []
+
+    def benchmark(self, mail, base_criteria):
+        """
+        Modo benchmark (--bench-query): cuántos mensajes devuelve cada estrategia
+        de SEARCH sobre el mismo rango, y cuánto tarda.
+        """
+        modes = ["none", "imap"]
+        if "X-GM-EXT-1" in mail.capabilities:
+            modes.append("gmraw")
+
+        print(f"Benchmark de filtros de servidor sobre: {' '.join(base_criteria)}")
+        for mode in modes:
+            criteria = base_criteria + self.criteria(mail, mode)
+            t0 = time.perf_counter()
+            status, data = mail.search(None, *criteria)
+            elapsed = time.perf_counter() - t0
+            if status != "OK":
+                print(f"  {mode:<6} -> ERROR {status}")
+                continue
+            count = len(data[0].split()) if data and data[0] else 0
+            print(f"  {mode:<6} -> {count} mensaje(s) en {elapsed:.3f}s")
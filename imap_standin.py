@@ -0,0 +1,729 @@
+# imap_standin.py
+#
+# Servidor IMAP local (sin TLS) con un buzón sintético de alarmas estilo GEOMOV,
+# para probar / medir el listener y los backfills SIN tocar Gmail.
+#
+#   python3 imap_standin.py --messages 2000 --port 1143 --latency 0.03
+#
+# y luego, en otra terminal:
+#   ALERT_IMAP_HOST=127.0.0.1 ALERT_IMAP_PORT=1143 ALERT_IMAP_SSL=0 python3 gmail_alert_month_backfill.py
+#
+# Soporta lo que usan los scripts: CAPABILITY, LOGIN, ENABLE, SELECT/EXAMINE, STATUS,
+# NOOP, SEARCH (ALL, SINCE, BEFORE, ON, UID, TEXT, BODY, SUBJECT, FROM, OR, NOT,
+# SEEN/UNSEEN, X-GM-RAW), FETCH (UID, FLAGS, RFC822*, BODY[...] / BODY.PEEK[...],
+# BODYSTRUCTURE, X-GM-MSGID, MODSEQ, CHANGEDSINCE), STORE, IDLE, COMPRESS=DEFLATE.
+# Latencia inyectable por comando (--latency-search / --latency-fetch / ...).
+#
+# Lo usa bench_imap_standin.py (harness de benchmark). Solo stdlib.
+
+import argparse
+import email
+import random
+import re
+import socket
+import socketserver
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.header import decode_header, make_header
+from email.utils import format_datetime, parsedate_to_datetime
+
+LIMA_TZ = timezone(timedelta(hours=-5))
+
+DEFAULT_CAPS = "IMAP4rev1 IDLE UIDPLUS ENABLE CONDSTORE COMPRESS=DEFLATE"
+
+MONTHS_ES = ["ene", "feb", "mar", "abr", "may", "jun", "jul", "ago", "sep", "oct", "nov", "dic"]
+
+
+# ---------- BUZÓN SINTÉTICO ----------
+
+ALARM_KINDS = [
+    # (tipo en el asunto, peso)
+    ("IMPACTO", 30),
+    ("FRENADA BRUSCA", 25),
+    ("ACELERACION BRUSCA", 20),
+    ("CHECKLIST", 10),
+    ("EXCESO VELOCIDAD", 10),
+    ("SIN CONDICIONES", 5),
+]
+PLANTS = ["Planta Norte", "Planta Sur", "Planta Callao", "Sede Arequipa"]
+AREAS = ["Almacén 1", "Almacén 2", "Patio de maniobras", "Zona de carga", "Rampa 3"]
+OPERATORS = ["Juan Perez", "María Quispe", "Luis Huamán", "Rosa Díaz", "Carlos Rojas"]
+
+
+def make_geomov_message(i: int, kind: str = "IMPACTO", when: datetime = None, html: bool = False,
+                        attach_bytes: int = 0, rnd: random.Random = None, ref: str = None) -> bytes:
+    """
+    Un correo como los de GEOMOV:
+      Asunto 'Alarma - IMPACTO - MG069 (308FG25-3)' + cuerpo con Fecha/Hora, Planta, Área, Operador, DNI.
+    html=True => cuerpo solo text/html (como algunos reportes reales).
+    attach_bytes > 0 => multipart/mixed con un PDF falso de ese tamaño.
+    ref => línea 'Ref: <ref>' en el cuerpo (para correlacionar con lo que llega a la API).
+    """
+    rnd = rnd or random.Random(i)
+    when = when or datetime.now(timezone.utc)
+    lima = when.astimezone(LIMA_TZ)
+
+    vehicle = f"MG{rnd.randint(1, 150):03d}"
+    plate = f"{rnd.randint(100, 999)}FG{rnd.randint(10, 99)}-{rnd.randint(1, 9)}"
+    plant = rnd.choice(PLANTS)
+    area = rnd.choice(AREAS)
+    operator = rnd.choice(OPERATORS)
+
+    lines = [
+        f"Alarma Fecha: {lima.day:02d}-{MONTHS_ES[lima.month - 1].capitalize()}-{lima.year} Hora: {lima:%H:%M}",
+        f"Vehículo: {vehicle}  Placa: {plate}",
+        f"Planta: {plant}",
+        f"Área: {area}",
+        f"Operador: {operator}",
+        f"DNI: {rnd.randint(40000000, 79999999)}",
+    ]
+    if kind == "SIN CONDICIONES":
+        lines.append("Estado: SIN CONDICIONES - bloquea la operación del equipo")
+    if kind == "CHECKLIST":
+        lines.append("Checklist pre-uso: 2 observaciones")
+    if ref:
+        lines.append(f"Ref: {ref}")
+    lines.append("")
+    lines.append("Este es un mensaje automático del sistema de monitoreo. No responder.")
+    text = "\n".join(lines)
+
+    if html:
+        rows = "".join(f"<tr><td>{line}</td></tr>" for line in lines if line)
+        body_html = (
+            "<html><head><style>td{font-family:Arial;font-size:12px}</style></head><body>"
+            f"<div><p><b>Reporte de alarma</b></p><table>{rows}</table>"
+            "<br/><p>Saludos,<br>Centro de control</p></div></body></html>"
+        )
+        part = MIMEText(body_html, "html", "utf-8")
+    else:
+        part = MIMEText(text, "plain", "utf-8")
+
+    if attach_bytes:
+        outer = MIMEMultipart("mixed")
+        outer.attach(part)
+        pdf = MIMEApplication(b"%PDF-1.4\n" + bytes(rnd.getrandbits(8) for _ in range(attach_bytes)), Name="reporte.pdf")
+        pdf["Content-Disposition"] = 'attachment; filename="reporte.pdf"'
+        outer.attach(pdf)
+        part = outer
+
+    subject = f"Alarma - {kind} - {vehicle} ({plate})"
+    if kind == "CHECKLIST":
+        subject = f"Checklist - {vehicle} ({plate})"
+    part["Subject"] = subject
+    part["From"] = "Alertas GEOMOV <alertas@geomov.com>"
+    part["To"] = "monitoreo@example.com"
+    part["Date"] = format_datetime(when)
+    # estable entre corridas con la misma semilla (el spool / cache reconocen el mismo correo)
+    part["Message-ID"] = f"<{i}.{rnd.getrandbits(40)}.JavaMail.geomov@dbserver02>"
+    return part.as_bytes()
+
+
+class Mailbox:
+    """
+    Buzón en memoria (una sola carpeta). Cada mensaje:
+      {"uid", "flags", "raw", "date" (UTC), "gmid", "modseq"}
+    """
+
+    def __init__(self, uidvalidity: int = 1):
+        self.uidvalidity = uidvalidity
+        self.msgs = []
+        self.next_uid = 1
+        self.modseq = 1
+        self.lock = threading.Lock()
+        self.listeners = []  # sesiones en IDLE
+
+    def add(self, raw: bytes):
+        with self.lock:
+            msg = email.message_from_bytes(raw)
+            try:
+                date = parsedate_to_datetime(msg["Date"]).astimezone(timezone.utc)
+            except Exception:
+                date = datetime.now(timezone.utc)
+            self.modseq += 1
+            self.msgs.append({
+                "uid": self.next_uid, "flags": set(), "raw": raw, "date": date,
+                "gmid": 1600000000000000000 + self.next_uid, "modseq": self.modseq,
+            })
+            self.next_uid += 1
+            count = len(self.msgs)
+            listeners = list(self.listeners)
+        for notify in listeners:
+            notify(count)
+
+
+def build_synthetic_mailbox(count: int, start: datetime, end: datetime, html_ratio: float = 0.3,
+                            attach_ratio: float = 0.1, attach_bytes: int = 60000, seed: int = 7) -> Mailbox:
+    """
+    'count' alarmas repartidas al azar entre start y end (orden cronológico, como llegan a Gmail).
+    """
+    rnd = random.Random(seed)
+    kinds = [k for k, _ in ALARM_KINDS]
+    weights = [w for _, w in ALARM_KINDS]
+    span = (end - start).total_seconds()
+    dates = sorted(start + timedelta(seconds=rnd.random() * span) for _ in range(count))
+
+    mailbox = Mailbox()
+    for i, when in enumerate(dates):
+        mailbox.add(make_geomov_message(
+            i, rnd.choices(kinds, weights)[0], when,
+            html=rnd.random() < html_ratio,
+            attach_bytes=attach_bytes if rnd.random() < attach_ratio else 0,
+            rnd=random.Random(seed * 100003 + i),
+        ))
+    return mailbox
+
+
+# ---------- PROTOCOLO ----------
+
+def tokenize(s: str) -> list:
+    """
+    Tokens IMAP simples: átomos, "strings", paréntesis. BODY[...] queda en un solo token.
+    """
+    toks = []
+    i = 0
+    while i < len(s):
+        c = s[i]
+        if c == " ":
+            i += 1
+        elif c in "()":
+            toks.append(c)
+            i += 1
+        elif c == '"':
+            j = i + 1
+            buf = ""
+            while j < len(s) and s[j] != '"':
+                if s[j] == "\\":
+                    j += 1
+                buf += s[j]
+                j += 1
+            toks.append(buf)
+            i = j + 1
+        else:
+            j = i
+            depth = 0
+            while j < len(s) and (s[j] not in " ()" or depth):
+                if s[j] == "[":
+                    depth += 1
+                elif s[j] == "]":
+                    depth -= 1
+                j += 1
+            toks.append(s[i:j])
+            i = j
+    return toks
+
+
+def parse_set(spec: str, maxval: int) -> set:
+    out = set()
+    for part in spec.split(","):
+        if ":" in part:
+            a, b = part.split(":", 1)
+            a = maxval if a == "*" else int(a)
+            b = maxval if b == "*" else int(b)
+            out.update(range(min(a, b), max(a, b) + 1))
+        else:
+            out.add(maxval if part == "*" else int(part))
+    return out
+
+
+def imap_string(s) -> str:
+    if s is None:
+        return "NIL"
+    return '"' + str(s).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def bodystructure(part) -> str:
+    if part.is_multipart():
+        subs = "".join(bodystructure(p) for p in part.get_payload())
+        return f"({subs} {imap_string(part.get_content_subtype().upper())})"
+    maintype = part.get_content_maintype().upper()
+    subtype = part.get_content_subtype().upper()
+    params = part.get_params()[1:] if part.get_params() else []
+    plist = "(" + " ".join(f"{imap_string(k.upper())} {imap_string(v)}" for k, v in params) + ")" if params else "NIL"
+    enc = part.get("Content-Transfer-Encoding", "7BIT").upper()
+    payload = part.get_payload()
+    size = len(payload.encode() if isinstance(payload, str) else payload)
+    disp = part.get("Content-Disposition")
+    disp_str = f"({imap_string(disp.split(';')[0].strip().upper())} NIL)" if disp else "NIL"
+    base = f"{imap_string(maintype)} {imap_string(subtype)} {plist} NIL NIL {imap_string(enc)} {size}"
+    if maintype == "TEXT":
+        base += f" {(payload if isinstance(payload, str) else '').count(chr(10))}"
+    return f"({base} NIL {disp_str} NIL)"
+
+
+def split_header_body(raw: bytes):
+    for sep in (b"\r\n\r\n", b"\n\n"):
+        if sep in raw:
+            head, body = raw.split(sep, 1)
+            return head, body
+    return raw, b""
+
+
+def search_text(m: dict, part: str) -> str:
+    """
+    Texto donde busca SEARCH, como lo hace un servidor real (no sobre los bytes crudos):
+      header = cabeceras con RFC 2047 decodificado | body = partes de texto decodificadas
+      (base64 / quoted-printable / charset) | text = ambas.
+    En minúsculas (str.lower). Se calcula una vez por mensaje.
+    """
+    key = "search_" + part
+    if key not in m:
+        msg = email.message_from_bytes(m["raw"])
+        if part == "header":
+            m[key] = "\n".join(f"{k}: {decode_header_value(v)}" for k, v in msg.items()).lower()
+        elif part == "body":
+            texts = []
+            for sub in msg.walk():
+                if sub.get_content_maintype() != "text":
+                    continue
+                payload = sub.get_payload(decode=True) or b""
+                texts.append(payload.decode(sub.get_content_charset() or "utf-8", "replace"))
+            m[key] = "\n".join(texts).lower()
+        else:
+            m[key] = search_text(m, "header") + "\n" + search_text(m, "body")
+    return m[key]
+
+
+def decode_header_value(value) -> str:
+    try:
+        return str(make_header(decode_header(str(value))))
+    except Exception:
+        return str(value)
+
+
+def section_bytes(raw: bytes, section: str) -> bytes:
+    su = section.upper()
+    head, body = split_header_body(raw)
+    if su == "":
+        return raw
+    if su == "HEADER":
+        return head + b"\r\n\r\n"
+    if su == "TEXT":
+        return body
+    if su.startswith("HEADER.FIELDS"):
+        names = {n.lower() for n in re.findall(r"[\w-]+", su[len("HEADER.FIELDS"):]) if n.upper() != "NOT"}
+        fields = []
+        for line in re.split(rb"\r?\n", head):
+            if line[:1] in (b" ", b"\t") and fields:
+                fields[-1].append(line)
+            else:
+                fields.append([line])
+        keep = [b"\r\n".join(f) for f in fields if f[0].split(b":")[0].decode(errors="ignore").lower() in names]
+        return b"\r\n".join(keep) + b"\r\n\r\n"
+
+    part = email.message_from_bytes(raw)
+    for n in section.split("."):
+        n = int(n)
+        if part.is_multipart():
+            part = part.get_payload()[n - 1]
+        elif n != 1:
+            raise ValueError(f"sección inválida {section}")
+    payload = part.get_payload()
+    return payload.encode() if isinstance(payload, str) else payload
+
+
+class DeflateWriter:
+    closed = False
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        self.buf = b""
+
+    def write(self, data: bytes):
+        self.buf += data
+
+    def flush(self):
+        if self.buf:
+            self.sock.sendall(self.compressor.compress(self.buf) + self.compressor.flush(zlib.Z_SYNC_FLUSH))
+            self.buf = b""
+
+    def close(self):
+        self.flush()
+
+
+class DeflateLineReader:
+    closed = False
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.decompressor = zlib.decompressobj(-15)
+        self.buf = b""
+
+    def readline(self) -> bytes:
+        while b"\n" not in self.buf:
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                line, self.buf = self.buf, b""
+                return line
+            self.buf += self.decompressor.decompress(chunk)
+        i = self.buf.index(b"\n") + 1
+        line, self.buf = self.buf[:i], self.buf[i:]
+        return line
+
+    def close(self):
+        pass
+
+
+class StandinHandler(socketserver.StreamRequestHandler):
+
+    def send(self, line):
+        if isinstance(line, str):
+            line = line.encode()
+        self.wfile.write(line + b"\r\n")
+        self.wfile.flush()
+
+    def delay(self, cmd: str):
+        seconds = self.server.latency.get(cmd, self.server.latency.get("*", 0.0))
+        if seconds:
+            time.sleep(seconds)
+
+    def handle(self):
+        # sin Nagle: respuestas de varias líneas chicas + ACK retrasado del cliente = ~40 ms
+        # extra por comando, que no existe contra Gmail y ensuciaría las mediciones
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send("* OK [CAPABILITY " + self.server.caps + "] imap_standin listo")
+        self.condstore = False  # RFC 7162: HIGHESTMODSEQ en el SELECT solo tras ENABLE o SELECT (CONDSTORE)
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            line = line.decode(errors="ignore").rstrip("\r\n")
+            tag, _, rest = line.partition(" ")
+            cmd, _, args = rest.partition(" ")
+            cmd = cmd.upper()
+            use_uid = cmd == "UID"
+            if use_uid:
+                cmd, _, args = args.partition(" ")
+                cmd = cmd.upper()
+
+            with self.server.stats_lock:
+                self.server.command_counts[cmd] = self.server.command_counts.get(cmd, 0) + 1
+            self.delay(cmd)
+
+            try:
+                if cmd == "LOGOUT":
+                    self.send("* BYE cerrando")
+                    self.send(f"{tag} OK LOGOUT completado")
+                    return
+                if cmd == "IDLE":
+                    self.idle(tag)
+                    continue
+                if cmd == "COMPRESS":
+                    self.send(f"{tag} OK DEFLATE activo")
+                    self.wfile = DeflateWriter(self.request)
+                    self.rfile = DeflateLineReader(self.request)
+                    continue
+                if not self.dispatch(tag, cmd, args, use_uid):
+                    self.send(f"{tag} BAD comando no soportado: {cmd}")
+                    continue
+                self.send(f"{tag} OK {cmd} completado")
+            except Exception as e:
+                self.send(f"{tag} BAD {e}")
+
+    def dispatch(self, tag, cmd, args, use_uid) -> bool:
+        mb = self.server.mailbox
+        if cmd == "CAPABILITY":
+            self.send("* CAPABILITY " + self.server.caps)
+        elif cmd in ("LOGIN", "AUTHENTICATE"):
+            pass
+        elif cmd == "ENABLE":
+            self.condstore = self.condstore or "CONDSTORE" in args.upper()
+            self.send("* ENABLED " + args)
+        elif cmd in ("SELECT", "EXAMINE"):
+            self.condstore = self.condstore or "(CONDSTORE)" in args.upper()
+            with mb.lock:
+                self.send(f"* {len(mb.msgs)} EXISTS")
+                self.send("* FLAGS (\\Seen \\Answered \\Flagged \\Deleted \\Draft)")
+                self.send(f"* OK [UIDVALIDITY {mb.uidvalidity}] UIDs válidos")
+                self.send(f"* OK [UIDNEXT {mb.next_uid}] próximo UID")
+                if "CONDSTORE" in self.server.caps and self.condstore:
+                    self.send(f"* OK [HIGHESTMODSEQ {mb.modseq}] modseq")
+        elif cmd == "STATUS":
+            self.send(f"* STATUS INBOX (MESSAGES {len(mb.msgs)} UIDVALIDITY {mb.uidvalidity} UIDNEXT {mb.next_uid})")
+        elif cmd == "NOOP":
+            with mb.lock:
+                self.send(f"* {len(mb.msgs)} EXISTS")
+        elif cmd == "SEARCH":
+            found = self.search(tokenize(args), use_uid)
+            self.send("* SEARCH" + "".join(f" {n}" for n in found))
+        elif cmd == "FETCH":
+            self.fetch(args, use_uid)
+        elif cmd == "STORE":
+            self.store(args, use_uid)
+        else:
+            return False
+        return True
+
+    def idle(self, tag):
+        mb = self.server.mailbox
+
+        def notify(count):
+            try:
+                self.delay("IDLE")
+                self.send(f"* {count} EXISTS")
+            except Exception:
+                pass
+
+        self.send("+ idling")
+        with mb.lock:
+            mb.listeners.append(notify)
+        try:
+            self.rfile.readline()  # DONE
+        finally:
+            with mb.lock:
+                mb.listeners.remove(notify)
+        self.send(f"{tag} OK IDLE terminado")
+
+    def search(self, toks, use_uid) -> list:
+        mb = self.server.mailbox
+        if toks and toks[0].upper() == "CHARSET":
+            toks = toks[2:]
+        with mb.lock:
+            msgs = list(enumerate(mb.msgs, 1))
+            max_uid = mb.next_uid - 1
+        pos = [0]
+
+        def take():
+            tok = toks[pos[0]]
+            pos[0] += 1
+            return tok
+
+        def criterion():
+            t = take().upper()
+            if t == "ALL":
+                return lambda seq, m: True
+            if t == "(":
+                subs = []
+                while toks[pos[0]] != ")":
+                    subs.append(criterion())
+                pos[0] += 1
+                return lambda seq, m: all(f(seq, m) for f in subs)
+            if t == "OR":
+                a, b = criterion(), criterion()
+                return lambda seq, m: a(seq, m) or b(seq, m)
+            if t == "NOT":
+                a = criterion()
+                return lambda seq, m: not a(seq, m)
+            if t in ("SINCE", "BEFORE", "ON"):
+                day = datetime.strptime(take(), "%d-%b-%Y").date()
+                if t == "SINCE":
+                    return lambda seq, m: m["date"].astimezone(LIMA_TZ).date() >= day
+                if t == "BEFORE":
+                    return lambda seq, m: m["date"].astimezone(LIMA_TZ).date() < day
+                return lambda seq, m: m["date"].astimezone(LIMA_TZ).date() == day
+            if t == "UID":
+                uids = parse_set(take(), max_uid)
+                return lambda seq, m: m["uid"] in uids
+            if t in ("TEXT", "BODY", "SUBJECT", "FROM"):
+                needle = take().lower()
+
+                def match(seq, m, t=t, needle=needle):
+                    if t in ("SUBJECT", "FROM"):
+                        head = email.message_from_bytes(split_header_body(m["raw"])[0])
+                        return needle in decode_header_value(head.get(t.capitalize(), "")).lower()
+                    return needle in search_text(m, "text" if t == "TEXT" else "body")
+                return match
+            if t == "X-GM-RAW":
+                query = take().lower()
+                words = [w for w in re.split(r"[\s{}()]+", query) if w and w != "or" and ":" not in w]
+                return lambda seq, m: any(w in m["raw"].decode("utf-8", "ignore").lower() for w in words)
+            if t == "MODSEQ":
+                value = int(take())
+                return lambda seq, m: m["modseq"] >= value
+            if t in ("SEEN", "UNSEEN"):
+                return lambda seq, m, t=t: ("\\Seen" in m["flags"]) == (t == "SEEN")
+            if re.match(r"^[\d*:,]+$", t):
+                seqs = parse_set(t, len(msgs))
+                return lambda seq, m: seq in seqs
+            raise ValueError(f"criterio no soportado: {t}")
+
+        filters = []
+        while pos[0] < len(toks):
+            filters.append(criterion())
+        return [m["uid"] if use_uid else seq for seq, m in msgs if all(f(seq, m) for f in filters)]
+
+    def select_msgs(self, spec: str, use_uid: bool):
+        mb = self.server.mailbox
+        with mb.lock:
+            msgs = list(enumerate(mb.msgs, 1))
+            max_uid = mb.next_uid - 1
+        if use_uid:
+            wanted = parse_set(spec, max_uid)
+            return [(seq, m) for seq, m in msgs if m["uid"] in wanted]
+        wanted = parse_set(spec, len(msgs))
+        return [(seq, m) for seq, m in msgs if seq in wanted]
+
+    def fetch(self, args: str, use_uid: bool):
+        spec, _, items = args.partition(" ")
+        changedsince = None
+        m_cs = re.search(r"\(CHANGEDSINCE (\d+)\)\s*$", items, re.IGNORECASE)
+        if m_cs:
+            changedsince = int(m_cs.group(1))
+            items = items[:m_cs.start()]
+        items = items.strip()
+        if items.startswith("(") and items.endswith(")"):
+            items = items[1:-1]
+        names = tokenize(items)
+        upper = [n.upper() for n in names]
+
+        for seq, m in self.select_msgs(spec, use_uid):
+            if changedsince is not None and m["modseq"] <= changedsince:
+                continue
+            parts = []
+            if (use_uid or changedsince is not None) and "UID" not in upper:
+                parts.append(f"UID {m['uid']}")
+            for name, u in zip(names, upper):
+                if u == "UID":
+                    parts.append(f"UID {m['uid']}")
+                elif u == "FLAGS":
+                    parts.append("FLAGS (" + " ".join(sorted(m["flags"])) + ")")
+                elif u == "INTERNALDATE":
+                    parts.append(f'INTERNALDATE "{m["date"]:%d-%b-%Y %H:%M:%S +0000}"')
+                elif u == "RFC822.SIZE":
+                    parts.append(f"RFC822.SIZE {len(m['raw'])}")
+                elif u == "X-GM-MSGID":
+                    parts.append(f"X-GM-MSGID {m['gmid']}")
+                elif u == "MODSEQ":
+                    parts.append(f"MODSEQ ({m['modseq']})")
+                elif u == "BODYSTRUCTURE":
+                    parts.append("BODYSTRUCTURE " + bodystructure(email.message_from_bytes(m["raw"])))
+                elif u in ("RFC822", "RFC822.HEADER", "RFC822.TEXT"):
+                    section = {"RFC822": "", "RFC822.HEADER": "HEADER", "RFC822.TEXT": "TEXT"}[u]
+                    parts.append((u, section_bytes(m["raw"], section)))
+                    if u != "RFC822.HEADER":
+                        m["flags"].add("\\Seen")
+                elif u.startswith("BODY[") or u.startswith("BODY.PEEK["):
+                    section = name[name.index("[") + 1:name.rindex("]")]
+                    parts.append((f"BODY[{section}]", section_bytes(m["raw"], section)))
+                    if u.startswith("BODY["):
+                        m["flags"].add("\\Seen")
+                else:
+                    raise ValueError(f"item FETCH no soportado: {name}")
+            if changedsince is not None and "MODSEQ" not in upper:
+                parts.append(f"MODSEQ ({m['modseq']})")
+
+            out = f"* {seq} FETCH (".encode()
+            for k, p in enumerate(parts):
+                if k:
+                    out += b" "
+                if isinstance(p, tuple):
+                    out += f"{p[0]} {{{len(p[1])}}}\r\n".encode() + p[1]
+                else:
+                    out += p.encode()
+            self.send(out + b")")
+
+    def store(self, args: str, use_uid: bool):
+        spec, _, rest = args.partition(" ")
+        op, _, flags = rest.partition(" ")
+        op = op.upper()
+        flags = set(flags.strip().strip("()").split())
+        mb = self.server.mailbox
+        for seq, m in self.select_msgs(spec, use_uid):
+            with mb.lock:
+                if op.startswith("+"):
+                    m["flags"] |= flags
+                elif op.startswith("-"):
+                    m["flags"] -= flags
+                else:
+                    m["flags"] = set(flags)
+                mb.modseq += 1
+                m["modseq"] = mb.modseq
+            if ".SILENT" not in op:
+                self.send(f"* {seq} FETCH (UID {m['uid']} FLAGS ({' '.join(sorted(m['flags']))}))")
+
+
+class StandinServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def start_server(mailbox: Mailbox, host: str = "127.0.0.1", port: int = 0, caps: str = DEFAULT_CAPS,
+                 latency: dict = None) -> StandinServer:
+    """
+    Arranca el servidor en un hilo y lo devuelve (server.server_address[1] = puerto real).
+    latency = {"SEARCH": 0.05, "FETCH": 0.02, "*": 0.01, ...} segundos por comando.
+    """
+    server = StandinServer((host, port), StandinHandler)
+    server.mailbox = mailbox
+    server.caps = caps
+    server.latency = latency or {}
+    server.command_counts = {}
+    server.stats_lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def latency_from_args(args) -> dict:
+    latency = {"*": args.latency}
+    for cmd in ("search", "fetch", "store", "idle"):
+        value = getattr(args, f"latency_{cmd}")
+        if value is not None:
+            latency[cmd.upper()] = value
+    return latency
+
+
+def add_server_args(parser: argparse.ArgumentParser):
+    parser.add_argument("--messages", type=int, default=1000, help="correos sintéticos en el buzón")
+    parser.add_argument("--days", type=int, default=0,
+                        help="repartir los correos en los últimos N días (0 = mes actual hasta hoy, hora Lima)")
+    parser.add_argument("--html-ratio", type=float, default=0.3, help="fracción de correos solo HTML")
+    parser.add_argument("--attach-ratio", type=float, default=0.1, help="fracción con PDF adjunto")
+    parser.add_argument("--attach-bytes", type=int, default=60000, help="tamaño del PDF adjunto")
+    parser.add_argument("--caps", default=DEFAULT_CAPS, help="capacidades anunciadas")
+    parser.add_argument("--latency", type=float, default=0.0, help="latencia por comando (s)")
+    parser.add_argument("--latency-search", type=float, default=None)
+    parser.add_argument("--latency-fetch", type=float, default=None)
+    parser.add_argument("--latency-store", type=float, default=None)
+    parser.add_argument("--latency-idle", type=float, default=None, help="demora de los avisos EXISTS en IDLE")
+    parser.add_argument("--seed", type=int, default=7)
+
+
+def mailbox_range(days: int):
+    now = datetime.now(LIMA_TZ)
+    if days:
+        return now - timedelta(days=days), now
+    return now.replace(day=1, hour=0, minute=0, second=0, microsecond=0), now
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor IMAP local con alarmas GEOMOV sintéticas")
+    add_server_args(parser)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1143)
+    parser.add_argument("--arrivals-per-minute", type=float, default=0.0,
+                        help="si > 0, sigue agregando alarmas nuevas a ese ritmo (para el listener)")
+    args = parser.parse_args()
+
+    start, end = mailbox_range(args.days)
+    print(f"Generando {args.messages} correos sintéticos ({start:%Y-%m-%d} -> {end:%Y-%m-%d %H:%M}, hora Lima)…")
+    mailbox = build_synthetic_mailbox(args.messages, start, end, args.html_ratio, args.attach_ratio,
+                                      args.attach_bytes, args.seed)
+    server = start_server(mailbox, args.host, args.port, args.caps, latency_from_args(args))
+    print(f"imap_standin escuchando en {args.host}:{server.server_address[1]} | caps: {args.caps}")
+    print(f"  ALERT_IMAP_HOST={args.host} ALERT_IMAP_PORT={server.server_address[1]} ALERT_IMAP_SSL=0")
+
+    rnd = random.Random(args.seed + 1)
+    kinds = [k for k, _ in ALARM_KINDS]
+    weights = [w for _, w in ALARM_KINDS]
+    i = args.messages
+    try:
+        while True:
+            if args.arrivals_per_minute > 0:
+                time.sleep(rnd.expovariate(args.arrivals_per_minute / 60.0))
+                mailbox.add(make_geomov_message(i, rnd.choices(kinds, weights)[0], datetime.now(timezone.utc),
+                                                html=rnd.random() < args.html_ratio))
+                i += 1
+            else:
+                time.sleep(60)
+            print(f"Comandos recibidos: {server.command_counts}")
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
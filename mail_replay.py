@@ -0,0 +1,111 @@
+# mail_replay.py
+#
+# Reproceso offline: en vez de IMAP, los scripts leen un export de correo
+#   - archivo mbox (Google Takeout, Thunderbird, etc.)
+#   - carpeta Maildir (cur/ new/ tmp/)
+#   - carpeta con archivos .eml (incluye el spool de raw_spool.py)
+#   - un solo archivo .eml
+# y corren el MISMO parseo / filtro / payload, tan rápido como dé la CPU.
+# Con --ndjson los payloads se escriben a un archivo (una línea JSON por alerta)
+# en vez de mandarse a la API: sirve para cargas históricas revisables y como
+# benchmark determinístico del parseo.
+#
+#   python3 gmail_alert_month_backfill.py --replay export.mbox
+#   python3 gmail_alert_month_backfill.py --replay ~/Maildir --ndjson alertas.ndjson
+#   python3 gmail_alert_listener.py --replay cache/spool --ndjson hoy.ndjson
+#   python3 gmail_vehicle_backfill_range.py --replay export.mbox --ndjson vehiculos.ndjson
+#
+# Sin dependencias externas (solo stdlib).
+
+import json
+import mailbox
+import os
+import threading
+
+
+def replay_options(argv):
+    """
+    (ruta_export, ruta_ndjson) desde la línea de comandos; None si no se pidió.
+    """
+    def value_of(flag):
+        if flag in argv:
+            idx = argv.index(flag)
+            if idx + 1 < len(argv):
+                return argv[idx + 1]
+            raise SystemExit(f"Falta el valor de {flag}")
+        return None
+
+    return value_of("--replay"), value_of("--ndjson")
+
+
+def is_maildir(path: str) -> bool:
+    return all(os.path.isdir(os.path.join(path, d)) for d in ("cur", "new", "tmp"))
+
+
+def iter_replay_messages(path: str):
+    """
+    Entrega (referencia, bytes_crudos) de cada correo del export, en orden estable
+    (mbox: orden del archivo; Maildir / carpeta: nombre de archivo).
+    """
+    if os.path.isdir(path):
+        if is_maildir(path):
+            box = mailbox.Maildir(path, factory=None, create=False)
+            for key in sorted(box.keys()):
+                with box.get_file(key) as f:
+                    yield key, f.read()
+            return
+
+        files = []
+        for dirpath, _, names in os.walk(path):
+            files += [os.path.join(dirpath, n) for n in names if n.lower().endswith(".eml")]
+        for fp in sorted(files):
+            with open(fp, "rb") as f:
+                yield os.path.relpath(fp, path), f.read()
+        return
+
+    if path.lower().endswith(".eml"):
+        with open(path, "rb") as f:
+            yield os.path.basename(path), f.read()
+        return
+
+    if not os.path.isfile(path):
+        raise SystemExit(f"No existe el export: {path}")
+
+    box = mailbox.mbox(path, factory=None, create=False)
+    try:
+        for i, key in enumerate(box.iterkeys(), 1):
+            yield f"mbox#{i}", box.get_bytes(key)
+    finally:
+        box.close()
+
+
+class NdjsonSink:
+    """
+    Destino alternativo a la API: una línea JSON por payload. Seguro entre hilos.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.count = 0
+        self.file = open(path, "w", encoding="utf-8")
+
+    def write(self, record: dict) -> bool:
+        line = json.dumps(record, ensure_ascii=False, sort_keys=True)
+        with self.lock:
+            self.file.write(line + "\n")
+            self.count += 1
+        return True
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def format_replay_stats(total: int, sent: int, skipped: int, seconds: float, sink: NdjsonSink = None) -> str:
+    rate = total / seconds if seconds > 0 else 0.0
+    target = f"NDJSON {sink.path}" if sink is not None else "API"
+    return (
+        f"Replay: {total} correos en {seconds:.2f}s ({rate:.1f} correos/s) | "
+        f"enviados a {target}: {sent} | saltados: {skipped}"
+    )
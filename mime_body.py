@@ -0,0 +1,198 @@
+# mime_body.py
+#
+# Extracción del cuerpo de texto de un correo en UNA pasada y sin parsear de más:
+#   - parse_message_lazy(raw): parsea SOLO las cabeceras (Subject / From / Date /
+#     Message-ID quedan disponibles igual que siempre); el cuerpo queda crudo.
+#   - extract_body_text(msg): recorre la estructura MIME una sola vez buscando la
+#     parte preferida (text/plain; si no hay, text/html), con las mismas reglas que
+#     la versión anterior (dos recorridos de msg.walk()). De cada parte solo se leen
+#     sus cabeceras; el contenido se decodifica únicamente para la parte elegida,
+#     así que los adjuntos (PDF en base64, imágenes) nunca se parsean ni decodifican.
+#
+# Acepta también mensajes ya parseados completos (email.message_from_bytes) o
+# armados a mano (build_partial_message): en ese caso hace un único msg.walk().
+#
+# Lo usan los scripts (process_message / evaluate_message). Benchmark contra la
+# versión anterior en bench_parsing.py. Solo stdlib.
+
+import email
+from email.parser import BytesParser
+
+_HEADERS_ONLY = BytesParser()
+
+
+def parse_message_lazy(raw: bytes):
+    """
+    Como email.message_from_bytes(raw) pero sin parsear el cuerpo:
+    el payload queda como texto crudo (ascii + surrogateescape, sin pérdida).
+    """
+    head, body = split_head_body(raw)
+    msg = email.message_from_bytes(head)
+    if msg.get_payload():
+        # bloque de cabeceras con líneas inválidas: que decida el parser de siempre
+        return _HEADERS_ONLY.parsebytes(raw, headersonly=True)
+    msg.set_payload(body.decode("ascii", errors="surrogateescape"))
+    return msg
+
+
+def decode_part_text(part):
+    """
+    Payload decodificado (base64 / quoted-printable + charset) o None si no se pudo,
+    igual que el try/except de la versión anterior.
+    """
+    try:
+        return part.get_payload(decode=True).decode(part.get_content_charset() or "utf-8", errors="ignore")
+    except Exception:
+        return None
+
+
+def is_inline_text(part) -> bool:
+    return "attachment" not in str(part.get("Content-Disposition", ""))
+
+
+def split_head_body(data: bytes):
+    """
+    (cabeceras, cuerpo) de una parte MIME cruda. Sin línea en blanco => todo son cabeceras.
+    """
+    if data.startswith(b"\r\n"):
+        return b"", data[2:]
+    if data.startswith(b"\n"):
+        return b"", data[1:]
+    crlf = data.find(b"\r\n\r\n")
+    lf = data.find(b"\n\n")
+    if crlf >= 0 and (lf < 0 or crlf < lf):
+        return data[:crlf + 2], data[crlf + 4:]
+    if lf >= 0:
+        return data[:lf + 1], data[lf + 2:]
+    return data, b""
+
+
+def find_delimiter(body: bytes, delim: bytes, start: int) -> int:
+    """
+    Próxima línea que empieza con '--boundary' (seguido de fin de línea, espacios o '--').
+    """
+    i = body.find(delim, start)
+    while i >= 0:
+        at_line_start = i == 0 or body[i - 1:i] == b"\n"
+        nxt = body[i + len(delim):i + len(delim) + 1]
+        if at_line_start and nxt in (b"", b"\r", b"\n", b"-", b" ", b"\t"):
+            return i
+        i = body.find(delim, i + 1)
+    return -1
+
+
+def split_multipart(body: bytes, boundary: str):
+    """
+    Partes crudas de un cuerpo multipart (sin preámbulo ni epílogo).
+    Si falta el delimitador de cierre, la última parte llega hasta el final (como feedparser).
+    """
+    delim = b"--" + boundary.encode("ascii", errors="surrogateescape")
+    parts = []
+    pos = find_delimiter(body, delim, 0)
+    while pos >= 0:
+        if body[pos + len(delim):pos + len(delim) + 2] == b"--":
+            break
+        line_end = body.find(b"\n", pos)
+        if line_end < 0:
+            break
+        start = line_end + 1
+        nxt = find_delimiter(body, delim, start)
+        end = nxt if nxt >= 0 else len(body)
+        part = body[start:end]
+        if nxt >= 0:
+            # el CRLF antes del delimitador pertenece al delimitador
+            if part.endswith(b"\r\n"):
+                part = part[:-2]
+            elif part.endswith(b"\n"):
+                part = part[:-1]
+        parts.append(part)
+        pos = nxt
+    return parts
+
+
+def iter_text_candidates(head, body: bytes):
+    """
+    Recorre el árbol MIME en el mismo orden que msg.walk() y entrega (part, body)
+    de cada parte text/plain o text/html que no sea adjunto. 'part' tiene solo
+    cabeceras; 'body' es su contenido crudo (sin decodificar).
+    """
+    maintype = head.get_content_maintype()
+    if maintype == "multipart":
+        boundary = head.get_boundary()
+        if not boundary:
+            return
+        digest = head.get_content_subtype() == "digest"
+        for raw_part in split_multipart(body, boundary):
+            head_bytes, sub_body = split_head_body(raw_part)
+            sub = email.message_from_bytes(head_bytes)
+            if digest:
+                sub.set_default_type("message/rfc822")
+            yield from iter_text_candidates(sub, sub_body)
+        return
+
+    if head.get_content_type() == "message/rfc822":
+        head_bytes, sub_body = split_head_body(body)
+        yield from iter_text_candidates(email.message_from_bytes(head_bytes), sub_body)
+        return
+
+    if head.get_content_type() in ("text/plain", "text/html") and is_inline_text(head):
+        yield head, body
+
+
+def raw_payload(msg) -> bytes:
+    payload = msg.get_payload()
+    return payload.encode("ascii", errors="surrogateescape") if isinstance(payload, str) else payload or b""
+
+
+def extract_body_text(msg):
+    """
+    Devuelve el cuerpo como texto.
+    Preferimos text/plain; si no hay, usamos text/html como texto crudo.
+    """
+    if msg.is_multipart():
+        # ya parseado completo: un solo walk(), el HTML queda como reserva sin decodificar
+        html_parts = []
+        for part in msg.walk():
+            content_type = part.get_content_type()
+            if content_type not in ("text/plain", "text/html") or not is_inline_text(part):
+                continue
+            if content_type == "text/html":
+                html_parts.append(part)
+                continue
+            text = decode_part_text(part)
+            if text is not None:
+                return text
+        for part in html_parts:
+            text = decode_part_text(part)
+            if text is not None:
+                return text
+        return ""
+
+    # solo cabeceras (parse_message_lazy): se recorre el cuerpo crudo
+    body = None
+    boundary = msg.get_boundary() if msg.get_content_maintype() == "multipart" else None
+    if boundary:
+        body = raw_payload(msg)
+        if find_delimiter(body, b"--" + boundary.encode("ascii", errors="surrogateescape"), 0) < 0:
+            body = None  # sin boundary en el cuerpo: feedparser lo trata como una sola parte
+    elif msg.get_content_type() == "message/rfc822":
+        body = raw_payload(msg)  # correo reenviado como cuerpo entero: se busca adentro, como walk()
+    if body is None:
+        text = decode_part_text(msg)
+        return text if text is not None else ""
+
+    html_parts = []
+    for part, part_body in iter_text_candidates(msg, body):
+        if part.get_content_type() == "text/html":
+            html_parts.append((part, part_body))
+            continue
+        part.set_payload(part_body.decode("ascii", errors="surrogateescape"))
+        text = decode_part_text(part)
+        if text is not None:
+            return text
+    for part, part_body in html_parts:
+        part.set_payload(part_body.decode("ascii", errors="surrogateescape"))
+        text = decode_part_text(part)
+        if text is not None:
+            return text
+    return ""
@@ -0,0 +1,172 @@
+# raw_spool.py
+#
+# Spool local de correos crudos (RFC822) para no volver a bajarlos de Gmail.
+# Cada correo se guarda UNA vez en disco, direccionado por su identidad
+# (Message-ID, o la clave de cache si no tiene): spool/ab/<sha256>.eml
+# Re-ejecutar un backfill (cache borrado, cambio de parser, backfill de vehículos
+# sobre el mismo rango) lee de disco en vez de volver a hacer FETCH.
+#
+# Límites:
+#   - tamaño máximo total (se borran los más viejos hasta bajar del 90%)
+#   - antigüedad máxima (se borra lo guardado hace más de N días)
+#
+# Lo usan los scripts vía ImapFetcher.fetch_messages(..., spool_keys=...) (imap_fetch.py):
+#   SPOOL = RawSpool(SPOOL_DIR, SPOOL_MAX_MB * 1048576, SPOOL_MAX_DAYS * 86400) if USE_SPOOL else None
+#   ...
+#   print(format_spool_stats(SPOOL))
+#
+# Sin dependencias externas (solo stdlib). Seguro entre hilos (backfill --shards).
+
+import hashlib
+import os
+import threading
+import time
+
+
+class RawSpool:
+
+    def __init__(self, root: str, max_bytes: int, max_age_seconds: float):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+        self.bytes_read = 0
+        self.total_bytes = 0
+        os.makedirs(root, exist_ok=True)
+        self.evict()
+
+    def path_for(self, key: str) -> str:
+        digest = hashlib.sha256(key.encode("utf-8", errors="replace")).hexdigest()
+        return os.path.join(self.root, digest[:2], digest + ".eml")
+
+    def get(self, key: str):
+        """
+        Bytes crudos del correo o None (no está, expiró o no se pudo leer).
+        """
+        if not key:
+            return None
+        path = self.path_for(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age_seconds:
+                raw = None
+            else:
+                with open(path, "rb") as f:
+                    raw = f.read()
+        except OSError:
+            raw = None
+
+        with self.lock:
+            if raw:
+                self.hits += 1
+                self.bytes_read += len(raw)
+            else:
+                self.misses += 1
+        return raw or None
+
+    def put(self, key: str, raw: bytes):
+        """
+        Guarda el correo (escritura atómica: tmp + rename). Si ya estaba y no expiró no hace nada;
+        si expiró se reescribe (si no, get() lo seguiría dando por ausente y se bajaría cada vez).
+        """
+        if not key or not raw:
+            return
+        path = self.path_for(key)
+        old_size = 0
+        try:
+            st = os.stat(path)
+            if time.time() - st.st_mtime <= self.max_age_seconds:
+                return
+            old_size = st.st_size
+        except OSError:
+            pass
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(raw)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"Spool: no se pudo guardar {key}: {e}")
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+
+        with self.lock:
+            self.stored += 1
+            self.total_bytes += len(raw) - old_size
+            over = self.total_bytes > self.max_bytes
+        if over:
+            self.evict()
+
+    def evict(self):
+        """
+        Borra lo expirado y, si el spool sigue pasado de tamaño, los más viejos
+        hasta quedar en el 90% del máximo. Recalcula el tamaño total.
+        """
+        with self.lock:
+            now = time.time()
+            entries = []
+            for dirpath, _, files in os.walk(self.root):
+                for name in files:
+                    path = os.path.join(dirpath, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    if name.endswith(".tmp"):
+                        # restos de una escritura interrumpida
+                        if now - st.st_mtime > 3600:
+                            self.remove(path)
+                        continue
+                    if now - st.st_mtime > self.max_age_seconds:
+                        if self.remove(path):
+                            self.evicted += 1
+                        continue
+                    entries.append((st.st_mtime, st.st_size, path))
+
+            total = sum(size for _, size, _ in entries)
+            if total > self.max_bytes:
+                target = int(self.max_bytes * 0.9)
+                for _, size, path in sorted(entries):
+                    if total <= target:
+                        break
+                    if self.remove(path):
+                        total -= size
+                        self.evicted += 1
+            self.total_bytes = total
+
+    @staticmethod
+    def remove(path: str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "stored": self.stored,
+                "evicted": self.evicted,
+                "bytesRead": self.bytes_read,
+                "totalBytes": self.total_bytes,
+            }
+
+
+def format_spool_stats(spool: RawSpool) -> str:
+    if spool is None:
+        return "Spool: no activo (ALERT_SPOOL=1 para guardar los correos crudos en disco)"
+    s = spool.stats()
+    return (
+        f"Spool {spool.root}: leídos de disco={s['hits']} ({s['bytesRead'] / 1048576:.2f} MB) | "
+        f"bajados y guardados={s['stored']} | expulsados={s['evicted']} | "
+        f"tamaño {s['totalBytes'] / 1048576:.1f}/{spool.max_bytes / 1048576:.0f} MB"
+    )
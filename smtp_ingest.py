@@ -0,0 +1,296 @@
+# smtp_ingest.py
+#
+# Receptor SMTP / LMTP local: para sitios donde controlamos el ruteo del correo,
+# las alarmas llegan directo al proceso (sin esperar el poll de Gmail).
+#
+#   Postfix:  transport_maps -> alertas@dominio  lmtp:inet:127.0.0.1:2525
+#   o relay SMTP normal a 127.0.0.1:2525
+#
+# El mismo puerto habla SMTP (EHLO/HELO) y LMTP (LHLO), según cómo salude el cliente.
+# Cada conexión se atiende en su propio hilo (varios envíos a la vez).
+#
+# Entrega "at-least-once":
+#   DATA -> se escribe en disco (fsync + rename) -> RECIÉN AHÍ se responde 250
+#   workers -> handler(raw) -> True/False = listo (se borra) | None = reintentar más tarde
+# Si el proceso se cae, lo que quedó en la cola se reprocesa al arrancar
+# (el dedupe por clave de cache evita duplicar en la API).
+# Los reintentos esperan cada vez el doble (tope 1 h); tras 'max_attempts' fallos el correo
+# pasa a <cola>/dead/ (no se borra: se puede volver a encolar moviéndolo a la cola).
+#
+# Lo usa gmail_alert_listener.py con --smtp HOST:PUERTO. Solo stdlib.
+
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+
+class DurableQueue:
+    """
+    Cola en disco: un archivo .eml por correo, nombre ordenable por llegada.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.lock = threading.Lock()
+        self.counter = 0
+        os.makedirs(root, exist_ok=True)
+
+    def put(self, raw: bytes) -> str:
+        with self.lock:
+            self.counter += 1
+            name = f"{time.time_ns()}-{os.getpid()}-{self.counter:06d}.eml"
+        path = os.path.join(self.root, name)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(raw)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        self.fsync_dir()
+        return name
+
+    def fsync_dir(self):
+        try:
+            fd = os.open(self.root, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def read(self, name: str) -> bytes:
+        with open(os.path.join(self.root, name), "rb") as f:
+            return f.read()
+
+    def done(self, name: str):
+        try:
+            os.remove(os.path.join(self.root, name))
+        except OSError:
+            pass
+
+    def pending(self) -> list:
+        return sorted(n for n in os.listdir(self.root) if n.endswith(".eml"))
+
+    def dead(self, name: str):
+        """
+        Lo saca de la cola a <root>/dead/ (no se reintenta más).
+        """
+        dead_dir = os.path.join(self.root, "dead")
+        os.makedirs(dead_dir, exist_ok=True)
+        os.replace(os.path.join(self.root, name), os.path.join(dead_dir, name))
+
+
+class SmtpIngestHandler(socketserver.StreamRequestHandler):
+    """
+    Subconjunto de SMTP (RFC 5321) / LMTP (RFC 2033) suficiente para recibir correo:
+    EHLO/HELO/LHLO, MAIL, RCPT, DATA, RSET, NOOP, QUIT.
+    """
+
+    def reply(self, line: str):
+        self.wfile.write(line.encode() + b"\r\n")
+        self.wfile.flush()
+
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        srv = self.server
+        self.reply(f"220 {srv.hostname} ESMTP/LMTP receptor de alertas")
+        lmtp = False
+        mail_from = None
+        rcpts = []
+
+        while True:
+            line = self.rfile.readline(4096)
+            if not line:
+                return
+            text = line.decode("utf-8", errors="replace").rstrip("\r\n")
+            cmd = text[:4].upper()
+            arg = text[4:].strip()
+
+            if cmd in ("EHLO", "LHLO"):
+                lmtp = cmd == "LHLO"
+                mail_from, rcpts = None, []
+                self.reply(f"250-{srv.hostname}")
+                self.reply("250-PIPELINING")
+                self.reply("250-8BITMIME")
+                self.reply(f"250 SIZE {srv.max_bytes}")
+            elif cmd == "HELO":
+                lmtp = False
+                mail_from, rcpts = None, []
+                self.reply(f"250 {srv.hostname}")
+            elif cmd == "MAIL":
+                mail_from, rcpts = arg, []
+                self.reply("250 OK")
+            elif cmd == "RCPT":
+                if mail_from is None:
+                    self.reply("503 Falta MAIL FROM")
+                    continue
+                rcpts.append(arg)
+                self.reply("250 OK")
+            elif cmd == "DATA":
+                if not rcpts:
+                    self.reply("503 Falta RCPT TO")
+                    continue
+                self.reply("354 Terminar con <CRLF>.<CRLF>")
+                raw, status = self.read_data()
+                if raw is not None:
+                    status = self.enqueue(raw)
+                # LMTP: un estado por destinatario; SMTP: uno solo
+                for _ in (rcpts if lmtp else [None]):
+                    self.reply(status)
+                mail_from, rcpts = None, []
+            elif cmd == "RSET":
+                mail_from, rcpts = None, []
+                self.reply("250 OK")
+            elif cmd == "NOOP":
+                self.reply("250 OK")
+            elif cmd == "QUIT":
+                self.reply("221 Chau")
+                return
+            else:
+                self.reply("502 Comando no soportado")
+
+    def read_data(self):
+        """
+        Lee hasta la línea '.', deshaciendo el dot-stuffing. Devuelve (bytes, None) o
+        (None, respuesta de error) si el mensaje pasa el máximo o trae una línea más larga
+        que max_line_bytes (se sigue leyendo hasta el final igual, para no desincronizar la sesión).
+        """
+        srv = self.server
+        chunks = []
+        size = 0
+        error = None
+        line_start = True
+        while True:
+            line = self.rfile.readline(srv.max_line_bytes + 1)
+            if not line or (line_start and line in (b".\r\n", b".\n")):
+                break
+            complete = line.endswith(b"\n")
+            if error is None:
+                if not complete and len(line) > srv.max_line_bytes:
+                    error = f"500 Línea de más de {srv.max_line_bytes} bytes"
+                elif line_start and line.startswith(b".."):
+                    line = line[1:]
+                size += len(line)
+                if error is None and size > srv.max_bytes:
+                    error = f"552 Mensaje supera {srv.max_bytes} bytes"
+                if error is None:
+                    chunks.append(line)
+                else:
+                    chunks = []
+            line_start = complete
+        return (None, error) if error else (b"".join(chunks), None)
+
+    def enqueue(self, raw: bytes) -> str:
+        srv = self.server
+        try:
+            name = srv.queue.put(raw)
+        except OSError as e:
+            print(f"SMTP: no se pudo encolar en disco: {e}")
+            return "451 Error temporal guardando el mensaje"
+        srv.work.put(name)
+        with srv.stats_lock:
+            srv.stats["accepted"] += 1
+        return f"250 OK encolado {name}"
+
+
+class SmtpIngestServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, handler, queue_dir: str, workers: int = 4, max_bytes: int = 25 * 1048576,
+                 retry_seconds: float = 30.0, hostname: str = None, max_attempts: int = 30,
+                 max_line_bytes: int = 65536):
+        """
+        'handler(raw, ref)' procesa un correo: True/False = terminado, None = reintentar.
+        'max_line_bytes': RFC 5321 pide 1000, se tolera más (relays que no cortan HTML largo).
+        """
+        super().__init__(address, SmtpIngestHandler)
+        self.process = handler
+        self.queue = DurableQueue(queue_dir)
+        self.work = queue.Queue()
+        self.max_bytes = max_bytes
+        self.retry_seconds = retry_seconds
+        self.max_attempts = max_attempts
+        self.max_line_bytes = max_line_bytes
+        self.hostname = hostname or socket.gethostname()
+        self.stats_lock = threading.Lock()
+        self.stats = {"accepted": 0, "done": 0, "retries": 0, "errors": 0, "dead": 0}
+        self.attempts = {}  # nombre -> intentos fallidos (en memoria: se reinicia al arrancar)
+
+        # lo que quedó de una corrida anterior va primero
+        recovered = self.queue.pending()
+        for name in recovered:
+            self.work.put(name)
+        if recovered:
+            print(f"SMTP: {len(recovered)} correo(s) pendientes en la cola de disco, se reprocesan.")
+
+        for i in range(max(1, workers)):
+            threading.Thread(target=self.worker, name=f"smtp-worker-{i}", daemon=True).start()
+
+    def worker(self):
+        while True:
+            name = self.work.get()
+            try:
+                raw = self.queue.read(name)
+            except OSError:
+                continue  # ya lo procesó otro (recuperación + llegada duplicada)
+            try:
+                result = self.process(raw, name)
+            except Exception as e:
+                print(f"SMTP: error procesando {name}: {e}")
+                result = None
+                with self.stats_lock:
+                    self.stats["errors"] += 1
+
+            if result is None:
+                # API caída o error: queda en disco y se reintenta más tarde
+                with self.stats_lock:
+                    attempts = self.attempts[name] = self.attempts.get(name, 0) + 1
+                    give_up = attempts >= self.max_attempts
+                    self.stats["dead" if give_up else "retries"] += 1
+                if give_up:
+                    print(f"SMTP: {name} falló {attempts} veces, se mueve a la cola muerta (dead/)")
+                    try:
+                        self.queue.dead(name)
+                    except OSError as e:
+                        print(f"SMTP: no se pudo mover {name} a dead/: {e}")
+                    with self.stats_lock:
+                        self.attempts.pop(name, None)
+                    continue
+                delay = min(self.retry_seconds * 2 ** (attempts - 1), 3600)
+                timer = threading.Timer(delay, self.work.put, args=(name,))
+                timer.daemon = True
+                timer.start()
+                continue
+
+            self.queue.done(name)
+            with self.stats_lock:
+                self.attempts.pop(name, None)
+                self.stats["done"] += 1
+
+    def stats_snapshot(self) -> dict:
+        with self.stats_lock:
+            snap = dict(self.stats)
+        snap["queued"] = self.work.qsize()
+        return snap
+
+
+def parse_listen(spec: str, default_port: int = 2525):
+    """
+    'host:puerto' | 'puerto' | 'host' -> (host, puerto)
+    """
+    spec = (spec or "").strip()
+    if not spec:
+        return "127.0.0.1", default_port
+    if spec.isdigit():
+        return "127.0.0.1", int(spec)
+    host, _, port = spec.rpartition(":")
+    if not host:
+        return port, default_port
+    return host, int(port)